@@ -0,0 +1,77 @@
+import math
+
+SKETCH_ACCURACY = 0.01  # relative error of the quantile estimates
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+SKETCH_MIN_VALUE = 1e-3  # smaller reply times (seconds) are counted as zero
+
+
+class ReplyTimes:
+    # Mergeable summary of reply times: count and sum for the mean, plus a log-bucket
+    # quantile sketch. Memory depends on the range of the values, not on their number
+    # (about 1200 buckets between a millisecond and a year).
+    __slots__ = ('count', 'total', 'zeros', 'buckets')
+
+    def __init__(self, values=()):
+        self.count = 0
+        self.total = 0.0
+        self.zeros = 0
+        self.buckets = {}
+        self.extend(values)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < SKETCH_MIN_VALUE:
+            self.zeros += 1
+        else:
+            index = math.ceil(math.log(value) / SKETCH_LOG_GAMMA)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def extend(self, values):
+        # One by one, so the total is rounded exactly like sum(values)
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.zeros += other.zeros
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
+        return 2 * SKETCH_GAMMA ** max(self.buckets) / (SKETCH_GAMMA + 1)
+
+    def __len__(self):
+        return self.count
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'zeros': self.zeros,
+                'buckets': {str(index): count for index, count in self.buckets.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        times = cls()
+        times.count = data['count']
+        times.total = data['total']
+        times.zeros = data['zeros']
+        times.buckets = {int(index): count for index, count in data['buckets'].items()}
+        return times
+
+    def __repr__(self):
+        return f"ReplyTimes(count={self.count}, mean={self.mean()})"
@@ -0,0 +1,934 @@
+import os
+import io
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import gc
+import json
+import platform
+import statistics
+import shutil
+import random
+import functools
+import tracemalloc
+import tarfile
+import zipfile
+import unittest.mock
+from datetime import date, datetime, timedelta, timezone, time as dtime
+
+import stats_tracker
+import message_cache
+import checkpoint
+from fake_telegram import FakeTelegramClient, make_workload, make_message, WORDS
+import vectorized_stats
+import reply_models
+import group_analytics
+import output_writer
+import daemon
+from message_record import MessageRecord, record_from_message
+from telethon.tl.types import PeerUser
+
+
+def snapshot_tree(root):
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, root)] = f.read()
+    return files
+
+
+def run_report(workload, latency, concurrency, start, end, work_start, work_end, **kwargs):
+    me, dialogs, messages = workload
+    client = FakeTelegramClient(me, dialogs, messages, latency=latency)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        stdout = io.StringIO()
+        try:
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(stdout):
+                asyncio.run(stats_tracker.process_chats(client, start, end, work_start, work_end,
+                                                        concurrency=concurrency, **kwargs))
+            elapsed = time.perf_counter() - started
+        finally:
+            os.chdir(cwd)
+        return elapsed, client.api_calls, snapshot_tree(tmp), stdout.getvalue()
+
+
+def bench_concurrency(args):
+    # Timings only, test_process_chats checks that the output does not change
+    workload = make_workload(dms=args.dms, groups=args.groups, days=args.days, seed=args.seed)
+    start, end = date(2024, 3, 4), date(2024, 3, 4 + args.days - 1)
+    work_start, work_end = dtime(9, 0), dtime(18, 0)
+
+    baseline = run_report(workload, args.latency, 1, start, end, work_start, work_end)
+    print(f"sequential:     {baseline[0]:8.3f}s  api calls: {baseline[1]}")
+    for concurrency in args.concurrency:
+        result = run_report(workload, args.latency, concurrency, start, end, work_start, work_end)
+        print(f"concurrency {concurrency:>2}: {result[0]:8.3f}s  api calls: {result[1]}  "
+              f"speedup: {baseline[0] / result[0]:5.2f}x")
+    return 0
+
+
+async def legacy_fetch_messages(client, entity, start_date, end_date):
+    # fetch_messages before id-bounded fetching, kept as the reference for call counts
+    messages = []
+    async for message in client.iter_messages(entity, offset_date=end_date + timedelta(days=1)):
+        if message.date.date() < start_date.date():
+            break
+        if start_date.date() <= message.date.date() <= end_date.date():
+            messages.append(message)
+    return messages
+
+
+async def count_fetch_calls(client, dialogs, start, end, fetch):
+    client.api_calls = 0
+    client.paused = 0.0
+    fetched = {}
+    for dialog in dialogs:
+        messages = await fetch(client, dialog)
+        fetched[dialog.entity.id] = [message.id for message in messages]
+    return client.api_calls, client.paused, fetched
+
+
+def bench_fetch(args):
+    # fetch_messages against walking the history with a date filter; API calls and pauses only,
+    # test_fetch checks that the messages are the same and the calls no more
+    me, dialogs, messages = make_workload(dms=args.dms, groups=args.groups, days=args.days, seed=args.seed,
+                                          group_messages=args.group_messages)
+    client = FakeTelegramClient(me, dialogs, messages)
+    # A window in the middle of the history, so both ends need a bound
+    start = datetime(2024, 3, 4) + timedelta(days=args.days // 3)
+    end = start + timedelta(days=max(args.days // 3 - 1, 0))
+
+    legacy_calls, legacy_paused, legacy = asyncio.run(count_fetch_calls(
+        client, dialogs, start, end,
+        lambda c, d: legacy_fetch_messages(c, d.entity, start, end)))
+    bounded_calls, bounded_paused, _ = asyncio.run(count_fetch_calls(
+        client, dialogs, start, end,
+        lambda c, d: stats_tracker.fetch_messages(c, d.entity, start, end, d.date)))
+
+    total = sum(len(ids) for ids in legacy.values())
+    print(f"messages in window: {total}")
+    print(f"client-side date filter: {legacy_calls} api calls, {legacy_paused:.0f}s of pauses between pages")
+    print(f"fetch_messages:          {bounded_calls} api calls, {bounded_paused:.0f}s of pauses between pages")
+    return 0
+
+
+def bench_split(args):
+    # A report dominated by one huge group: its id range fetched as one serial walk vs in parts;
+    # timings only, test_process_chats checks that the output does not change
+    workload = make_workload(dms=args.dms, groups=1, days=args.days, seed=args.seed,
+                             group_messages=args.group_messages)
+    start, end = date(2024, 3, 4), date(2024, 3, 4) + timedelta(days=args.days - 1)
+    parts = stats_tracker.FETCH_SPLIT_MAX_PARTS
+    try:
+        stats_tracker.FETCH_SPLIT_MAX_PARTS = 1
+        serial = run_report(workload, args.latency, 8, start, end, dtime(9, 0), dtime(18, 0))
+    finally:
+        stats_tracker.FETCH_SPLIT_MAX_PARTS = parts
+    split = run_report(workload, args.latency, 8, start, end, dtime(9, 0), dtime(18, 0))
+    print(f"serial id range: {serial[0]:.2f}s, {serial[1]} api calls")
+    print(f"up to {parts} parts:  {split[0]:.2f}s, {split[1]} api calls")
+    return 0
+
+
+def bench_cache(args):
+    # A rolling window: the second report overlaps the first one by all but one day;
+    # timings only, test_message_cache checks that the output does not change
+    workload = make_workload(dms=args.dms, groups=args.groups, days=args.days + 1, seed=args.seed)
+    work_start, work_end = dtime(9, 0), dtime(18, 0)
+    first = (date(2024, 3, 4), date(2024, 3, 4) + timedelta(days=args.days - 1))
+    second = (first[0] + timedelta(days=1), first[1] + timedelta(days=1))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = message_cache.open_cache(os.path.join(tmp, 'cache.sqlite3'))
+        try:
+            cold = run_report(workload, args.latency, 8, *first, work_start, work_end,
+                              cache=cache, session_id='bench')
+            warm = run_report(workload, args.latency, 8, *second, work_start, work_end,
+                              cache=cache, session_id='bench')
+        finally:
+            cache.close()
+    uncached = run_report(workload, args.latency, 8, *second, work_start, work_end)
+
+    print(f"first report, empty cache: {cold[0]:8.3f}s  api calls: {cold[1]}")
+    print(f"next day, no cache:        {uncached[0]:8.3f}s  api calls: {uncached[1]}")
+    print(f"next day, warm cache:      {warm[0]:8.3f}s  api calls: {warm[1]}")
+    return 0
+
+
+def synthetic_rows(count, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2024, 3, 4, tzinfo=timezone.utc)
+    second = 0
+    rows = []
+    for i in range(count):
+        second += rng.randint(1, 120)
+        text = ' '.join(rng.choices(WORDS, k=rng.randint(1, 12)))
+        rows.append((i + 1, start + timedelta(seconds=second), rng.random() < 0.5, text))
+    return rows
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    objects = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    started = time.perf_counter()
+    stats_tracker.calculate_time_spent(objects, dtime(9, 0), dtime(18, 0), group=True)
+    elapsed = time.perf_counter() - started
+    return size, elapsed
+
+
+def bench_memory(args):
+    # Dates and texts are created up front and shared, so only the per-message objects are measured
+    rows = synthetic_rows(args.count, args.seed)
+    peer = PeerUser(10_000)
+
+    results = {
+        'Telethon Message': measure(lambda: [make_message(i, peer, d, text, out, 10_000) for i, d, out, text in rows]),
+        'MessageRecord': measure(lambda: [MessageRecord(i, d, out, text, text, 10_000) for i, d, out, text in rows]),
+    }
+    for name, (size, elapsed) in results.items():
+        print(f"{name:17} {size / 2 ** 20:9.1f} MiB  {size / args.count:7.1f} B/message  "
+              f"calculate_time_spent: {elapsed:6.2f}s")
+    return 0
+
+
+def loop_time_spent(messages, work_start, work_end, group=False):
+    # calculate_time_spent without the vectorised fast path
+    state = stats_tracker.new_reply_state(group)
+    for msg in sorted(messages, key=lambda m: m.date):
+        stats_tracker.update_reply_state(state, msg, work_start, work_end)
+    return stats_tracker.finish_reply_state(state)
+
+
+def random_conversation(rng, count):
+    # Bursts of both directions, same-second messages, empty texts and long gaps over several days
+    start = datetime(2024, 3, 4, tzinfo=timezone.utc) + timedelta(seconds=rng.randrange(86400))
+    second = 0
+    messages = []
+    for i in range(count):
+        second += rng.choice([0, 1, rng.randint(1, 600), rng.randint(600, 86400)])
+        text = '' if rng.random() < 0.1 else ' '.join(rng.choices(WORDS, k=rng.randint(1, 8)))
+        messages.append(MessageRecord(i + 1, start + timedelta(seconds=second), rng.random() < 0.5, text, text))
+    rng.shuffle(messages)
+    return messages
+
+
+def bench_vectorized(args):
+    if not vectorized_stats.available():
+        print("numpy is not installed")
+        return 1
+
+    # Timings only, test_vectorized_stats checks the results against the loop
+    rng = random.Random(args.seed)
+    # Newest first, the order fetch_messages returns
+    messages = sorted(random_conversation(rng, args.count), key=lambda m: m.id, reverse=True)
+    started = time.perf_counter()
+    arrays = vectorized_stats.to_arrays(messages)
+    conversion = time.perf_counter() - started
+    print(f"{args.count} messages: records to arrays {conversion:.3f}s")
+    for group in (False, True):
+        started = time.perf_counter()
+        loop_time_spent(messages, dtime(9, 0), dtime(18, 0), group)
+        loop = time.perf_counter() - started
+        started = time.perf_counter()
+        vectorized_stats.calculate_time_spent_arrays(*arrays, dtime(9, 0), dtime(18, 0), group)
+        vectorized = time.perf_counter() - started
+        print(f"  group={group}: loop {loop:.3f}s  numpy on arrays {vectorized:.3f}s "
+              f"({loop / vectorized:.0f}x), including conversion {loop / (vectorized + conversion):.1f}x")
+    return 0
+
+
+def bench_models(args):
+    # Every preset in one pass against one per-message pass of the legacy code; timings only,
+    # test_reply_models checks the models against calculate_time_spent
+    rng = random.Random(args.seed)
+    first_day, last_day = date(2024, 3, 4), date(2024, 3, 4) + timedelta(days=args.days + 30)
+    messages = random_conversation(rng, args.count)
+    models = [reply_models.compile_model(model, first_day, last_day)
+              for model in reply_models.preset_models(reply_models.PRESETS, dtime(9, 0), dtime(18, 0))]
+    for group in (False, True):
+        started = time.perf_counter()
+        loop_time_spent(messages, dtime(9, 0), dtime(18, 0), group)
+        loop = time.perf_counter() - started
+        started = time.perf_counter()
+        reply_models.calculate_models(messages, models, group)
+        compiled = time.perf_counter() - started
+        print(f"  group={group}: legacy loop {loop:.3f}s, {len(models)} models in one pass {compiled:.3f}s "
+              f"({compiled / len(models):.3f}s per model)")
+    return 0
+
+
+def random_group(rng, count, participants=200, reply_share=0.3, mention_share=0.05):
+    # A busy megagroup: messages from many senders, replies to recent messages, mentions of me
+    start = datetime(2024, 3, 4, tzinfo=timezone.utc)
+    second = 0
+    messages = []
+    for i in range(count):
+        second += rng.randint(0, 30)
+        out = rng.random() < 0.1
+        text = ' '.join(rng.choices(WORDS, k=rng.randint(1, 8)))
+        target = messages[rng.randrange(max(0, i - 50), i)] if i and rng.random() < reply_share else None
+        mentioned = not out and (rng.random() < mention_share or bool(target and target.out))
+        messages.append(MessageRecord(i + 1, start + timedelta(seconds=second), out, text, text,
+                                      1 if out else 1000 + rng.randrange(participants), None,
+                                      target.id if target else None, mentioned))
+    return messages
+
+
+def scan_group_replies(messages):
+    # group_analytics' attribution of my replies, finding every message by scanning the list
+    ordered = sorted(messages, key=lambda m: (m.date, m.id))
+    replies, answered, last_incoming = {}, set(), None
+    for i, msg in enumerate(ordered):
+        if not msg.out:
+            last_incoming = msg
+            continue
+        target = next((m for m in ordered[:i] if m.id == msg.reply_to), None) if msg.reply_to else None
+        if target is None or target.out:
+            target = next((m for m in ordered[:i] if not m.out and m.mentioned and m.id not in answered),
+                          last_incoming)
+        if target is None:
+            continue
+        answered.add(target.id)
+        last_incoming = None
+        counts = replies.setdefault(target.sender_id, [0, 0.0])
+        counts[0] += 1
+        counts[1] += (msg.date - target.date).total_seconds()
+    return replies
+
+
+def bench_groups(args):
+    # Indexed group analytics against a list-scanning reference, its time per message as the group
+    # grows, then a report with group analytics; timings only, test_group_analytics checks the results
+    rng = random.Random(args.seed)
+    messages = random_group(rng, 5000)
+    started = time.perf_counter()
+    scan_group_replies(messages)
+    scanned = time.perf_counter() - started
+    started = time.perf_counter()
+    group_analytics.analyze_group(messages)
+    indexed = time.perf_counter() - started
+    print(f"  5000 messages: list scanning {scanned:.3f}s, indexed {indexed:.3f}s ({scanned / indexed:.0f}x)")
+    for count in (args.count // 4, args.count // 2, args.count):
+        messages = random_group(rng, count, participants=count // 100)
+        started = time.perf_counter()
+        analytics = group_analytics.analyze_group(messages)
+        elapsed = time.perf_counter() - started
+        print(f"  {count} messages, {len(analytics['participants'])} participants: {elapsed:.3f}s "
+              f"({elapsed / count * 1e6:.2f}us per message)")
+
+    start, end = date(2024, 3, 4), date(2024, 3, 4) + timedelta(days=args.days - 1)
+    workload = make_workload(dms=args.dms, groups=args.groups, days=args.days, seed=args.seed, reply_share=0.3,
+                             mention_share=0.05)
+    plain = run_report(workload, 0, 8, start, end, dtime(9, 0), dtime(18, 0))
+    report = run_report(workload, 0, 8, start, end, dtime(9, 0), dtime(18, 0), analyze_groups=True)
+    print(f"report: {plain[0]:.2f}s, with group analytics: {report[0]:.2f}s")
+    name = next(name for name in report[2] if '_group_analytics_' in name)
+    print('\n'.join(report[2][name].decode('utf-8').splitlines()[:12]))
+    return 0
+
+
+class InterruptedClient(FakeTelegramClient):
+    # Drops the connection on the n-th history request, like a network failure halfway through a run
+    def __init__(self, *args, fail_after=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.histories_left = fail_after
+
+    async def iter_messages(self, entity, *args, **kwargs):
+        self.histories_left -= 1
+        if self.histories_left == 0:
+            raise ConnectionError('connection dropped')
+        async for message in super().iter_messages(entity, *args, **kwargs):
+            yield message
+
+
+def bench_media(args):
+    # Media-aware accounting on a workload with voice notes, photos, stickers and forwards against
+    # a text-only workload of the same size; test_message_record checks the calls and the cache
+    start, end = date(2024, 3, 4), date(2024, 3, 4) + timedelta(days=args.days - 1)
+    workload = make_workload(dms=args.dms, groups=args.groups, days=args.days, seed=args.seed,
+                             media_share=args.media_share)
+    # the same messages without their media metadata
+    text_only = make_workload(dms=args.dms, groups=args.groups, days=args.days, seed=args.seed,
+                              media_share=args.media_share)
+    for history in text_only[2].values():
+        for message in history:
+            message.media = message.fwd_from = None
+    models = reply_models.preset_models(['legacy', 'media'], dtime(9, 0), dtime(18, 0))
+    report = run_report(workload, 0, 8, start, end, dtime(9, 0), dtime(18, 0), models=models)
+    baseline = run_report(text_only, 0, 8, start, end, dtime(9, 0), dtime(18, 0))
+    print(f"with media: {report[0]:.2f}s, {report[1]} API calls; text only: {baseline[0]:.2f}s, {baseline[1]} API calls")
+    name = next(name for name in report[2] if '_models_' in name)
+    print(report[2][name].decode('utf-8'))
+    return 0
+
+
+def bench_resume(args):
+    # A run interrupted halfway and started again against an uninterrupted run; API calls and
+    # journal size only, test_checkpoint checks that the output is identical
+    me, dialogs, messages = workload = make_workload(dms=args.dms, groups=args.groups, days=args.days, seed=args.seed)
+    start, end = date(2024, 3, 4), date(2024, 3, 4) + timedelta(days=args.days - 1)
+    clean = run_report(workload, 0, 8, start, end, dtime(9, 0), dtime(18, 0))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = InterruptedClient(me, dialogs, messages, fail_after=len(dialogs) // 2)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                asyncio.run(stats_tracker.process_chats(client, start, end, dtime(9, 0), dtime(18, 0),
+                                                        output_root=tmp))
+        except ConnectionError:
+            pass
+        first_calls = client.api_calls
+        journal = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(tmp)
+                      for name in names if name == checkpoint.JOURNAL_NAME)
+        client = FakeTelegramClient(me, dialogs, messages)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(stats_tracker.process_chats(client, start, end, dtime(9, 0), dtime(18, 0), output_root=tmp))
+        resumed = time.perf_counter() - started
+    print(f"uninterrupted run: {clean[0]:.2f}s, {clean[1]} API calls; interrupted run: {first_calls} API calls, "
+          f"journal {journal / 1024:.0f} KB; resumed run: {resumed:.2f}s, {client.api_calls} API calls")
+    return 0
+
+
+def bench_shards(args):
+    # One process against N worker processes on the same workload; timings only,
+    # test_sharding checks that the output is identical
+    workload = make_workload(dms=args.dms, groups=args.groups, days=args.days, seed=args.seed)
+    start, end = date(2024, 3, 4), date(2024, 3, 4) + timedelta(days=args.days - 1)
+    single = run_report(workload, args.latency, 8, start, end, dtime(9, 0), dtime(18, 0))
+    print(f"1 process: {single[0]:.2f}s")
+    for shards in args.shards:
+        make_client = functools.partial(FakeTelegramClient, *workload, latency=args.latency)
+        sharded = run_report(workload, args.latency, 8, start, end, dtime(9, 0), dtime(18, 0), shards=shards,
+                             make_client=make_client)
+        print(f"{shards} shards: {sharded[0]:.2f}s")
+    return 0
+
+
+def bench_offload(args):
+    # Timings only, test_process_chats checks that every offload mode writes the same files
+    workload = make_workload(dms=args.dms, groups=args.groups, days=args.days, seed=args.seed,
+                             group_messages=args.group_messages)
+    start, end = date(2024, 3, 4), date(2024, 3, 4 + args.days - 1)
+    work_start, work_end = dtime(9, 0), dtime(18, 0)
+
+    for offload in (None, 'thread', 'process'):
+        result = run_report(workload, args.latency, 8, start, end, work_start, work_end,
+                            offload=offload, report_timings=True)
+        timing = result[3][result[3].index('=== Время выполнения ==='):].strip().splitlines()[1:]
+        print(f"offload={offload}: {result[0]:.2f}s")
+        for line in timing:
+            print(f"    {line}")
+    return 0
+
+
+def legacy_save_messages(user_dir, file_name, messages):
+    # save_messages before the buffered writer: strftime and file.write for every message
+    with open(os.path.join(user_dir, file_name), 'w', encoding='utf-8') as file:
+        for msg in reversed(messages):
+            time_str = msg.date.strftime('%d.%m %H:%M:%S')
+            direction = 'Исходящее' if msg.out else 'Входящее '
+            content = msg.text or f"<{msg.message or 'Не текстовое сообщ.'}>"
+            lines = content.split('\n')
+            file.write(f"[{time_str}] ({direction}) {lines[0]}\n")
+            indent_length = len(f"[{time_str}] ({direction}) ")
+            for line in lines[1:]:
+                file.write(' ' * indent_length + line + '\n')
+
+
+def write_chats(root, chats, save):
+    started = time.perf_counter()
+    for i, messages in enumerate(chats):
+        user_dir = os.path.join(root, f'chat{i}')
+        os.makedirs(user_dir, exist_ok=True)
+        save(user_dir, f'chat{i}.txt', messages)
+    return time.perf_counter() - started
+
+
+def place_unanswered(root, count, place):
+    started = time.perf_counter()
+    for i in range(count):
+        place(os.path.join(root, f'chat{i}'), os.path.join(root, '!!!!!UNANSWERED', f'chat{i}'))
+    return time.perf_counter() - started
+
+
+def bench_transcripts(args):
+    # Timings only, test_output_writer checks that both ways write the same files
+    rng = random.Random(args.seed)
+    chats = []
+    for _ in range(args.chats):
+        messages = sorted(random_conversation(rng, args.messages), key=lambda m: m.id, reverse=True)
+        for msg in messages[::10]:
+            msg.text += '\n' + ' '.join(rng.choices(WORDS, k=4))
+        chats.append(messages)
+
+    with tempfile.TemporaryDirectory() as legacy, tempfile.TemporaryDirectory() as buffered:
+        legacy_write = write_chats(legacy, chats, legacy_save_messages)
+        buffered_write = write_chats(buffered, chats, stats_tracker.save_messages)
+        copy = place_unanswered(legacy, args.chats, lambda source, dest: shutil.copytree(source, dest, dirs_exist_ok=True))
+        link = place_unanswered(buffered, args.chats, output_writer.link_tree)
+
+    print(f"{args.chats} chats x {args.messages} messages")
+    print(f"  transcripts: per-line writes {legacy_write:.3f}s  buffered {buffered_write:.3f}s "
+          f"({legacy_write / buffered_write:.1f}x)")
+    print(f"  UNANSWERED:  copytree {copy:.3f}s  links {link:.3f}s ({copy / link:.1f}x)")
+    return 0
+
+
+def archive_files(path):
+    # Member name -> content, hardlink members of tar archives resolved
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+    if path.endswith('.tar.zst'):
+        with open(path, 'rb') as f:
+            data = output_writer.zstandard.ZstdDecompressor().stream_reader(f).read()
+        archive = tarfile.open(fileobj=io.BytesIO(data))
+    else:
+        archive = tarfile.open(path)
+    with archive:
+        return {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+
+
+def slow_disk(delay):
+    # Every file written through output_writer takes delay seconds longer
+    atomic_write = output_writer.atomic_write
+
+    def slow_atomic_write(path, data):
+        time.sleep(delay)
+        atomic_write(path, data)
+    return slow_atomic_write
+
+
+def bench_archive(args):
+    # The messages folder against the same report as one archive: their size on disk, and fetching
+    # against the writer stage on a slow disk; test_output_writer checks that the files are the same
+    workload = make_workload(dms=args.dms, groups=args.groups, days=args.days, seed=args.seed)
+    start, end = date(2024, 3, 4), date(2024, 3, 4) + timedelta(days=args.days - 1)
+    folder = run_report(workload, 0, 8, start, end, dtime(9, 0), dtime(18, 0))
+    messages = {name: data for name, data in folder[2].items() if '_messages_' in name}
+    print(f"folder: {folder[0]:.2f}s  {len(messages)} files, {sum(map(len, messages.values())) / 1e6:.1f} MB")
+    for archive in output_writer.available_archive_formats():
+        result = run_report(workload, 0, 8, start, end, dtime(9, 0), dtime(18, 0), archive=archive)
+        [data] = [data for name, data in result[2].items() if name.endswith(archive)]
+        print(f"{archive}: {result[0]:.2f}s  {len(data) / 1e6:.1f} MB")
+
+    with unittest.mock.patch.object(output_writer, 'atomic_write', slow_disk(args.write_delay)):
+        slow = run_report(workload, args.latency, 8, start, end, dtime(9, 0), dtime(18, 0), report_timings=True)
+    print(f"disk {args.write_delay * 1000:.0f}ms per file, API {args.latency * 1000:.0f}ms per call:")
+    for line in slow[3][slow[3].index('=== Время выполнения ==='):].strip().splitlines()[1:]:
+        print(f"    {line}")
+    return 0
+
+
+def summary_lines(stdout):
+    # The totals of print_summary without the dialog counts, which depend on the dialog list
+    lines = stdout[stdout.index('=== Общая статистика ==='):].splitlines()
+    return [line for line in lines if not line.startswith(('Всего чатов', 'Всего групп'))]
+
+
+def bench_partials(args):
+    # One cached report over the whole workload, then sub-ranges from the stored day partials
+    # against full reports of the same ranges; timings only, test_partials checks the totals
+    workload = make_workload(dms=args.dms, groups=args.groups, days=args.days, seed=args.seed)
+    work_start, work_end = dtime(9, 0), dtime(18, 0)
+    first_day = date(2024, 3, 4)
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = message_cache.open_cache(os.path.join(tmp, 'cache.sqlite3'))
+        try:
+            run_report(workload, 0, 8, first_day, first_day + timedelta(days=args.days - 1), work_start, work_end,
+                       cache=cache, session_id='bench')
+            for _ in range(args.ranges):
+                start = first_day + timedelta(days=rng.randrange(args.days))
+                end = start + timedelta(days=rng.randrange((first_day - start).days + args.days))
+                report = run_report(workload, 0, 8, start, end, work_start, work_end)
+
+                started = time.perf_counter()
+                stats_tracker.totals_from_partials(cache, 'bench', datetime.combine(start, dtime.min),
+                                                   datetime.combine(end, dtime.min), work_start, work_end)
+                merged = time.perf_counter() - started
+                print(f"{start} - {end}: full report {report[0]:.3f}s  from partials {merged:.3f}s")
+        finally:
+            cache.close()
+    return 0
+
+
+def bench_rolling(args):
+    # Daily rolling reports over a warm cache, built in full and incrementally, with the JSON report
+    # and its diff; timings only, test_incremental checks the partials and the output
+    first = date(2024, 3, 4)
+    workload = make_workload(dms=args.dms, groups=args.groups, days=args.window + args.runs - 1, seed=args.seed,
+                             dm_messages=args.dm_messages, group_messages=args.group_messages)
+    with tempfile.TemporaryDirectory() as tmp:
+        caches = {mode: message_cache.open_cache(os.path.join(tmp, f'{mode}.sqlite3')) for mode in ('full', 'incr')}
+        try:
+            for run in range(args.runs):
+                start = first + timedelta(days=run)
+                end = start + timedelta(days=args.window - 1)
+                elapsed = {}
+                for mode, cache in caches.items():
+                    client = FakeTelegramClient(*workload)
+                    started = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        asyncio.run(stats_tracker.process_chats(client, start, end, dtime(9, 0), dtime(18, 0),
+                                                                cache=cache, session_id='bench',
+                                                                output_root=os.path.join(tmp, mode),
+                                                                incremental=mode == 'incr', diff=True))
+                    elapsed[mode] = time.perf_counter() - started
+                print(f"{start} - {end}: full {elapsed['full']:.3f}s  incremental {elapsed['incr']:.3f}s "
+                      f"({elapsed['full'] / elapsed['incr']:.1f}x)")
+        finally:
+            for cache in caches.values():
+                cache.close()
+        diffs = sorted(name for name in os.listdir(os.path.join(tmp, 'incr')) if '_report_diff_' in name)
+        with open(os.path.join(tmp, 'incr', diffs[-1]), encoding='utf-8') as f:
+            changes = json.load(f)
+    print(f"last diff: {len(changes['new_unanswered'])} new unanswered chats, {len(changes['answered'])} answered, "
+          f"reply time changed in {len(changes['reply_time_changes'])} chats")
+    return 0
+
+
+async def enumerate_dialogs(client, start):
+    # The enumeration process_chats does without the dialog index
+    peers = []
+    async for dialog in client.iter_dialogs(offset_date=datetime.now()):
+        if dialog.date.date() < start:
+            if dialog.pinned:
+                continue
+            break
+        peers.append(dialog.entity.id)
+    return peers
+
+
+def bench_dialogs(args):
+    # Many dialogs with little activity; a 30 day report, then the same report after some
+    # dialogs received new messages. Pages only, test_dialog_index checks the chosen dialogs
+    me, dialogs, messages = make_workload(dms=args.dialogs, groups=0, dm_messages=2, days=args.days, seed=args.seed)
+    first_day = date(2024, 3, 4)
+    start = first_day + timedelta(days=args.days - 30)
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = message_cache.open_cache(os.path.join(tmp, 'cache.sqlite3'))
+        client = FakeTelegramClient(me, dialogs, messages)
+        for run in ('first run', 'next run'):
+            if run == 'next run':
+                latest = max(dialog.date for dialog in dialogs)
+                for dialog in rng.sample(dialogs, args.active):
+                    dialog.date = latest + timedelta(seconds=rng.randrange(1, 86400))
+
+            client.api_calls = 0
+            expected = asyncio.run(enumerate_dialogs(client, start))
+            plain = client.api_calls
+
+            client.api_calls = 0
+            asyncio.run(stats_tracker.refresh_dialog_index(client, cache, 'bench'))
+            indexed = client.api_calls
+
+            print(f"{run}: iter_dialogs pages without index {plain}, with index {indexed} ({len(expected)} dialogs)")
+        cache.close()
+    return 0
+
+
+# Workloads of the suite, arguments of make_workload
+WORKLOADS = {
+    'small_dms': dict(dms=1000, groups=0, dm_messages=20, days=7),
+    'megagroups': dict(dms=10, groups=4, dm_messages=100, group_messages=25_000, days=7),
+    'long_messages': dict(dms=60, groups=2, dm_messages=200, group_messages=2000, days=7, long_share=0.3),
+    'long_range': dict(dms=60, groups=2, dm_messages=600, group_messages=10_000, days=120),
+}
+
+
+NOISE_FLOOR = 0.005  # seconds; smaller slowdowns are not reported as regressions
+
+
+def median_time(repeat, run):
+    # Median of the repeats, in seconds
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def suite_workload(name, workload, args):
+    me, dialogs, messages = workload
+    days = WORKLOADS[name]['days']
+    start, end = date(2024, 3, 4), date(2024, 3, 4) + timedelta(days=days - 1)
+    work_start, work_end = dtime(9, 0), dtime(18, 0)
+    results = {}
+
+    reports = [run_report(workload, args.latency, 8, start, end, work_start, work_end, verbose=False)
+               for _ in range(args.repeat)]
+    results['process_chats'] = statistics.median(report[0] for report in reports)
+    results['api_calls'] = reports[0][1]
+
+    # The biggest dialog, newest first like fetch_messages returns it
+    peer_id = max(messages, key=lambda peer: len(messages[peer]))
+    records = [record_from_message(message) for message in reversed(messages[peer_id])]
+    results['calculate_time_spent'] = median_time(args.repeat, lambda: stats_tracker.calculate_time_spent(
+        records, work_start, work_end, group=peer_id >= 20_000))
+    results['calculate_time_spent_loop'] = median_time(args.repeat, lambda: loop_time_spent(
+        records, work_start, work_end, group=peer_id >= 20_000))
+
+    all_records = [[record_from_message(message) for message in reversed(history)] for history in messages.values()]
+    chat_stats = []
+    for history in all_records:
+        stats = stats_tracker.calculate_time_spent(history, work_start, work_end)
+        chat_stats.append({
+            'chat_name': 'bench',
+            'typing_time': stats_tracker.format_time(stats['typing_time']),
+            'reading_time': stats_tracker.format_time(stats['reading_time']),
+            'total_incoming_messages': stats['incoming_messages'],
+            'total_outgoing_messages': stats['outgoing_messages'],
+            'total_incoming_symbols': stats['incoming_symbols'],
+            'total_outgoing_symbols': stats['outgoing_symbols'],
+            'work_reply_time': 'N/A',
+            'night_reply_time': 'N/A',
+            'messages_without_reply': stats['messages_without_reply'],
+        })
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results['save_messages'] = median_time(args.repeat, lambda: [
+            stats_tracker.save_messages(tmp, f'{i}.txt', history) for i, history in enumerate(all_records)])
+        results['write_chat_statistics'] = median_time(args.repeat, lambda: stats_tracker.write_chat_statistics(
+            chat_stats, os.path.join(tmp, 'statistics.txt')))
+    results['messages'] = sum(len(history) for history in messages.values())
+    return results
+
+
+def compare_results(previous, current, threshold):
+    # Prints the change of every timing against an earlier run; returns the regressions
+    regressions = []
+    print(f"\ncompared to {previous['created']} ({previous['python']}):")
+    for workload, results in current['results'].items():
+        for bench, value in results.items():
+            before = previous['results'].get(workload, {}).get(bench)
+            if before is None or bench in ('api_calls', 'messages'):
+                continue
+            change = value / before - 1 if before else 0
+            mark = ''
+            if change > threshold and value - before > NOISE_FLOOR:
+                mark = '  REGRESSION'
+                regressions.append(f'{workload}/{bench}')
+            print(f"  {workload:14} {bench:26} {before:8.3f}s -> {value:8.3f}s  {change:+6.0%}{mark}")
+    for workload, results in current['results'].items():
+        before = previous['results'].get(workload, {}).get('api_calls')
+        if before is not None and results['api_calls'] != before:
+            print(f"  {workload:14} api calls {before} -> {results['api_calls']}")
+    return regressions
+
+
+def bench_suite(args):
+    names = args.workloads or list(WORKLOADS)
+    current = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': vectorized_stats.available(),
+        'latency': args.latency,
+        'repeat': args.repeat,
+        'results': {},
+    }
+    for name in names:
+        workload = make_workload(seed=args.seed, **WORKLOADS[name])
+        results = suite_workload(name, workload, args)
+        current['results'][name] = results
+        print(f"{name}: {results['messages']} messages, {results['api_calls']} api calls")
+        for bench, value in results.items():
+            if bench not in ('api_calls', 'messages'):
+                print(f"  {bench:26} {value:8.3f}s")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=1)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+        if compare_results(previous, current, args.threshold):
+            return 1
+    return 0
+
+
+async def query_daemon(socket_path):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(b"GET /stats HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+async def replay_day(me, dialogs, messages, live_share, snapshot_interval):
+    # Starts the daemon with the first part of today's messages already sent, delivers the
+    # rest as NewMessage events (plus duplicates of some) and returns its statistics
+    arrived = sorted(((m.date, m.id, peer_id) for peer_id, history in messages.items() for m in history))
+    cut = int(len(arrived) * (1 - live_share))
+    history = {peer_id: [m for m in msgs if (m.date, m.id, peer_id) < arrived[cut]] if cut < len(arrived) else msgs
+               for peer_id, msgs in messages.items()}
+    by_key = {(m.date, m.id, peer_id): m for peer_id, msgs in messages.items() for m in msgs}
+    entities = {dialog.entity.id: dialog.entity for dialog in dialogs}
+
+    client = FakeTelegramClient(me, dialogs, history)
+    socket_path = os.path.join(os.getcwd(), 'live.sock')
+    task = asyncio.create_task(daemon.run_daemon(client, 'bench', dtime(9, 0), dtime(18, 0), socket_path=socket_path,
+                                                 snapshot_interval=snapshot_interval))
+    while not os.path.exists(socket_path):
+        await asyncio.sleep(0.01)
+    backfill_calls = client.api_calls
+
+    started = time.perf_counter()
+    for key in arrived[cut:]:
+        await client.emit(by_key[key], entities[key[2]])
+    for key in arrived[cut:][::10]:
+        await client.emit(by_key[key], entities[key[2]])
+    per_event = (time.perf_counter() - started) / max(len(arrived) - cut, 1)
+
+    report = await query_daemon(socket_path)
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+    os.remove(socket_path)
+    return report, backfill_calls, per_event
+
+
+def bench_daemon(args):
+    # The last 24 hours, so every message is already in the past; the daemon keeps today's part.
+    # Timings and API calls only, test_daemon checks the statistics against a streaming report
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    me, dialogs, messages = make_workload(dms=args.dms, groups=args.groups, days=1, seed=args.seed,
+                                          start=now - timedelta(days=1))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            os.makedirs('stored_sessions')
+            with contextlib.redirect_stdout(io.StringIO()):
+                report, backfill_calls, per_event = asyncio.run(replay_day(me, dialogs, messages, args.live_share, 3600))
+                # A restart picks up the snapshot and fetches only dialogs changed since it was saved
+                _, restart_calls, _ = asyncio.run(replay_day(me, dialogs, messages, 0.0, 3600))
+        finally:
+            os.chdir(cwd)
+
+    print(f"{len(report['chats'])} chats, {args.live_share:.0%} of the day as events: "
+          f"{per_event * 1e6:.0f}us per event")
+    print(f"startup backfill: {backfill_calls} api calls, restart from snapshot: {restart_calls} api calls")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for stats_tracker against a fake Telegram client')
+    parser.add_argument('--dms', type=int, default=60)
+    parser.add_argument('--groups', type=int, default=6)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=0)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    concurrency = commands.add_parser('concurrency', help='sequential vs concurrent process_chats')
+    concurrency.add_argument('--latency', type=float, default=0.02, help='simulated seconds per API call')
+    concurrency.add_argument('--concurrency', type=int, nargs='+', default=[4, 8, 16])
+    concurrency.set_defaults(func=bench_concurrency)
+
+    fetch = commands.add_parser('fetch', help='API calls of id-bounded vs date-filtered fetching')
+    fetch.add_argument('--group-messages', type=int, default=5000)
+    fetch.set_defaults(func=bench_fetch)
+
+    split = commands.add_parser('split', help='a huge group fetched serially vs in concurrent id ranges')
+    split.add_argument('--latency', type=float, default=0.02, help='simulated seconds per API call')
+    split.add_argument('--group-messages', type=int, default=50000)
+    split.set_defaults(func=bench_split)
+
+    cache = commands.add_parser('cache', help='rolling report with and without the message cache')
+    cache.add_argument('--latency', type=float, default=0.02, help='simulated seconds per API call')
+    cache.set_defaults(func=bench_cache)
+
+    memory = commands.add_parser('memory', help='memory of Telethon messages vs compact records')
+    memory.add_argument('--count', type=int, default=1_000_000)
+    memory.set_defaults(func=bench_memory)
+
+    vectorized = commands.add_parser('vectorized', help='numpy engine against the per-message loop, timings')
+    vectorized.add_argument('--count', type=int, default=1_000_000)
+    vectorized.set_defaults(func=bench_vectorized)
+
+    models = commands.add_parser('models', help='reply models against calculate_time_spent, presets in one pass')
+    models.add_argument('--count', type=int, default=200_000)
+    models.set_defaults(func=bench_models)
+
+    media = commands.add_parser('media', help='media-aware accounting from message metadata only')
+    media.add_argument('--media-share', type=float, default=0.2)
+    media.set_defaults(func=bench_media)
+
+    groups = commands.add_parser('groups', help='indexed group analytics: threads, participants, reply attribution')
+    groups.add_argument('--count', type=int, default=400_000)
+    groups.set_defaults(func=bench_groups)
+
+    resume = commands.add_parser('resume', help='interrupted and resumed run against an uninterrupted one')
+    resume.set_defaults(func=bench_resume)
+
+    shards = commands.add_parser('shards', help='single process vs worker processes with their own clients')
+    shards.add_argument('--latency', type=float, default=0.02, help='simulated seconds per API call')
+    shards.add_argument('--shards', type=int, nargs='+', default=[2, 4])
+    shards.set_defaults(func=bench_shards)
+
+    offload = commands.add_parser('offload', help='fetching vs transcript/statistics stage overlap')
+    offload.add_argument('--latency', type=float, default=0.02, help='simulated seconds per API call')
+    offload.add_argument('--group-messages', type=int, default=20000)
+    offload.set_defaults(func=bench_offload)
+
+    partials = commands.add_parser('partials', help='date ranges from stored day partials vs full reports')
+    partials.add_argument('--ranges', type=int, default=10)
+    partials.set_defaults(func=bench_partials)
+
+    rolling = commands.add_parser('rolling', help='daily rolling reports rebuilt in full vs incrementally')
+    rolling.add_argument('--window', type=int, default=7)
+    rolling.add_argument('--runs', type=int, default=4)
+    rolling.add_argument('--dm-messages', type=int, default=1000)
+    rolling.add_argument('--group-messages', type=int, default=10000)
+    rolling.set_defaults(func=bench_rolling)
+
+    dialogs = commands.add_parser('dialogs', help='dialog enumeration with and without the dialog index')
+    dialogs.add_argument('--dialogs', type=int, default=5000)
+    dialogs.add_argument('--active', type=int, default=50, help='dialogs with new messages before the next run')
+    dialogs.set_defaults(func=bench_dialogs)
+
+    suite = commands.add_parser('suite', help='all hot paths on the standard workloads, results as JSON')
+    suite.add_argument('--workloads', nargs='+', choices=list(WORKLOADS))
+    suite.add_argument('--latency', type=float, default=0.0, help='simulated seconds per API call')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--output', help='write the results to this JSON file')
+    suite.add_argument('--compare', help='JSON file of an earlier run to compare against')
+    suite.add_argument('--threshold', type=float, default=0.2, help='slowdown reported as a regression')
+    suite.set_defaults(func=bench_suite)
+
+    live = commands.add_parser('daemon', help='live statistics from replayed NewMessage events')
+    live.add_argument('--live-share', type=float, default=0.5, help='part of the day delivered as events')
+    live.set_defaults(func=bench_daemon)
+
+    transcripts = commands.add_parser('transcripts', help='per-line vs buffered transcript writing')
+    transcripts.add_argument('--chats', type=int, default=2000)
+    transcripts.add_argument('--messages', type=int, default=200)
+    transcripts.set_defaults(func=bench_transcripts)
+
+    archive = commands.add_parser('archive', help='messages folder vs zip/tar archives from the writer stage')
+    archive.add_argument('--latency', type=float, default=0.02, help='simulated seconds per API call')
+    archive.add_argument('--write-delay', type=float, default=0.01, help='simulated seconds per written file')
+    archive.set_defaults(func=bench_archive)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
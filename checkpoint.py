@@ -0,0 +1,78 @@
+import os
+import json
+
+from aggregates import ReplyTimes
+
+JOURNAL_NAME = 'journal.jsonl'
+UNJOURNALED = ('message_columns',)  # per-message export rows, the caller derives them again on resume
+REPLY_TIMES = ('working_reply_times', 'night_reply_times')  # journaled as ReplyTimes, not one value per reply
+
+# The journal of a run lives in its output directory: a first line with the parameters of the
+# run, then one line per finished dialog (transcript written, statistics computed). A run with
+# the same parameters takes the finished dialogs from it instead of fetching them again; a run
+# that completes removes it.
+
+
+def open_journal(output_dir, params):
+    path = os.path.join(output_dir, JOURNAL_NAME)
+    done = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        if lines and json.loads(lines[0]) == {'params': params}:
+            for line in lines[1:]:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # the line being written when the run was interrupted
+                done[entry['peer_id']] = entry
+
+    # Written again without a possibly cut last line, so new entries append cleanly;
+    # renamed into place, an interruption now leaves the old journal
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'params': params}) + '\n')
+        for entry in done.values():
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    os.replace(path + '.tmp', path)
+    f = open(path, 'a', encoding='utf-8')
+    return {'path': path, 'file': f, 'done': done}
+
+
+def journaled_stats(stats):
+    # Only the per-chat numbers, the journal must not grow with the messages: the reply times of
+    # the chat and of its reply models become ReplyTimes sketches
+    stats = {key: value for key, value in stats.items() if key not in UNJOURNALED}
+    for key in REPLY_TIMES:
+        stats[key] = ReplyTimes(stats[key]).to_dict()
+    if 'models' in stats:
+        stats['models'] = {name: journaled_stats(model_stats) for name, model_stats in stats['models'].items()}
+    return stats
+
+
+def resumed_stats(stats):
+    stats = dict(stats)
+    for key in REPLY_TIMES:
+        stats[key] = ReplyTimes.from_dict(stats[key])
+    if 'models' in stats:
+        stats['models'] = {name: resumed_stats(model_stats) for name, model_stats in stats['models'].items()}
+    return stats
+
+
+def finished_dialog(journal, peer_id, transcript):
+    # Statistics of a dialog finished by an interrupted run, None if it has to be processed.
+    # The reply times are ReplyTimes, which add_chat_stats merges like the lists of a new dialog.
+    entry = journal['done'].get(peer_id)
+    if entry is None or not os.path.exists(transcript):
+        return None
+    return resumed_stats(entry['stats'])
+
+
+def record_dialog(journal, peer_id, stats):
+    journal['file'].write(json.dumps({'peer_id': peer_id, 'stats': journaled_stats(stats)}, ensure_ascii=False) + '\n')
+    journal['file'].flush()
+
+
+def close_journal(journal, completed):
+    journal['file'].close()
+    if completed:
+        os.remove(journal['path'])
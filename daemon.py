@@ -0,0 +1,225 @@
+import os
+import json
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+
+from telethon import events
+from telethon.utils import get_peer_id
+
+import stats_tracker
+from aggregates import ReplyTimes
+from message_record import record_from_message
+
+SNAPSHOT_INTERVAL = 60  # seconds between snapshots of the live statistics
+HTTP_HOST = '127.0.0.1'
+HTTP_PORT = 8765
+
+
+def snapshot_path(session_id):
+    return os.path.join('stored_sessions', f'live_{session_id}.json')
+
+
+def new_live_stats(work_start, work_end, day):
+    # Statistics of one UTC day, fed message by message. A new day starts from scratch,
+    # like a one-day report does.
+    return {
+        'day': day,
+        'since': datetime.now(timezone.utc),
+        'work_start': work_start,
+        'work_end': work_end,
+        'chats': {},  # peer id -> name, group flag, reply state, last message id
+    }
+
+
+def add_message(live, peer_id, name, group, record):
+    day = record.date.astimezone(timezone.utc).date()
+    if day < live['day']:
+        return
+    if day > live['day']:
+        live['day'] = day
+        live['since'] = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+        live['chats'] = {}
+
+    chat = live['chats'].get(peer_id)
+    if chat is None:
+        chat = live['chats'][peer_id] = {'name': name, 'group': group, 'state': stats_tracker.new_reply_state(group),
+                                         'last_id': 0}
+    # Events can repeat messages the backfill already saw; ids only grow within a chat
+    if record.id <= chat['last_id']:
+        return
+    chat['last_id'] = record.id
+    stats_tracker.update_reply_state(chat['state'], record, live['work_start'], live['work_end'])
+
+
+def reply_times_json(times):
+    return {'count': times.count, 'mean': times.mean(), 'p50': times.quantile(0.5), 'p90': times.quantile(0.9)}
+
+
+def live_report(live, name=''):
+    # Current statistics in the shape of the report summary, plus every chat
+    chat_totals, group_totals = stats_tracker.new_totals(), stats_tracker.new_totals()
+    chats = []
+    for peer_id, chat in live['chats'].items():
+        stats = stats_tracker.finish_reply_state(chat['state'])
+        stats_tracker.add_chat_stats(group_totals if chat['group'] else chat_totals, stats)
+        chats.append({
+            'peer_id': peer_id,
+            'name': chat['name'],
+            'group': chat['group'],
+            'typing_time': stats['typing_time'],
+            'reading_time': stats['reading_time'],
+            'incoming_messages': stats['incoming_messages'],
+            'outgoing_messages': stats['outgoing_messages'],
+            'incoming_symbols': stats['incoming_symbols'],
+            'outgoing_symbols': stats['outgoing_symbols'],
+            'average_working_reply': stats['average_working_reply'],
+            'average_night_reply': stats['average_night_reply'],
+            'messages_without_reply': stats['messages_without_reply'],
+        })
+
+    groups = sum(chat['group'] for chat in live['chats'].values())
+    summary = stats_tracker.make_summary(name, len(live['chats']) - groups, groups, chat_totals, group_totals)
+    summary = {key: reply_times_json(value) if isinstance(value, ReplyTimes) else value
+               for key, value in summary.items()}
+    return {'day': live['day'].isoformat(), 'since': live['since'].isoformat(), 'summary': summary, 'chats': chats}
+
+
+def state_to_json(state):
+    state = dict(state)
+    state['last_incoming_chat_datetimes'] = [dt.timestamp() for dt in state['last_incoming_chat_datetimes']]
+    if state['last_incoming_datetime'] is not None:
+        state['last_incoming_datetime'] = state['last_incoming_datetime'].timestamp()
+    return state
+
+
+def state_from_json(state):
+    state['last_incoming_chat_datetimes'] = deque(
+        [datetime.fromtimestamp(ts, timezone.utc) for ts in state['last_incoming_chat_datetimes']], maxlen=3)
+    if state['last_incoming_datetime'] is not None:
+        state['last_incoming_datetime'] = datetime.fromtimestamp(state['last_incoming_datetime'], timezone.utc)
+    return state
+
+
+def save_snapshot(live, path):
+    # Written next to the target and renamed, so a crash never leaves half a snapshot
+    data = {
+        'day': live['day'].isoformat(),
+        'since': live['since'].isoformat(),
+        'saved_at': datetime.now(timezone.utc).isoformat(),
+        'chats': [[peer_id, dict(chat, state=state_to_json(chat['state']))] for peer_id, chat in live['chats'].items()],
+    }
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+def load_snapshot(path, work_start, work_end, day):
+    # The live statistics of `day` saved by an earlier run, None if there are none
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if data['day'] != day.isoformat():
+        return None
+    live = new_live_stats(work_start, work_end, day)
+    live['since'] = datetime.fromisoformat(data['since'])
+    live['saved_at'] = datetime.fromisoformat(data['saved_at'])
+    for peer_id, chat in data['chats']:
+        chat['state'] = state_from_json(chat['state'])
+        live['chats'][peer_id] = chat
+    return live
+
+
+def reported_chat(chat, me):
+    # (name, group) for the dialogs process_chats reports on, None for the others
+    kind = stats_tracker.dialog_kind(chat)
+    if kind == 'user' and not chat.bot and chat.id != me.id and chat.id != 777000:
+        return f"{chat.first_name} {chat.last_name or ''}".strip(), False
+    if kind in ('chat', 'megagroup'):
+        return chat.title or '', True
+    return None
+
+
+async def backfill(client, live, me):
+    # Today's messages sent before the daemon started, fetched once. After a restart only the
+    # dialogs with messages since the snapshot are fetched, add_message skips what it already has.
+    changed_since = live.get('saved_at')
+    day_start = datetime.combine(live['day'], datetime.min.time())
+    async for dialog in client.iter_dialogs(offset_date=datetime.now()):
+        if dialog.date.astimezone(timezone.utc).date() < live['day']:
+            if dialog.pinned:
+                continue
+            break
+        chat = reported_chat(dialog.entity, me)
+        if chat is None or (changed_since is not None and dialog.date < changed_since):
+            continue
+        messages = await stats_tracker.fetch_messages(client, dialog.entity, day_start, day_start, dialog.date)
+        for record in sorted(messages, key=lambda m: m.id):
+            add_message(live, get_peer_id(dialog.entity), *chat, record)
+
+
+async def serve_request(live, name, reader, writer):
+    # GET / (or /stats) -> the summary and every chat as JSON
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        parts = request.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1] in ('/', '/stats'):
+            status, body = '200 OK', json.dumps(live_report(live, name), ensure_ascii=False)
+        else:
+            status, body = '404 Not Found', json.dumps({'error': 'GET / or /stats'})
+        body = body.encode('utf-8')
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def run_daemon(client, session_id, work_start, work_end, port=HTTP_PORT, socket_path=None,
+                     snapshot_interval=SNAPSHOT_INTERVAL):
+    # Stays connected and keeps today's statistics up to date from NewMessage events.
+    # Runs until cancelled (Ctrl+C); the last state is saved on the way out.
+    path = snapshot_path(session_id)
+    day = datetime.now(timezone.utc).date()
+    live = load_snapshot(path, work_start, work_end, day) or new_live_stats(work_start, work_end, day)
+
+    async with client:
+        me = await client.get_me()
+        name = f"{me.first_name} {me.last_name or ''}".strip()
+        pending = []
+
+        async def on_message(event):
+            chat = reported_chat(await event.get_chat(), me)
+            if chat is None:
+                return
+            item = (event.chat_id, *chat, record_from_message(event.message))
+            if pending is not None:
+                pending.append(item)
+            else:
+                add_message(live, *item)
+
+        # Registered before the backfill; what arrives meanwhile is applied after it
+        client.add_event_handler(on_message, events.NewMessage())
+        await backfill(client, live, me)
+        for item in pending:
+            add_message(live, *item)
+        pending = None
+
+        handler = lambda reader, writer: serve_request(live, name, reader, writer)
+        if socket_path:
+            server = await asyncio.start_unix_server(handler, socket_path)
+            print(f"Статистика: curl --unix-socket {socket_path} http://localhost/stats")
+        else:
+            server = await asyncio.start_server(handler, HTTP_HOST, port)
+            print(f"Статистика: http://{HTTP_HOST}:{port}/stats")
+
+        try:
+            async with server:
+                while True:
+                    await asyncio.sleep(snapshot_interval)
+                    save_snapshot(live, path)
+        finally:
+            save_snapshot(live, path)
@@ -0,0 +1,125 @@
+import os
+import csv
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency, exports fall back to CSV
+    pa = None
+
+ROW_GROUP_SIZE = 64_000  # rows buffered before they are written out
+
+# Raw numbers only: times in seconds, dates as unix seconds or ISO dates
+MESSAGE_COLUMNS = {
+    'chat_id': 'int64',
+    'message_id': 'int64',
+    'timestamp': 'timestamp',
+    'out': 'bool',
+    'symbols': 'int64',
+    'words': 'int64',
+    'reply_seconds': 'float64',  # outgoing messages that answered, empty otherwise
+    'reply_working': 'bool',
+    'media': 'string',  # message_record.media_info kind, empty for plain text
+    'media_seconds': 'float64',
+    'media_bytes': 'int64',
+    'forwarded': 'bool',
+}
+
+CHAT_COLUMNS = {
+    'account_id': 'int64',
+    'chat_id': 'int64',
+    'name': 'string',
+    'group': 'bool',
+    'date_from': 'string',
+    'date_to': 'string',
+    'incoming_messages': 'int64',
+    'outgoing_messages': 'int64',
+    'incoming_symbols': 'int64',
+    'outgoing_symbols': 'int64',
+    'typing_seconds': 'float64',
+    'reading_seconds': 'float64',
+    'working_replies': 'int64',
+    'working_reply_seconds': 'float64',
+    'night_replies': 'int64',
+    'night_reply_seconds': 'float64',
+    'messages_without_reply': 'int64',
+}
+
+
+def available_formats():
+    return ['csv', 'parquet'] if pa is not None else ['csv']
+
+
+def resolve_format(export_format):
+    # 'auto' is Parquet when pyarrow is installed, CSV otherwise
+    if export_format == 'auto':
+        return 'parquet' if pa is not None else 'csv'
+    if export_format == 'parquet' and pa is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    return export_format
+
+
+def arrow_type(name):
+    if name == 'timestamp':
+        return pa.timestamp('s', tz='UTC')
+    return {'int64': pa.int64(), 'float64': pa.float64(), 'bool': pa.bool_(), 'string': pa.string()}[name]
+
+
+class ColumnarWriter:
+    # Appends rows given as columns (dict of equal length lists) and writes them in row groups,
+    # so memory stays bounded by ROW_GROUP_SIZE whatever the size of the export
+    def __init__(self, path, columns, export_format='csv'):
+        self.path = path
+        self.columns = columns
+        self.format = export_format
+        self.buffer = {name: [] for name in columns}
+        self.rows = 0
+        if export_format == 'parquet':
+            schema = pa.schema([(name, arrow_type(kind)) for name, kind in columns.items()])
+            self.writer = pq.ParquetWriter(path, schema)
+        else:
+            self.file = open(path, 'w', encoding='utf-8', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(columns)
+
+    def add(self, columns):
+        for name in self.columns:
+            self.buffer[name].extend(columns[name])
+        if len(self.buffer['chat_id']) >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        count = len(self.buffer['chat_id'])
+        if not count:
+            return
+        if self.format == 'parquet':
+            table = pa.table({name: pa.array(values, type=arrow_type(self.columns[name]))
+                              for name, values in self.buffer.items()})
+            self.writer.write_table(table)
+        else:
+            self.writer.writerows(zip(*self.buffer.values()))
+        self.rows += count
+        self.buffer = {name: [] for name in self.columns}
+
+    def close(self):
+        self.flush()
+        if self.format == 'parquet':
+            self.writer.close()
+        else:
+            self.file.close()
+
+
+def open_export(directory, prefix, export_format='auto'):
+    # Per-message and per-chat writers: <prefix>_messages.<ext> and <prefix>_chats.<ext>
+    export_format = resolve_format(export_format)
+    extension = 'parquet' if export_format == 'parquet' else 'csv'
+    return {
+        'messages': ColumnarWriter(os.path.join(directory, f'{prefix}_messages.{extension}'), MESSAGE_COLUMNS,
+                                   export_format),
+        'chats': ColumnarWriter(os.path.join(directory, f'{prefix}_chats.{extension}'), CHAT_COLUMNS, export_format),
+    }
+
+
+def close_export(writers):
+    for writer in writers.values():
+        writer.close()
@@ -0,0 +1,250 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import (User, Chat, Channel, Message, PeerUser, PeerChat, PeerChannel, MessageMediaDocument,
+                               MessageMediaPhoto, MessageFwdHeader, Document, Photo, PhotoSize, DocumentAttributeAudio,
+                               DocumentAttributeVideo, DocumentAttributeSticker, InputStickerSetEmpty,
+                               MessageReplyHeader)
+
+PAGE_SIZE = 100
+
+WORDS = ['привет', 'да', 'нет', 'когда', 'сделаю', 'отправил', 'спасибо', 'ок', 'созвон', 'завтра',
+         'проверь', 'готово', 'вопрос', 'задача', 'файл', 'сегодня', 'понял', 'хорошо']
+
+
+class FakeDialog:
+    def __init__(self, entity, date, pinned=False):
+        self.entity = entity
+        self.date = date
+        self.pinned = pinned
+
+
+class FakeEvent:
+    # What daemon.py uses of a NewMessage event
+    def __init__(self, message, chat):
+        self.message = message
+        self.chat_id = message.chat_id
+        self.chat = chat
+
+    async def get_chat(self):
+        return self.chat
+
+
+class FakeTelegramClient:
+    # Minimal stand-in for TelegramClient: every page of results costs one
+    # "API call" with a configurable latency, so fetch strategies can be compared offline.
+
+    def __init__(self, me, dialogs, messages, latency=0.0, page_size=PAGE_SIZE, flood_waits=0, pause_scale=0.0):
+        self.me = me
+        self.dialogs = dialogs
+        self.messages = messages  # peer id -> list of Message, ascending by id
+        self.latency = latency
+        self.page_size = page_size
+        self.flood_waits = flood_waits
+        self.pause_scale = pause_scale
+        self.api_calls = 0
+        self.paused = 0.0  # seconds Telethon would sleep between history pages
+        self.handlers = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def _request(self, history=False):
+        self.api_calls += 1
+        if history and self.flood_waits:
+            self.flood_waits -= 1
+            raise FloodWaitError(request=None, capture=0)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append(callback)
+
+    async def emit(self, message, chat):
+        # Delivers a new message to the event handlers, like an update from Telegram
+        self.messages.setdefault(chat.id, []).append(message)
+        for callback in self.handlers:
+            await callback(FakeEvent(message, chat))
+
+    async def get_me(self):
+        await self._request()
+        return self.me
+
+    async def iter_dialogs(self, offset_date=None, limit=None):
+        dialogs = sorted(self.dialogs, key=lambda d: (not d.pinned, -d.date.timestamp()))
+        for i in range(0, len(dialogs), self.page_size):
+            await self._request()
+            for dialog in dialogs[i:i + self.page_size]:
+                yield dialog
+
+    async def iter_messages(self, entity, limit=None, offset_date=None, offset_id=0, max_id=0, min_id=0,
+                            reverse=False, wait_time=None):
+        # Mirrors Telethon: offset_date/offset_id go to the server, min_id/max_id are
+        # checked locally and iteration stops on the first message outside of them.
+        history = self.messages.get(entity.id, [])
+        if offset_date is not None and offset_date.tzinfo is None:
+            offset_date = offset_date.replace(tzinfo=timezone.utc)
+        left = float('inf') if limit is None else limit
+        if wait_time is None:
+            wait_time = 1 if left > 3000 else 0
+
+        if reverse:
+            offset_id = max(offset_id, min_id)
+            candidates = [m for m in history if m.id > offset_id
+                          and (offset_date is None or m.date >= offset_date)]
+        else:
+            offset_id = max(offset_id, max_id)
+            candidates = [m for m in history[::-1] if (not offset_id or m.id < offset_id)
+                          and (offset_date is None or m.date < offset_date)]
+
+        position = 0
+        while left > 0:
+            if position and wait_time:
+                self.paused += wait_time
+                if self.pause_scale:
+                    await asyncio.sleep(wait_time * self.pause_scale)
+            chunk = int(min(left, self.page_size))
+            await self._request(history=True)
+            page = candidates[position:position + chunk]
+            position += chunk
+            for message in page:
+                if reverse and max_id and message.id >= max_id:
+                    return
+                if not reverse and min_id and message.id <= min_id:
+                    return
+                yield message
+                left -= 1
+            if len(page) < chunk:
+                return
+
+
+def make_message(msg_id, peer, date, text, out, sender_id=None, media=None, forwarded=False):
+    message = Message(id=msg_id, peer_id=peer, date=date, message=text, out=out,
+                      from_id=PeerUser(sender_id) if sender_id else None, media=media,
+                      fwd_from=MessageFwdHeader(date=date) if forwarded else None)
+    message.text = text
+    return message
+
+
+def make_media(rng, date):
+    # Metadata only, like what Telegram sends with a history page
+    kind = rng.choice(['voice', 'voice', 'video_note', 'photo', 'photo', 'sticker'])
+    if kind == 'photo':
+        return MessageMediaPhoto(photo=Photo(id=rng.getrandbits(62), access_hash=0, file_reference=b'', date=date,
+                                             sizes=[PhotoSize(type='y', w=1280, h=960, size=rng.randint(50, 400) * 1024)],
+                                             dc_id=2))
+    if kind == 'sticker':
+        attributes, mime_type = [DocumentAttributeSticker(alt='', stickerset=InputStickerSetEmpty())], 'image/webp'
+    elif kind == 'voice':
+        attributes, mime_type = [DocumentAttributeAudio(duration=rng.randint(2, 120), voice=True)], 'audio/ogg'
+    else:
+        attributes = [DocumentAttributeVideo(duration=rng.randint(2, 60), w=384, h=384, round_message=True)]
+        mime_type = 'video/mp4'
+    return MessageMediaDocument(document=Document(id=rng.getrandbits(62), access_hash=0, file_reference=b'',
+                                                  date=date, mime_type=mime_type, size=rng.randint(10, 900) * 1024,
+                                                  dc_id=2, attributes=attributes))
+
+
+def make_conversation(rng, peer, start, days, count, group=False, me_id=1, long_share=0.0, media_share=0.0):
+    # Alternating bursts of incoming and outgoing messages spread over `days` days;
+    # long_share of them are long multi-line texts, media_share voice notes, photos, stickers
+    # and forwards
+    messages = []
+    span = days * 86400
+    seconds = sorted(rng.randrange(span) for _ in range(count))
+    out = False
+    for second in seconds:
+        if rng.random() < 0.4:
+            out = not out
+        words = rng.choices(WORDS, k=rng.randint(1, 12))
+        text = ' '.join(words)
+        if rng.random() < 0.05:
+            text += '\n' + ' '.join(rng.choices(WORDS, k=5))
+        if long_share and rng.random() < long_share:
+            text = '\n'.join(' '.join(rng.choices(WORDS, k=rng.randint(5, 20))) for _ in range(rng.randint(5, 40)))
+        if rng.random() < 0.05:
+            text = ''
+        sender = me_id if out else (rng.randint(1000, 1010) if group else peer_user_id(peer))
+        date = start + timedelta(seconds=second)
+        media, forwarded = None, False
+        if media_share and rng.random() < media_share:
+            forwarded = rng.random() < 0.2
+            if not forwarded or rng.random() < 0.5:
+                media, text = make_media(rng, date), ''
+        messages.append(make_message(0, peer, date, text, out, sender, media, forwarded))
+    return messages
+
+
+def peer_user_id(peer):
+    return getattr(peer, 'user_id', None)
+
+
+def make_workload(dms=50, groups=5, dm_messages=200, group_messages=2000, days=7, seed=0,
+                  start=datetime(2024, 3, 4, tzinfo=timezone.utc), long_share=0.0, media_share=0.0, reply_share=0.0,
+                  mention_share=0.0):
+    # Builds (me, dialogs, messages) for FakeTelegramClient. Like in Telegram, private chats
+    # and basic groups share one id sequence per account, megagroups have their own.
+    # In groups reply_share of the messages reply to a recent one, mention_share of the incoming
+    # ones mention me.
+    rng = random.Random(seed)
+    me = User(id=1, first_name='Bench', last_name=None)
+    counter = [0]
+
+    def next_id():
+        counter[0] += 1
+        return counter[0]
+
+    conversations = []
+    for i in range(dms):
+        entity = User(id=10_000 + i, first_name=f'User{i}', last_name='Test' if i % 2 else None, bot=False)
+        conversations.append((entity, PeerUser(entity.id), dm_messages, False))
+    for i in range(groups):
+        if i % 2:
+            entity = Chat(id=20_000 + i, title=f'Group {i}', photo=None, participants_count=10,
+                          date=start, version=1)
+            peer = PeerChat(entity.id)
+        else:
+            entity = Channel(id=30_000 + i, title=f'Mega {i}', photo=None, date=start, megagroup=True)
+            peer = PeerChannel(entity.id)
+        conversations.append((entity, peer, group_messages, True))
+
+    # Generate all messages first, then assign ids in global date order
+    pending = []
+    for entity, peer, count, group in conversations:
+        for message in make_conversation(rng, peer, start, days, count, group, me.id, long_share, media_share):
+            pending.append((entity.id, message))
+    pending.sort(key=lambda item: item[1].date)
+
+    messages = {}
+    for peer_id, message in pending:
+        history = messages.setdefault(peer_id, [])
+        if isinstance(message.peer_id, PeerChannel):
+            message.id = len(history) + 1
+        else:
+            message.id = next_id()
+        history.append(message)
+
+    if reply_share or mention_share:
+        for entity, _, _, group in conversations:
+            history = messages.get(entity.id, []) if group else []
+            for i, message in enumerate(history):
+                if i and rng.random() < reply_share:
+                    target = history[rng.randrange(max(0, i - 30), i)]
+                    message.reply_to = MessageReplyHeader(reply_to_msg_id=target.id)
+                    # Telegram marks replies to my messages as mentions
+                    message.mentioned = bool(target.out and not message.out)
+                if not message.out and rng.random() < mention_share:
+                    message.mentioned = True
+
+    dialogs = []
+    for entity, _, _, _ in conversations:
+        history = messages.get(entity.id)
+        last_date = history[-1].date if history else start
+        dialogs.append(FakeDialog(entity, last_date))
+
+    return me, dialogs, messages
@@ -0,0 +1,97 @@
+ATTRIBUTIONS = ['reply', 'mention', 'last']
+
+# Groups as threads and participants instead of one stream of incoming messages. Every message
+# is indexed by id once (sender, time, thread), so a reply finds the message it answers with a
+# dict lookup and a range of any size is a single pass.
+#
+# My message answers, in this order:
+#   'reply'    the incoming message it replies to (reply_to), when it is in the range
+#   'mention'  the oldest incoming message that mentions me and has no answer yet
+#              (Telegram marks replies to my messages as mentions too)
+#   'last'     the last incoming message, only for my first message after it, like calculate_time_spent
+# and the reply latency is the time since that message.
+# A thread is a message with every reply to it, to its replies and so on; replies to messages
+# before the range join the thread of that message.
+
+
+def new_participant():
+    return {'messages': 0, 'symbols': 0, 'mentions': 0, 'replies_to_me': 0, 'their_reply_seconds': 0.0,
+            'my_replies': 0, 'my_reply_seconds': 0.0, 'unanswered': 0}
+
+
+def analyze_group(messages):
+    index = {}  # message id -> (sender id, unix time, thread id, out)
+    threads = {}  # thread id -> [messages, my messages]
+    participants = {}  # sender id -> new_participant()
+    waiting = {}  # id -> sender of the messages that mention me, without an answer; oldest first
+    attributed = dict.fromkeys(ATTRIBUTIONS, 0)
+    my_replies, my_reply_seconds = 0, 0.0
+    thread_replies, thread_reply_seconds = 0, 0.0
+    last_incoming = None
+
+    for msg in sorted(messages, key=lambda m: (m.date, m.id)):
+        if msg.media_info and msg.media_info[0] == 'service':
+            continue
+        ts = msg.date.timestamp()
+        target = index.get(msg.reply_to) if msg.reply_to else None
+        thread_id = target[2] if target else msg.reply_to or msg.id
+        index[msg.id] = (msg.sender_id, ts, thread_id, msg.out)
+        thread = threads.get(thread_id)
+        if thread is None:
+            thread = threads[thread_id] = [0, 0]
+        thread[0] += 1
+        if target:
+            thread_replies += 1
+            thread_reply_seconds += ts - target[1]
+
+        if not msg.out:
+            participant = participants.get(msg.sender_id)
+            if participant is None:
+                participant = participants[msg.sender_id] = new_participant()
+            participant['messages'] += 1
+            participant['symbols'] += len(msg.text or '')
+            if msg.mentioned:
+                participant['mentions'] += 1
+                waiting[msg.id] = msg.sender_id
+            if target and target[3]:
+                participant['replies_to_me'] += 1
+                participant['their_reply_seconds'] += ts - target[1]
+            last_incoming = msg.id
+            continue
+
+        thread[1] += 1
+        if target and not target[3]:
+            answered, how = msg.reply_to, 'reply'
+        elif waiting:
+            answered, how = next(iter(waiting)), 'mention'
+        elif last_incoming is not None:
+            answered, how = last_incoming, 'last'
+        else:
+            continue
+        last_incoming = None
+        waiting.pop(answered, None)
+        sender, sent, _, _ = index[answered]
+        participant = participants[sender]
+        participant['my_replies'] += 1
+        participant['my_reply_seconds'] += ts - sent
+        attributed[how] += 1
+        my_replies += 1
+        my_reply_seconds += ts - sent
+
+    for sender in waiting.values():
+        participants[sender]['unanswered'] += 1
+    # the busiest participants first; a list, so the statistics survive the JSON journal as they are
+    participants = [dict(participant, sender_id=sender) for sender, participant in
+                    sorted(participants.items(), key=lambda item: (-item[1]['messages'], -item[1]['my_replies']))]
+    return {
+        'messages': len(index),
+        'participants': participants,
+        'threads': sum(1 for count, _ in threads.values() if count > 1),
+        'my_threads': sum(1 for count, mine in threads.values() if count > 1 and mine),
+        'thread_replies': thread_replies,
+        'thread_reply_seconds': thread_reply_seconds,
+        'my_replies': my_replies,
+        'my_reply_seconds': my_reply_seconds,
+        'attributed': attributed,
+        'unanswered_mentions': len(waiting),
+    }
@@ -0,0 +1,104 @@
+import os
+import csv
+import json
+import cProfile
+import tracemalloc
+import contextvars
+from time import perf_counter
+
+# Enabled by process_chats arguments or, for runs started from the menu, by the environment:
+# STATS_TRACE=trace.json (or .csv), STATS_TRACE_TOP=10, STATS_PROFILE=run.prof, STATS_TRACEMALLOC=1
+TRACE_ENV = 'STATS_TRACE'
+TRACE_TOP_ENV = 'STATS_TRACE_TOP'
+PROFILE_ENV = 'STATS_PROFILE'
+TRACEMALLOC_ENV = 'STATS_TRACEMALLOC'
+TRACE_TOP = 10
+
+TRACE_FIELDS = ['dialog', 'group', 'seconds', 'fetch_seconds', 'flood_wait', 'requests', 'fetched', 'text_bytes',
+                'messages', 'save_seconds', 'stats_cpu_seconds']
+
+# Trace of the dialog handled by the current asyncio task, None when tracing is off
+DIALOG_TRACE = contextvars.ContextVar('dialog_trace', default=None)
+
+
+def trace_path(path=None):
+    return path or os.environ.get(TRACE_ENV)
+
+
+def new_dialog_trace(name, group=False):
+    trace = {field: 0 for field in TRACE_FIELDS}
+    trace.update({'dialog': name, 'group': group, 'started': perf_counter()})
+    return trace
+
+
+def finish_dialog_trace(trace):
+    trace['seconds'] = perf_counter() - trace.pop('started')
+
+
+async def traced_history(messages, page_size):
+    # Counts what iter_messages pulls for the current dialog. Requests are estimated from the
+    # page size, text_bytes is the UTF-8 size of the message texts, not of the TL responses.
+    trace = DIALOG_TRACE.get()
+    trace['requests'] += 1
+    count = 0
+    async for message in messages:
+        if count and count % page_size == 0:
+            trace['requests'] += 1
+        count += 1
+        trace['fetched'] += 1
+        trace['text_bytes'] += len((message.message or '').encode('utf-8'))
+        yield message
+
+
+def add_flood_wait(seconds):
+    trace = DIALOG_TRACE.get()
+    if trace is not None:
+        trace['flood_wait'] += seconds
+
+
+def write_trace(traces, path):
+    if path.endswith('.csv'):
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=TRACE_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(traces)
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(traces, f, ensure_ascii=False, indent=1)
+
+
+def print_slowest(traces, top=None):
+    top = top or int(os.environ.get(TRACE_TOP_ENV, TRACE_TOP))
+    print(f"\n=== Самые медленные диалоги (топ {top}) ===")
+    for trace in sorted(traces, key=lambda t: t['seconds'], reverse=True)[:top]:
+        print(f"{trace['seconds']:8.2f}с  {trace['dialog']}: сообщений {trace['messages']}, "
+              f"запросов {trace['requests']}, загрузка {trace['fetch_seconds']:.2f}с, "
+              f"FloodWait {trace['flood_wait']:.0f}с, запись {trace['save_seconds']:.2f}с, "
+              f"подсчёт {trace['stats_cpu_seconds']:.2f}с")
+
+
+def start_profiling(profile=None, trace_memory=False):
+    # cProfile and/or tracemalloc around a run; returns the handle for stop_profiling
+    profile = profile or os.environ.get(PROFILE_ENV)
+    trace_memory = trace_memory or os.environ.get(TRACEMALLOC_ENV) == '1'
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if trace_memory:
+        tracemalloc.start()
+    return {'path': profile, 'profiler': profiler, 'trace_memory': trace_memory}
+
+
+def stop_profiling(handle, top=10):
+    if handle['profiler'] is not None:
+        handle['profiler'].disable()
+        handle['profiler'].dump_stats(handle['path'])
+        print(f"\nПрофиль сохранён в {handle['path']} (python -m pstats {handle['path']})")
+    if handle['trace_memory']:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"\n=== Память: пик {peak / 2 ** 20:.1f} МБ ===")
+        for stat in snapshot.statistics('lineno')[:top]:
+            print(stat)
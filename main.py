@@ -1,56 +1,105 @@
-from datetime import datetime, time
+from datetime import datetime, time, timezone
 
 import os
-import json
+import sys
 import re
 import asyncio
-from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError
+import argparse
+import functools
 
-import stats_tracker
+import message_cache
+import output_writer
+import reply_models
+import session_store
 
-CONFIG_PATH = 'stored_sessions/sessions.json'
+# Telethon (and stats_tracker, which needs it) are imported where a client is actually used,
+# so --help and argument errors return without loading them
+
+SESSIONS_DIR = 'stored_sessions'
+BATCH_PER_API_LIMIT = 2
+
+# The account store is opened once per process. Clients stay connected between reports
+# (see connected_client) and are disconnected when the program exits.
+STORE = None
+CLIENTS = {}  # session id -> connected, authorized client
+
+
+def telegram_client(session_file, api_id, api_hash):
+    from telethon import TelegramClient
+    return TelegramClient(session_file, int(api_id), api_hash)
+
+
+def shard_client(session_string, api_id, api_hash):
+    # Client of a shard worker process: the coordinator's login, without sharing its session file
+    from telethon.sessions import StringSession
+    return telegram_client(StringSession(session_string), api_id, api_hash)
+
+
+def sessions_store():
+    global STORE
+    if STORE is None:
+        STORE = session_store.open_store()
+    return STORE
 
 
 def load_sessions():
-    if not os.path.exists(CONFIG_PATH):
-        with open(CONFIG_PATH, 'w') as f:
-            json.dump({"sessions": {}}, f, indent=4)
-    with open(CONFIG_PATH, 'r') as f:
-        data = json.load(f)
-    return data.get('sessions', {})
+    return session_store.load_sessions(sessions_store())
 
 
-def save_sessions(sessions):
-    with open(CONFIG_PATH, 'w') as f:
-        json.dump({"sessions": sessions}, f, indent=4)
+def get_session(session_id):
+    return session_store.get_session(sessions_store(), session_id)
 
 
 def add_session_to_config(session_id, api_id, api_hash, phone, name, last_name):
     if last_name is None:
         last_name = ''
-    sessions = load_sessions()
-    sessions[session_id] = {
+    session_store.put_session(sessions_store(), session_id, {
         "api_id": api_id,
         "api_hash": api_hash,
         "phone": phone,
         "name": name,
         "last_name": last_name
-    }
-    save_sessions(sessions)
+    })
     print(f"Акаунт '{session_id} {name} {last_name}' добавлен")
 
 
 def remove_session_from_config(session_id):
-    sessions = load_sessions()
-    if session_id in sessions:
-        del sessions[session_id]
-        save_sessions(sessions)
+    if session_store.delete_session(sessions_store(), session_id):
         print(f"Акаунт '{session_id}' удален.")
     else:
         print(f"Акаунт '{session_id}' не найден.")
 
 
+async def connected_client(session_id, config, interactive=True):
+    # The account's client from the pool, connected on first use. interactive: log in again
+    # (asks for the code) if the session is no longer authorized, otherwise None is returned.
+    client = CLIENTS.get(session_id)
+    if client is not None and client.is_connected():
+        return client
+    client = telegram_client(os.path.join(SESSIONS_DIR, f"{session_id}.session"), config['api_id'],
+                             config['api_hash'])
+    if interactive:
+        await client.start()
+    else:
+        await client.connect()
+        if not await client.is_user_authorized():
+            await client.disconnect()
+            return None
+    CLIENTS[session_id] = client
+    return client
+
+
+async def disconnect_client(session_id):
+    client = CLIENTS.pop(session_id, None)
+    if client is not None:
+        await client.disconnect()
+
+
+async def close_clients():
+    for session_id in list(CLIENTS):
+        await disconnect_client(session_id)
+
+
 def ensure_session_directory(directory='stored_sessions'):
     if not os.path.exists(directory):
         os.makedirs(directory)
@@ -62,27 +111,21 @@ def sanitize_phone(phone):
     return sanitized
 
 
-def list_sessions(directory='stored_sessions'):
-    sessions = []
-    for file in os.listdir(directory):
-        if file.endswith('.session'):
-            session_name = os.path.splitext(file)[0]
-            sessions.append(session_name)
-    return sessions
-
 def display_menu():
     print("\n=== Анализатор статистики чатов ===")
     print("1. Выбрать из ранее добавленых")
     print("2. Добавить новый акаунт")
     print("3. Удалить акаунт")
-    print("4. Выход")
-    choice = input("Выберите действие (1-4): ").strip()
+    print("4. Статистика по всем акаунтам")
+    print("5. Выход")
+    choice = input("Выберите действие (1-5): ").strip()
     return choice
 
 
 async def login(session_file, api_id, api_hash, phone):
+    from telethon.errors import SessionPasswordNeededError
+    client = telegram_client(session_file, api_id, api_hash)
     try:
-        client = TelegramClient(session_file, api_id, api_hash)
         await client.connect()
         if not await client.is_user_authorized():
             await client.send_code_request(phone)
@@ -96,57 +139,70 @@ async def login(session_file, api_id, api_hash, phone):
         me = await client.get_me()
         print(f'Акаунт: {me.first_name} ({me.username})')
 
-        await client.disconnect()
-
+        # stays connected, the first report of the account reuses it
         return client, me.first_name, me.last_name
 
     except Exception as e:
         print(f"Ошибка во время входа: {e}")
+        await client.disconnect()
         if os.path.exists(session_file):
             os.remove(session_file)
-    finally:
-        await client.disconnect()
+
+
+async def add_session(phone, api_id, api_hash, directory='stored_sessions'):
+    # Logs in (the code and 2FA password are still asked for) and saves the account;
+    # returns the session id, None if it failed
+    if not str(api_id).isdigit():
+        print("Неверный API ID. Пожалуйста, введите целое число.")
+        return None
+
+    session_id = sanitize_phone(phone)
+    session_file = os.path.join(directory, f"{session_id}.session")
+    await disconnect_client(session_id)
+    result = await login(session_file, int(api_id), api_hash, phone)
+    if not result:
+        return None
+
+    client, name, last_name = result
+    CLIENTS[session_id] = client
+    add_session_to_config(session_id, api_id, api_hash, phone, name, last_name)
+    return session_id
 
 
 async def add_new_session(directory='stored_sessions'):
     phone = input("\nВведите номер телефона (полный, напр.: +380991234567): ").strip()
-    session_file = os.path.join(directory, f"{sanitize_phone(phone)}.session")
-
     api_id = input("Введите Telegram API ID: ").strip()
     api_hash = input("Введите Telegram API Hash: ").strip()
 
-    if not api_id.isdigit():
-        print("Неверный API ID. Пожалуйста, введите целое число.")
-        return
+    session_id = await add_session(phone, api_id, api_hash, directory)
+    if session_id:
+        await dump_menu(session_id)
 
-    session, name, last_name = await login(session_file, int(api_id), api_hash, phone)
 
-    if session:
-        add_session_to_config(sanitize_phone(phone), api_id, api_hash, phone, name, last_name)
-        await dump_menu(session)
+async def remove_session(session_id, directory='stored_sessions'):
+    await disconnect_client(session_id)
+    session_file = os.path.join(directory, f"{session_id}.session")
+    if os.path.exists(session_file):
+        os.remove(session_file)
 
+    remove_session_from_config(session_id)
+    message_cache.forget_session(session_id)
 
-def remove_existing_session(directory='stored_sessions'):
-    sessions = list_sessions(directory)
-    if not sessions:
+
+async def remove_existing_session(directory='stored_sessions'):
+    session_data = load_sessions()
+    if not session_data:
         print("\nСписок пуст")
         return
 
-    session_data = load_sessions()
     print("\n=== Удаление акаунта ===")
     for idx, session in enumerate(session_data.values(), start=1):
         print(f"{idx}. {session['phone']} {session['name']} {session['last_name']}")
 
     try:
         choice = int(input("Выберите акаунт по номеру телефона: ").strip())
-        if 1 <= choice <= len(sessions):
-            session_id = list(session_data.keys())[choice - 1]
-            session_file = os.path.join(directory, f"{session_id}.session")
-
-            if os.path.exists(session_file):
-                os.remove(session_file)
-
-            remove_session_from_config(session_id)
+        if 1 <= choice <= len(session_data):
+            await remove_session(list(session_data.keys())[choice - 1], directory)
         else:
             print("Неверный выбор. Пожалуйста, выберите существующий акаунт.")
     except ValueError:
@@ -154,29 +210,20 @@ def remove_existing_session(directory='stored_sessions'):
 
 
 async def select_from_saved_sessions():
-    sessions = list_sessions()
-    if not sessions:
+    session_data = load_sessions()
+    if not session_data:
         print("\nСписок пуст")
         return
 
-    session_data = load_sessions()
     print("\n=== Выбор акаунта ===")
     for idx, session in enumerate(session_data.values(), start=1):
         print(f"{idx}.  {session['phone']} {session['name']} {session['last_name']}")
 
-    session_menu_selector = f"1-{len(sessions)}" if len(sessions) >= 2 else "1"
+    session_menu_selector = f"1-{len(session_data)}" if len(session_data) >= 2 else "1"
     try:
         choice = int(input(f"Выберите акаунт ({session_menu_selector}): ").strip())
-        if 1 <= choice <= len(sessions):
-            session_id = list(session_data.keys())[choice - 1]
-            session_file = os.path.join('stored_sessions', f"{session_id}.session")
-
-            config_loaded = load_sessions()
-            api_id = config_loaded[session_id]['api_id']
-            api_hash = config_loaded[session_id]['api_hash']
-
-            session = TelegramClient(session_file, api_id, api_hash)
-            await dump_menu(session)
+        if 1 <= choice <= len(session_data):
+            await dump_menu(list(session_data.keys())[choice - 1])
         else:
             print("Неверный выбор. Пожалуйста, выберите существующий акаунт.")
     except ValueError:
@@ -188,22 +235,55 @@ async def select_from_saved_sessions():
 # =======================
 
 
-async def dump_menu(session):
+def parse_date_range(date_input):
+    if '-' not in date_input:
+        date_start = date_end = datetime.strptime(date_input.strip(), "%d.%m.%Y").date()
+    else:
+        date_start, date_end = date_input.split('-')
+        date_start = datetime.strptime(date_start.strip(), "%d.%m.%Y").date()
+        date_end = datetime.strptime(date_end.strip(), "%d.%m.%Y").date()
+
+    if date_end < date_start:
+        raise ValueError("Дата окончания должна быть позже даты начала.")
+    return date_start, date_end
+
+
+def parse_working_hours(time_input):
+    parts = time_input.split('-')
+    if len(parts) != 2:
+        raise ValueError("Input must contain exactly one '-' separator.")
+
+    start_str, end_str = parts[0].strip(), parts[1].strip()
+    time_format = "%H:%M"
+    start_dt = datetime.strptime(start_str, time_format)
+    start_time = start_dt.time()
+
+    end_dt = datetime.strptime(end_str, time_format)
+    end_time = end_dt.time()
+
+    if (end_time.hour, end_time.minute) <= (start_time.hour, start_time.minute):
+        raise ValueError("Время окончания должно быть позже времени начала.")
+    return start_time, end_time
+
+
+def parse_shift_hours(time_input):
+    # Like parse_working_hours, but the end may be earlier: a shift across midnight
+    start_str, end_str = time_input.split('-')
+    start_time = datetime.strptime(start_str.strip(), "%H:%M").time()
+    end_time = datetime.strptime(end_str.strip(), "%H:%M").time()
+    if end_time == start_time:
+        raise ValueError("Время окончания совпадает со временем начала.")
+    return start_time, end_time
+
+
+async def dump_menu(session_id):
     print("\n=== Получение статистики ===")
 
     while True:
         date_input = input("Введите дату по которой нужно получить статистику (ДД.ММ.ГГГГ)\n"
                            "или диапазон дат (ДД.ММ.ГГГГ - ДД.ММ.ГГГГ): ")
         try:
-            if '-' not in date_input:
-                date_start = date_end = datetime.strptime(date_input, "%d.%m.%Y").date()
-            else:
-                date_start, date_end = date_input.split('-')
-                date_start = datetime.strptime(date_start.strip(), "%d.%m.%Y").date()
-                date_end = datetime.strptime(date_end.strip(), "%d.%m.%Y").date()
-
-            if date_end < date_start:
-                raise ValueError("Дата окончания должна быть позже даты начала.")
+            date_start, date_end = parse_date_range(date_input)
         except ValueError:
             print("Неверный формат даты или дата окончание раньше даты начала. Повторите")
         else:
@@ -212,37 +292,298 @@ async def dump_menu(session):
     while True:
         time_input = input("Введите рабочие часы (чч:мм - чч:мм): ").strip()
         try:
-            parts = time_input.split('-')
-            if len(parts) != 2:
-                raise ValueError("Input must contain exactly one '-' separator.")
+            start_time, end_time = parse_working_hours(time_input)
+        except ValueError as ve:
+            print(f"Неверный формат времени: {ve}. Повтор")
+        else:
+            break
 
-            start_str, end_str = parts[0].strip(), parts[1].strip()
-            time_format = "%H:%M"
-            start_dt = datetime.strptime(start_str, time_format)
-            start_time = start_dt.time()
+    await run_report(session_id, date_start, date_end, start_time, end_time)
 
-            end_dt = datetime.strptime(end_str, time_format)
-            end_time = end_dt.time()
 
-            if (end_time.hour, end_time.minute) <= (start_time.hour, start_time.minute):
-                raise ValueError("Время окончания должно быть позже времени начала.")
+async def run_report(session_id, date_start, date_end, start_time, end_time, **options):
+    # Report of one saved account; options go to stats_tracker.process_chats.
+    # Returns the summary, None if the account is unknown.
+    import stats_tracker
 
+    config = get_session(session_id)
+    if config is None:
+        print(f"Акаунт '{session_id}' не найден.")
+        return None
+
+    cache = message_cache.open_cache()
+    try:
+        client = await connected_client(session_id, config)
+        if options.get('shards'):
+            from telethon.sessions import StringSession
+            options['make_client'] = functools.partial(shard_client, StringSession.save(client.session),
+                                                       config['api_id'], config['api_hash'])
+        return await stats_tracker.process_chats(client, date_start, date_end, start_time, end_time,
+                                                 cache=cache, session_id=session_id, **options)
+    finally:
+        cache.close()
+
+
+# =======================
+# Batch mode
+# =======================
+
+
+async def run_account_report(session_id, config, date_start, date_end, start_time, end_time, limit, cache,
+                             output_root):
+    import stats_tracker
+
+    session_file = os.path.join('stored_sessions', f"{session_id}.session")
+    if not os.path.exists(session_file):
+        print(f"Акаунт '{session_id}': нет файла сессии, пропускаю")
+        return None
+
+    async with limit:
+        try:
+            client = await connected_client(session_id, config, interactive=False)
+            if client is None:
+                print(f"Акаунт '{session_id}' не авторизован, пропускаю")
+                return None
+
+            print(f"Получаю статистику акаунта {config['phone']} {config['name']} {config['last_name']}")
+            summary = await stats_tracker.process_chats(client, date_start, date_end, start_time, end_time,
+                                                        cache=cache, session_id=session_id,
+                                                        output_root=os.path.join(output_root, session_id),
+                                                        verbose=False)
+            print(f"Готово: {config['phone']} {config['name']} {config['last_name']}")
+            summary['name'] = f"{config['phone']} {summary['name']}"
+            return summary
+        except Exception as e:
+            print(f"Ошибка в акаунте '{session_id}': {e}")
+            return None
+
+
+async def batch_report(date_start, date_end, start_time, end_time, per_api_limit=BATCH_PER_API_LIMIT):
+    # Every saved account with the same range and working hours; accounts sharing an API id
+    # run at most `per_api_limit` at a time
+    sessions = load_sessions()
+    if not sessions:
+        print("\nСписок пуст")
+        return
+
+    output_root = f"team_{date_start.strftime('%Y-%m-%d')}_{date_end.strftime('%Y-%m-%d')}"
+    os.makedirs(output_root, exist_ok=True)
+
+    limits = {}
+    cache = message_cache.open_cache()
+    try:
+        summaries = await asyncio.gather(*[
+            run_account_report(session_id, config, date_start, date_end, start_time, end_time,
+                               limits.setdefault(config['api_id'], asyncio.Semaphore(per_api_limit)),
+                               cache, output_root)
+            for session_id, config in sessions.items()
+        ])
+    finally:
+        cache.close()
+
+    import stats_tracker
+
+    summaries = [summary for summary in summaries if summary is not None]
+    team_file = os.path.join(output_root, 'team_statistics.txt')
+    stats_tracker.write_team_statistics(summaries, filename=team_file)
+    print(f"\nОбработано акаунтов: {len(summaries)} из {len(sessions)}. Итог команды: {team_file}")
+
+
+async def batch_menu():
+    print("\n=== Статистика по всем акаунтам ===")
+    while True:
+        try:
+            date_start, date_end = parse_date_range(input("Введите дату или диапазон дат (ДД.ММ.ГГГГ - ДД.ММ.ГГГГ): "))
+            break
+        except ValueError:
+            print("Неверный формат даты или дата окончание раньше даты начала. Повторите")
+    while True:
+        try:
+            start_time, end_time = parse_working_hours(input("Введите рабочие часы (чч:мм - чч:мм): ").strip())
+            break
         except ValueError as ve:
             print(f"Неверный формат времени: {ve}. Повтор")
-        else:
-            break
 
-    async with session:
-        await stats_tracker.process_chats(session, date_start, date_end, start_time, end_time)
+    await batch_report(date_start, date_end, start_time, end_time)
 
 
 # =======================
-# Main Loop
+# Command line
 # =======================
 
-async def main():
-    ensure_session_directory()
 
+def date_range_argument(value):
+    try:
+        return parse_date_range(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("ожидается ДД.ММ.ГГГГ или ДД.ММ.ГГГГ-ДД.ММ.ГГГГ, начало не позже конца")
+
+
+def shift_hours_argument(value):
+    try:
+        return parse_shift_hours(value)
+    except ValueError as ve:
+        raise argparse.ArgumentTypeError(f"ожидается чч:мм-чч:мм ({ve})")
+
+
+def holidays_argument(value):
+    try:
+        return [datetime.strptime(day.strip(), "%d.%m.%Y").date() for day in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("ожидается ДД.ММ.ГГГГ[,ДД.ММ.ГГГГ...]")
+
+
+def timezone_argument(value):
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    try:
+        return ZoneInfo(value)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise argparse.ArgumentTypeError(f"неизвестный часовой пояс: {value}")
+
+
+def working_hours_argument(value):
+    try:
+        return parse_working_hours(value)
+    except ValueError as ve:
+        raise argparse.ArgumentTypeError(f"ожидается чч:мм-чч:мм ({ve})")
+
+
+async def report_command(args):
+    (date_start, date_end), (start_time, end_time) = args.dates, args.hours
+    options = {'stream': args.stream, 'output_root': args.output, 'verbose': not args.quiet}
+    if args.concurrency:
+        options['concurrency'] = args.concurrency
+    if args.trace:
+        options['trace'] = args.trace
+    if args.export:
+        options['export_format'] = args.export
+    if args.shards:
+        options['shards'] = args.shards
+    if args.models:
+        model_start, model_end = args.model_hours or args.hours
+        options['models'] = reply_models.preset_models(args.models, model_start, model_end, args.timezone,
+                                                       args.holidays)
+    if args.group_analytics:
+        options['analyze_groups'] = True
+    if args.incremental:
+        options['incremental'] = True
+    if args.diff:
+        options['diff'] = True
+    if args.archive:
+        options['archive'] = args.archive
+    summary = await run_report(args.session, date_start, date_end, start_time, end_time, **options)
+    return 0 if summary is not None else 1
+
+
+async def batch_command(args):
+    (date_start, date_end), (start_time, end_time) = args.dates, args.hours
+    await batch_report(date_start, date_end, start_time, end_time, per_api_limit=args.per_api_limit)
+    return 0
+
+
+async def daemon_command(args):
+    import daemon
+
+    config = get_session(args.session)
+    if config is None:
+        print(f"Акаунт '{args.session}' не найден.")
+        return 1
+    start_time, end_time = args.hours
+    session_file = os.path.join(SESSIONS_DIR, f"{args.session}.session")
+    client = telegram_client(session_file, config['api_id'], config['api_hash'])
+    await daemon.run_daemon(client, args.session, start_time, end_time, port=args.port, socket_path=args.socket,
+                            snapshot_interval=args.snapshot_interval)
+    return 0
+
+
+async def sessions_list_command(args):
+    sessions = load_sessions()
+    if not sessions:
+        print("Список пуст")
+    for session_id, config in sessions.items():
+        logged_in = os.path.exists(os.path.join(SESSIONS_DIR, f"{session_id}.session"))
+        print(f"{session_id}\t{config['phone']} {config['name']} {config['last_name']}".rstrip()
+              + ("" if logged_in else "\t(нет файла сессии)"))
+    return 0
+
+
+async def sessions_add_command(args):
+    return 0 if await add_session(args.phone, args.api_id, args.api_hash) else 1
+
+
+async def sessions_remove_command(args):
+    if get_session(args.session) is None:
+        print(f"Акаунт '{args.session}' не найден.")
+        return 1
+    await remove_session(args.session)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Статистика переписки Telegram. Без команды открывается интерактивное меню.")
+    commands = parser.add_subparsers(dest='command')
+
+    report = commands.add_parser('report', help='статистика одного акаунта')
+    report.add_argument('--session', required=True, help='id акаунта (см. sessions list)')
+    report.add_argument('--dates', required=True, type=date_range_argument, help='ДД.ММ.ГГГГ[-ДД.ММ.ГГГГ]')
+    report.add_argument('--hours', required=True, type=working_hours_argument, help='рабочие часы чч:мм-чч:мм')
+    report.add_argument('--output', default='.', help='папка для отчёта')
+    report.add_argument('--stream', action='store_true', help='потоковый режим, меньше памяти')
+    report.add_argument('--concurrency', type=int, help='сколько диалогов загружать одновременно')
+    report.add_argument('--trace', help='файл .json/.csv с замерами по диалогам')
+    report.add_argument('--export', choices=['csv', 'parquet', 'auto'],
+                        help='сырые данные по сообщениям и чатам (parquet нужен pyarrow, auto выберет сам)')
+    report.add_argument('--shards', type=int, help='процессов-воркеров, каждый со своим подключением')
+    report.add_argument('--models', nargs='+', choices=reply_models.PRESETS,
+                        help='сравнить модели времени ответа (отдельный файл _models_)')
+    report.add_argument('--model-hours', type=shift_hours_argument,
+                        help='рабочие часы моделей, смена может переходить через полночь (по умолчанию --hours)')
+    report.add_argument('--timezone', type=timezone_argument, default=timezone.utc,
+                        help='часовой пояс рабочего календаря моделей, напр. Europe/Kyiv')
+    report.add_argument('--holidays', type=holidays_argument, default=[], help='выходные дни ДД.ММ.ГГГГ,ДД.ММ.ГГГГ')
+    report.add_argument('--group-analytics', action='store_true',
+                        help='ветки, участники и кому я отвечал в группах (отдельный файл _group_analytics_)')
+    report.add_argument('--incremental', action='store_true',
+                        help='не пересчитывать дни, не изменившиеся с прошлых отчётов (из кеша)')
+    report.add_argument('--diff', action='store_true',
+                        help='отчёт в JSON и изменения с прошлого отчёта (файлы _report_ и _report_diff_)')
+    report.add_argument('--archive', choices=output_writer.ARCHIVE_FORMATS,
+                        help='переписки одним архивом вместо папки (tar.zst нужен zstandard)')
+    report.add_argument('--quiet', action='store_true', help='без вывода по чатам и итогов')
+    report.set_defaults(func=report_command)
+
+    # python main.py batch ДД.ММ.ГГГГ[-ДД.ММ.ГГГГ] чч:мм-чч:мм still works
+    batch = commands.add_parser('batch', help='статистика по всем акаунтам')
+    batch.add_argument('dates', type=date_range_argument, help='ДД.ММ.ГГГГ[-ДД.ММ.ГГГГ]')
+    batch.add_argument('hours', type=working_hours_argument, help='рабочие часы чч:мм-чч:мм')
+    batch.add_argument('--per-api-limit', type=int, default=BATCH_PER_API_LIMIT,
+                       help='акаунтов с одним API ID одновременно')
+    batch.set_defaults(func=batch_command)
+
+    live = commands.add_parser('daemon', help='статистика за сегодня в реальном времени по новым сообщениям')
+    live.add_argument('--session', required=True, help='id акаунта (см. sessions list)')
+    live.add_argument('--hours', required=True, type=working_hours_argument, help='рабочие часы чч:мм-чч:мм')
+    live.add_argument('--port', type=int, default=8765, help='локальный HTTP порт (127.0.0.1)')
+    live.add_argument('--socket', help='Unix сокет вместо HTTP порта')
+    live.add_argument('--snapshot-interval', type=int, default=60, help='секунд между сохранениями на диск')
+    live.set_defaults(func=daemon_command)
+
+    sessions = commands.add_parser('sessions', help='сохранённые акаунты')
+    session_commands = sessions.add_subparsers(dest='sessions_command', required=True)
+    session_commands.add_parser('list', help='список акаунтов').set_defaults(func=sessions_list_command)
+    add = session_commands.add_parser('add', help='добавить акаунт (код из Telegram спросит при входе)')
+    add.add_argument('--phone', required=True)
+    add.add_argument('--api-id', required=True)
+    add.add_argument('--api-hash', required=True)
+    add.set_defaults(func=sessions_add_command)
+    remove = session_commands.add_parser('remove', help='удалить акаунт и его кэш')
+    remove.add_argument('session', help='id акаунта')
+    remove.set_defaults(func=sessions_remove_command)
+    return parser
+
+
+async def interactive_menu():
     while True:
         choice = display_menu()
         os.system('cls') if os.name == 'nt' else os.system('clear')
@@ -254,13 +595,33 @@ async def main():
             await add_new_session()
 
         elif choice == '3':
-            remove_existing_session()
+            await remove_existing_session()
 
         elif choice == '4':
+            await batch_menu()
+
+        elif choice == '5':
             break
 
         else:
             print("Неизвестный выбор. Повторите.")
 
 
-asyncio.run(main())
\ No newline at end of file
+async def run_command(command):
+    try:
+        return await command
+    finally:
+        await close_clients()
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    ensure_session_directory()
+    if args.command is None:
+        asyncio.run(run_command(interactive_menu()))
+        return 0
+    return asyncio.run(run_command(args.func(args)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
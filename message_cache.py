@@ -0,0 +1,322 @@
+import os
+import json
+import sqlite3
+import hashlib
+from datetime import datetime, timezone
+
+from message_record import MessageRecord
+
+CACHE_PATH = 'stored_sessions/message_cache.sqlite3'
+
+# Message columns added after the first caches were created
+ADDED_COLUMNS = [('media', 'TEXT'), ('reply_to', 'INTEGER'), ('mentioned', 'INTEGER NOT NULL DEFAULT 0')]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    peer_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    date INTEGER NOT NULL,
+    out INTEGER NOT NULL,
+    text TEXT,
+    message TEXT,
+    sender_id INTEGER,
+    media TEXT,  -- message_record.media_info() as a JSON list, NULL for plain text
+    reply_to INTEGER,
+    mentioned INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (session_id, peer_id, message_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS messages_by_date ON messages (session_id, peer_id, date);
+
+-- History of a dialog is complete between synced_from and synced_to (unix seconds),
+-- max_id is the newest message id stored for it (the high-water mark)
+CREATE TABLE IF NOT EXISTS sync_state (
+    session_id TEXT NOT NULL,
+    peer_id INTEGER NOT NULL,
+    synced_from INTEGER NOT NULL,
+    synced_to INTEGER NOT NULL,
+    max_id INTEGER NOT NULL,
+    PRIMARY KEY (session_id, peer_id)
+);
+
+-- Statistics of one dialog for one UTC day (stats_tracker.day_partials), stored as JSON per
+-- working hours; only days completely synced at the time of the report are kept. Every such day
+-- has a row, 'null' for a day without messages, so a missing row is a day that was never counted.
+CREATE TABLE IF NOT EXISTS day_partials (
+    session_id TEXT NOT NULL,
+    peer_id INTEGER NOT NULL,
+    work_hours TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (session_id, work_hours, day, peer_id)
+) WITHOUT ROWID;
+
+-- Transcript of one dialog for one complete UTC day (stats_tracker.write_dialog_days), the number
+-- of text messages in it and messages_digest() of them; every day has a row, days without messages
+-- too. Together with the day's partials it lets incremental reports skip the day. Dropped when
+-- the day is fetched again and its messages are not the same any more.
+CREATE TABLE IF NOT EXISTS day_transcripts (
+    session_id TEXT NOT NULL,
+    peer_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    text_messages INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (session_id, peer_id, day)
+) WITHOUT ROWID;
+
+-- Dialog list of an account; kind is 'user', 'chat', 'megagroup' or 'channel', last_date is the
+-- date of the newest message (unix seconds) as of the last refresh
+CREATE TABLE IF NOT EXISTS dialogs (
+    session_id TEXT NOT NULL,
+    peer_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    entity_id INTEGER NOT NULL,
+    access_hash INTEGER,
+    last_date INTEGER NOT NULL,
+    pinned INTEGER NOT NULL,
+    bot INTEGER NOT NULL,
+    first_name TEXT,
+    last_name TEXT,
+    title TEXT,
+    PRIMARY KEY (session_id, peer_id)
+);
+
+CREATE INDEX IF NOT EXISTS dialogs_by_date ON dialogs (session_id, last_date);
+
+-- newest_date: newest unpinned dialog seen by the last refresh, older ones have not changed since
+CREATE TABLE IF NOT EXISTS dialog_index_state (
+    session_id TEXT PRIMARY KEY,
+    newest_date INTEGER NOT NULL,
+    full_refresh INTEGER NOT NULL
+);
+"""
+
+
+def open_cache(path=CACHE_PATH):
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(messages)')]
+    missing = [(name, definition) for name, definition in ADDED_COLUMNS if name not in columns]
+    if missing:
+        # Caches from before these columns: the messages they hold lack the details (media,
+        # replies, mentions), forgetting what was synced makes the next reports fetch them again
+        with connection:
+            for name, definition in missing:
+                connection.execute(f'ALTER TABLE messages ADD COLUMN {name} {definition}')
+            connection.execute('DELETE FROM sync_state')
+    return connection
+
+
+def media_to_json(media_info):
+    return json.dumps(media_info) if media_info else None
+
+
+def media_from_json(data):
+    return tuple(json.loads(data)) if data else None
+
+
+def messages_digest(messages):
+    # Changes when any message is added, edited or deleted; records from Telegram and from the cache agree
+    digest = hashlib.blake2b(digest_size=16)
+    for m in sorted(messages, key=lambda m: m.id):
+        digest.update(repr((m.id, m.date.timestamp(), bool(m.out), m.text, m.message, m.sender_id, m.media_info,
+                            m.reply_to, bool(m.mentioned))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def record_from_row(row):
+    return MessageRecord(row[0], from_timestamp(row[1]), bool(row[2]), row[3], row[4], row[5], media_from_json(row[6]),
+                         row[7], bool(row[8]))
+
+
+def to_timestamp(dt):
+    return int(dt.timestamp())
+
+
+def from_timestamp(ts):
+    return datetime.fromtimestamp(ts, timezone.utc)
+
+
+def get_sync_state(cache, session_id, peer_id):
+    row = cache.execute(
+        'SELECT synced_from, synced_to, max_id FROM sync_state WHERE session_id = ? AND peer_id = ?',
+        (session_id, peer_id)).fetchone()
+    if row is None:
+        return None
+    return {'synced_from': from_timestamp(row[0]), 'synced_to': from_timestamp(row[1]), 'max_id': row[2]}
+
+
+def set_sync_state(cache, session_id, peer_id, synced_from, synced_to, max_id):
+    cache.execute(
+        'INSERT OR REPLACE INTO sync_state (session_id, peer_id, synced_from, synced_to, max_id) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (session_id, peer_id, to_timestamp(synced_from), to_timestamp(synced_to), max_id))
+
+
+def store_messages(cache, session_id, peer_id, messages):
+    # INSERT OR REPLACE also picks up edits of already stored messages
+    cache.executemany(
+        'INSERT OR REPLACE INTO messages (session_id, peer_id, message_id, date, out, text, message, sender_id, media, '
+        'reply_to, mentioned) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        [(session_id, peer_id, m.id, to_timestamp(m.date), bool(m.out), m.text, m.message, m.sender_id,
+          media_to_json(m.media_info), m.reply_to, bool(m.mentioned)) for m in messages])
+
+
+def drop_deleted(cache, session_id, peer_id, date_from, date_to, alive_ids):
+    # Messages stored for [date_from, date_to) that the server no longer returned were deleted
+    stored = cache.execute(
+        'SELECT message_id FROM messages WHERE session_id = ? AND peer_id = ? AND date >= ? AND date < ?',
+        (session_id, peer_id, to_timestamp(date_from), to_timestamp(date_to))).fetchall()
+    deleted = [(session_id, peer_id, row[0]) for row in stored if row[0] not in alive_ids]
+    cache.executemany('DELETE FROM messages WHERE session_id = ? AND peer_id = ? AND message_id = ?', deleted)
+    return len(deleted)
+
+
+def drop_outside(cache, session_id, peer_id, date_from, date_to):
+    cache.execute(
+        'DELETE FROM messages WHERE session_id = ? AND peer_id = ? AND (date < ? OR date >= ?)',
+        (session_id, peer_id, to_timestamp(date_from), to_timestamp(date_to)))
+
+
+def load_messages(cache, session_id, peer_id, date_from, date_to):
+    # Newest first, the same order as TelegramClient.iter_messages
+    rows = cache.execute(
+        'SELECT message_id, date, out, text, message, sender_id, media, reply_to, mentioned FROM messages '
+        'WHERE session_id = ? AND peer_id = ? AND date >= ? AND date < ? ORDER BY message_id DESC',
+        (session_id, peer_id, to_timestamp(date_from), to_timestamp(date_to)))
+    return [record_from_row(row) for row in rows]
+
+
+async def iter_messages(cache, session_id, peer_id, date_from, date_to):
+    # Oldest first, rows are read from the cursor one by one
+    rows = cache.execute(
+        'SELECT message_id, date, out, text, message, sender_id, media, reply_to, mentioned FROM messages '
+        'WHERE session_id = ? AND peer_id = ? AND date >= ? AND date < ? ORDER BY message_id',
+        (session_id, peer_id, to_timestamp(date_from), to_timestamp(date_to)))
+    for row in rows:
+        yield record_from_row(row)
+
+
+def store_partials(cache, session_id, peer_id, work_hours, date_from, date_to, partials):
+    # Replaces the partials of the days of [date_from, date_to), days without messages get a 'null' row
+    cache.execute(
+        'DELETE FROM day_partials WHERE session_id = ? AND peer_id = ? AND work_hours = ? AND day >= ? AND day < ?',
+        (session_id, peer_id, work_hours, to_timestamp(date_from), to_timestamp(date_to)))
+    days = range(to_timestamp(date_from), to_timestamp(date_to), 86400)
+    cache.executemany(
+        'INSERT INTO day_partials (session_id, peer_id, work_hours, day, data) VALUES (?, ?, ?, ?, ?)',
+        [(session_id, peer_id, work_hours, day, json.dumps(partials.get(from_timestamp(day)))) for day in days])
+
+
+def load_partials(cache, session_id, work_hours, date_from, date_to, peer_ids=None):
+    # peer id -> {day: partials, None for a day without messages} of the stored days in
+    # [date_from, date_to), oldest first; days never counted are missing
+    rows = cache.execute(
+        'SELECT peer_id, day, data FROM day_partials WHERE session_id = ? AND work_hours = ? AND day >= ? AND day < ? '
+        'ORDER BY day',
+        (session_id, work_hours, to_timestamp(date_from), to_timestamp(date_to)))
+    partials = {}
+    for peer_id, day, data in rows:
+        if peer_ids is None or peer_id in peer_ids:
+            partials.setdefault(peer_id, {})[from_timestamp(day)] = json.loads(data)
+    return partials
+
+
+def load_day_results(cache, session_id, peer_id, work_hours, date_from, date_to):
+    # day -> (transcript, text messages, partials or None) of the days of [date_from, date_to) with a transcript
+    rows = cache.execute(
+        'SELECT t.day, t.data, t.text_messages, p.data FROM day_transcripts t LEFT JOIN day_partials p '
+        'ON p.session_id = t.session_id AND p.peer_id = t.peer_id AND p.work_hours = ? AND p.day = t.day '
+        'WHERE t.session_id = ? AND t.peer_id = ? AND t.day >= ? AND t.day < ?',
+        (work_hours, session_id, peer_id, to_timestamp(date_from), to_timestamp(date_to)))
+    return {from_timestamp(day): (transcript, text_messages, json.loads(data) if data else None)
+            for day, transcript, text_messages, data in rows}
+
+
+def store_day_results(cache, session_id, peer_id, work_hours, results):
+    # results: day -> (transcript, partials or None, digest); replaces what was stored for these days
+    cache.executemany('DELETE FROM day_partials WHERE session_id = ? AND peer_id = ? AND work_hours = ? AND day = ?',
+                      [(session_id, peer_id, work_hours, to_timestamp(day)) for day in results])
+    cache.executemany(
+        'INSERT INTO day_partials (session_id, peer_id, work_hours, day, data) VALUES (?, ?, ?, ?, ?)',
+        [(session_id, peer_id, work_hours, to_timestamp(day), json.dumps(partial))
+         for day, (_, partial, _) in results.items()])
+    cache.executemany(
+        'INSERT OR REPLACE INTO day_transcripts (session_id, peer_id, day, text_messages, digest, data) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        [(session_id, peer_id, to_timestamp(day),
+          partial['incoming_messages'] + partial['outgoing_messages'] if partial else 0, digest, transcript)
+         for day, (transcript, partial, digest) in results.items()])
+
+
+def load_day_digests(cache, session_id, peer_id, date_from, date_to):
+    rows = cache.execute('SELECT day, digest FROM day_transcripts WHERE session_id = ? AND peer_id = ? AND day >= ? '
+                         'AND day < ?', (session_id, peer_id, to_timestamp(date_from), to_timestamp(date_to)))
+    return {from_timestamp(day): digest for day, digest in rows}
+
+
+def drop_day_results(cache, session_id, peer_id, date_from, date_to):
+    # The messages of these days changed: their partials (for all working hours) and transcripts are stale
+    for table in ('day_partials', 'day_transcripts'):
+        cache.execute(f'DELETE FROM {table} WHERE session_id = ? AND peer_id = ? AND day >= ? AND day < ?',
+                      (session_id, peer_id, to_timestamp(date_from), to_timestamp(date_to)))
+
+
+DIALOG_COLUMNS = ('peer_id', 'kind', 'entity_id', 'access_hash', 'last_date', 'pinned', 'bot',
+                  'first_name', 'last_name', 'title')
+
+
+def get_dialog_index_state(cache, session_id):
+    row = cache.execute('SELECT newest_date, full_refresh FROM dialog_index_state WHERE session_id = ?',
+                        (session_id,)).fetchone()
+    if row is None:
+        return None
+    return {'newest_date': from_timestamp(row[0]), 'full_refresh': from_timestamp(row[1])}
+
+
+def store_dialogs(cache, session_id, dialogs, newest_date, full_refresh):
+    # dialogs: dicts with DIALOG_COLUMNS, dates as datetimes. full_refresh is the time of the
+    # last complete enumeration; when it is new, dialogs missing from it are dropped. Every
+    # enumeration reads all pinned dialogs, so the ones not among them are not pinned anymore.
+    state = get_dialog_index_state(cache, session_id)
+    if state is None or state['full_refresh'] != full_refresh:
+        cache.execute('DELETE FROM dialogs WHERE session_id = ?', (session_id,))
+    cache.execute('UPDATE dialogs SET pinned = 0 WHERE session_id = ?', (session_id,))
+    cache.executemany(
+        f"INSERT OR REPLACE INTO dialogs (session_id, {', '.join(DIALOG_COLUMNS)}) "
+        f"VALUES (?, {', '.join('?' * len(DIALOG_COLUMNS))})",
+        [(session_id, *(to_timestamp(d[c]) if c == 'last_date' else d[c] for c in DIALOG_COLUMNS)) for d in dialogs])
+    cache.execute('INSERT OR REPLACE INTO dialog_index_state (session_id, newest_date, full_refresh) VALUES (?, ?, ?)',
+                  (session_id, to_timestamp(newest_date), to_timestamp(full_refresh)))
+
+
+def load_dialogs(cache, session_id, since):
+    # Dialogs with messages since `since`, in the order of iter_dialogs: pinned first, then newest first
+    rows = cache.execute(
+        f"SELECT {', '.join(DIALOG_COLUMNS)} FROM dialogs WHERE session_id = ? AND last_date >= ? "
+        f"ORDER BY pinned DESC, last_date DESC, peer_id",
+        (session_id, to_timestamp(since)))
+    dialogs = []
+    for row in rows:
+        dialog = dict(zip(DIALOG_COLUMNS, row))
+        dialog['last_date'] = from_timestamp(dialog['last_date'])
+        dialogs.append(dialog)
+    return dialogs
+
+
+def forget_session(session_id, path=CACHE_PATH):
+    if not os.path.exists(path):
+        return
+    connection = open_cache(path)
+    with connection:
+        connection.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
+        connection.execute('DELETE FROM sync_state WHERE session_id = ?', (session_id,))
+        connection.execute('DELETE FROM day_partials WHERE session_id = ?', (session_id,))
+        connection.execute('DELETE FROM day_transcripts WHERE session_id = ?', (session_id,))
+        connection.execute('DELETE FROM dialogs WHERE session_id = ?', (session_id,))
+        connection.execute('DELETE FROM dialog_index_state WHERE session_id = ?', (session_id,))
+    connection.close()
@@ -0,0 +1,49 @@
+class MessageRecord:
+    # The part of a Telethon Message the reports use. Built once at fetch time, so the
+    # full message (entities, media, client reference) can be dropped right away.
+    __slots__ = ('id', 'date', 'out', 'text', 'message', 'sender_id', 'media_info', 'reply_to', 'mentioned')
+
+    def __init__(self, id, date, out, text, message=None, sender_id=None, media_info=None, reply_to=None,
+                 mentioned=False):
+        self.id = id
+        self.date = date
+        self.out = out
+        self.text = text
+        # the raw message is only shown for messages without text, so it is not kept otherwise
+        self.message = None if text else message
+        self.sender_id = sender_id
+        self.media_info = media_info  # see media_info(), None for plain text messages
+        self.reply_to = reply_to  # id of the message this one replies to
+        self.mentioned = mentioned  # mentions me (Telegram also sets it for replies to my messages)
+
+    def __repr__(self):
+        return f"MessageRecord(id={self.id}, date={self.date}, out={self.out}, text={self.text!r})"
+
+
+# Checked in this order, the first Message property that is set wins: a voice note is also
+# an audio document, a round video note also a video
+MEDIA_KINDS = ['voice', 'video_note', 'sticker', 'gif', 'video', 'audio', 'photo', 'document', 'geo', 'contact',
+               'poll']
+
+
+def media_info(message):
+    # (kind, duration in seconds, size in bytes, forwarded) from the metadata the fetched message
+    # already carries, nothing is downloaded. kind is one of MEDIA_KINDS, 'other' for the rest of
+    # the media, 'service' for service messages and 'text' for forwarded text; None for the
+    # messages the reports always counted (own text, link previews).
+    forwarded = getattr(message, 'fwd_from', None) is not None
+    if getattr(message, 'action', None) is not None:
+        return 'service', 0, 0, False
+    # by type name, importing Telethon here would load it for every command of main.py
+    if message.media is None or type(message.media).__name__ == 'MessageMediaWebPage':
+        return ('text', 0, 0, True) if forwarded else None
+    kind = next((kind for kind in MEDIA_KINDS if getattr(message, kind, None)), 'other')
+    file = message.file
+    if file is None:
+        return kind, 0, 0, forwarded
+    return kind, file.duration or 0, file.size or 0, forwarded
+
+
+def record_from_message(message):
+    return MessageRecord(message.id, message.date, bool(message.out), message.text, message.message,
+                         message.sender_id, media_info(message), message.reply_to_msg_id, bool(message.mentioned))
@@ -0,0 +1,281 @@
+import io
+import os
+import time
+import shutil
+import asyncio
+import tarfile
+import zipfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+try:
+    import zstandard
+except ImportError:  # optional dependency, only for .tar.zst archives
+    zstandard = None
+
+OUTPUT_QUEUE_SIZE = 64  # transcripts waiting for the disk before process_chats waits for the writer
+OUTPUT_BATCH_SIZE = 32  # queued files the writer thread takes at once
+
+ARCHIVE_FORMATS = ['zip', 'tar.gz', 'tar.zst']
+
+# The writer stage of a report: process_chats queues the transcripts in dialog order and a single
+# thread writes them, while the next dialogs are fetched. Paths are relative to the output root.
+# Into a folder every file is written under a temporary name and renamed into place, so an
+# interrupted run leaves whole files or none; into an archive everything goes as one stream to
+# <archive>.tmp, which is renamed when the report is complete. The files of an interrupted
+# archive are unpacked into the folder, where a resumed run finds them (see checkpoint).
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    # open() that renames the file into place when the block finishes without an error
+    f = open(path + '.tmp', mode, encoding=None if 'b' in mode else 'utf-8')
+    try:
+        yield f
+    except BaseException:
+        f.close()
+        os.remove(path + '.tmp')
+        raise
+    f.close()
+    os.replace(path + '.tmp', path)
+
+
+def atomic_write(path, data):
+    with atomic_open(path, 'wb') as f:
+        f.write(data)
+
+
+def link_tree(source_dir, dest_dir):
+    # Places the files of source_dir into dest_dir without writing them again: a hardlink
+    # where the file system allows it, a relative symlink otherwise, a copy as the last resort
+    for root, _, files in os.walk(source_dir):
+        target_root = os.path.join(dest_dir, os.path.relpath(root, source_dir))
+        os.makedirs(target_root, exist_ok=True)
+        for name in files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(source, target)
+            except OSError:
+                try:
+                    os.symlink(os.path.relpath(source, target_root), target)
+                except OSError:
+                    shutil.copy2(source, target)
+
+
+def remove_empty_dirs(path):
+    # Bottom up, folders that still hold something are kept
+    for root, _, _ in os.walk(path, topdown=False):
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass
+
+
+def available_archive_formats():
+    return ARCHIVE_FORMATS if zstandard is not None else [name for name in ARCHIVE_FORMATS if name != 'tar.zst']
+
+
+def archive_path(output_dir, archive_format):
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format: {archive_format}")
+    if archive_format == 'tar.zst' and zstandard is None:
+        raise RuntimeError("tar.zst archives need zstandard (pip install zstandard)")
+    return f'{output_dir}.{archive_format}'
+
+
+class ArchiveWriter:
+    # One archive written front to back. A member added a second time under another folder
+    # (the UNANSWERED copy of a chat) is a hardlink member in tar and a second entry in zip.
+    def __init__(self, path, archive_format):
+        self.path = path
+        self.format = archive_format
+        self.names = []
+        self.copies = set()  # names added by copy()
+        self.mtime = time.time()
+        self.raw = self.stream = None
+        if archive_format == 'zip':
+            self.zip = zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_DEFLATED)
+            return
+        self.raw = open(path + '.tmp', 'wb')
+        if archive_format == 'tar.zst':
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.raw)
+            self.tar = tarfile.open(fileobj=self.stream, mode='w|')
+        else:
+            self.tar = tarfile.open(fileobj=self.raw, mode='w|gz')
+
+    def add(self, name, data):
+        name = name.replace(os.sep, '/')
+        if self.format == 'zip':
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self.zip.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self.mtime
+            self.tar.addfile(info, io.BytesIO(data))
+        self.names.append(name)
+
+    def add_file(self, name, path):
+        with open(path, 'rb') as f:
+            self.add(name, f.read())
+
+    def copy(self, source_dir, dest_dir):
+        prefix = source_dir.replace(os.sep, '/') + '/'
+        dest_dir = dest_dir.replace(os.sep, '/')
+        for name in [name for name in self.names if name.startswith(prefix)]:
+            target = dest_dir + '/' + name[len(prefix):]
+            self.copies.add(target)
+            if self.format == 'zip':
+                # read back from the part already written, the zip is not closed yet
+                self.add(target, self.zip.read(name))
+                continue
+            info = tarfile.TarInfo(target)
+            info.type = tarfile.LNKTYPE
+            info.linkname = name
+            info.mtime = self.mtime
+            self.tar.addfile(info)
+            self.names.append(target)
+
+    def close(self, completed=True, unpack_to=None):
+        # unpack_to: a folder the files of an archive that is not completed are written into,
+        # without the copies; the archive itself is removed
+        if self.format == 'zip':
+            self.zip.close()
+        else:
+            self.tar.close()
+            if self.stream is not None:
+                self.stream.close()  # closes raw as well
+            else:
+                self.raw.close()
+        if completed:
+            os.replace(self.path + '.tmp', self.path)
+            return
+        try:
+            if unpack_to is not None:
+                for name, data in self.read():
+                    if name in self.copies:
+                        continue
+                    target = os.path.join(unpack_to, *name.split('/'))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    atomic_write(target, data)
+        finally:
+            os.remove(self.path + '.tmp')
+
+    def read(self):
+        # (name, data) of the regular files of the closed <archive>.tmp
+        if self.format == 'zip':
+            with zipfile.ZipFile(self.path + '.tmp') as archive:
+                for name in archive.namelist():
+                    yield name, archive.read(name)
+            return
+        with open(self.path + '.tmp', 'rb') as f:
+            if self.format == 'tar.zst':
+                f = zstandard.ZstdDecompressor().stream_reader(f)
+            with tarfile.open(fileobj=f, mode='r|*') as archive:
+                for member in archive:
+                    if member.isfile():
+                        yield member.name, archive.extractfile(member).read()
+
+
+def open_writer(output_root, archive=None, archive_format=None):
+    # archive: an archive_path() of archive_format, None writes into output_root itself.
+    # Must be called from the event loop the files are queued from.
+    writer = {
+        'root': output_root,
+        'archive': ArchiveWriter(archive, archive_format) if archive else None,
+        'queue': asyncio.Queue(OUTPUT_QUEUE_SIZE),
+        'executor': ThreadPoolExecutor(1),
+        'dirs': set(),  # folders created so far, each is created once
+        'intervals': [],  # (start, end) of every batch, for print_timings
+        'error': None,
+    }
+    writer['task'] = asyncio.create_task(run_writer(writer))
+    return writer
+
+
+def write_batch(writer, batch):
+    started = perf_counter()
+    archive = writer['archive']
+    for op, path, data in batch:
+        if archive is not None:
+            if op == 'file':
+                archive.add(path, data)
+            elif op == 'move':
+                archive.add_file(path, data)
+                os.remove(data)
+            else:
+                archive.copy(path, data)
+            continue
+        target = os.path.join(writer['root'], path)
+        if op == 'copy':
+            link_tree(target, os.path.join(writer['root'], data))
+            continue
+        folder = os.path.dirname(target)
+        if folder not in writer['dirs']:
+            os.makedirs(folder, exist_ok=True)
+            writer['dirs'].add(folder)
+        if op == 'file':
+            atomic_write(target, data)
+        else:
+            os.replace(data, target)
+    writer['intervals'].append((started, perf_counter()))
+
+
+async def run_writer(writer):
+    loop = asyncio.get_running_loop()
+    queue = writer['queue']
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < OUTPUT_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        items = [item for item in batch if item is not None]
+        if items and writer['error'] is None:
+            try:
+                await loop.run_in_executor(writer['executor'], write_batch, writer, items)
+            except Exception as e:
+                # the rest of the queue is dropped, the next put raises the error
+                writer['error'] = e
+        if len(items) < len(batch):
+            return
+
+
+async def put(writer, item):
+    if writer['error'] is not None:
+        raise writer['error']
+    await writer['queue'].put(item)
+
+
+async def write_file(writer, path, data):
+    await put(writer, ('file', path, data))
+
+
+async def move_file(writer, path, source):
+    # A file already on disk (a streamed transcript, one written by a shard), renamed to path
+    # or added to the archive and removed
+    await put(writer, ('move', path, source))
+
+
+async def copy_tree(writer, source_dir, dest_dir):
+    # Every file written under source_dir so far, also under dest_dir (see link_tree)
+    await put(writer, ('copy', source_dir, dest_dir))
+
+
+async def close_writer(writer, completed):
+    # Waits for the queued files; the archive is renamed into place only for a completed report,
+    # otherwise its files are unpacked into the output root
+    try:
+        if not writer['task'].done():
+            await writer['queue'].put(None)
+            await writer['task']
+    finally:
+        writer['executor'].shutdown()
+        if writer['archive'] is not None:
+            writer['archive'].close(completed and writer['error'] is None,
+                                    writer['root'] if writer['error'] is None else None)
+    if completed and writer['error'] is not None:
+        raise writer['error']
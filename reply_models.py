@@ -0,0 +1,238 @@
+from bisect import bisect_right
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+TYPING_SPEED = 200  # symbols per minute
+READING_SPEED = 170  # words per minute
+DAY = 86400
+GROUP_WINDOW = 3  # incoming messages a group reply is averaged over
+WORKDAYS = (0, 1, 2, 3, 4)  # Monday to Friday
+
+# Media time model (seconds per message, message_record.media_info kinds). Voice and round video
+# notes are recorded in real time, their duration is the sending time; incoming media with a
+# duration take that long to listen to or watch. 'forward' is any forwarded outgoing message.
+RECORDED_KINDS = ('voice', 'video_note')
+MEDIA_SEND_SECONDS = {
+    'voice': 5, 'video_note': 5, 'sticker': 3, 'gif': 5, 'video': 30, 'audio': 15, 'photo': 20, 'document': 30,
+    'geo': 10, 'contact': 10, 'poll': 60, 'other': 15, 'text': 5, 'forward': 5,
+}
+MEDIA_VIEW_SECONDS = {
+    'voice': 10, 'video_note': 10, 'sticker': 1, 'gif': 3, 'video': 30, 'audio': 30, 'photo': 5, 'document': 15,
+    'geo': 5, 'contact': 3, 'poll': 10, 'other': 5, 'text': 0,
+}
+
+# A reply model is a dict:
+#   pairing   which incoming messages a reply answers: 'auto' (the last one in private chats,
+#             the last GROUP_WINDOW in groups, like calculate_time_spent), 'last', 'window'
+#             (the last `window` ones, averaged) or 'first' (time since the first unanswered one)
+#   classify  'legacy' (calculate_time_spent: working hours of a single day) or 'calendar'
+#             (the reply and everything it answers fall into one working interval)
+#   calendar  working_calendar(); typing_speed / reading_speed for the time estimates
+#   media     also count media messages (voice, photos, stickers, forwards...) as messages and replies,
+#             with their time from media_send_seconds / media_view_seconds; forwarded text is not typed
+# compile_model turns the calendar into a lookup table for the dates of one report.
+
+
+def working_calendar(work_start, work_end, weekdays=tuple(range(7)), holidays=(), tz=timezone.utc):
+    # work_end before work_start is a shift across midnight, it ends the next day
+    return {'work_start': work_start, 'work_end': work_end, 'weekdays': frozenset(weekdays),
+            'holidays': frozenset(holidays), 'tz': tz}
+
+
+def reply_model(name, calendar, pairing='auto', window=GROUP_WINDOW, classify='calendar',
+                typing_speed=TYPING_SPEED, reading_speed=READING_SPEED, media=False,
+                media_send_seconds=MEDIA_SEND_SECONDS, media_view_seconds=MEDIA_VIEW_SECONDS):
+    return {'name': name, 'calendar': calendar, 'pairing': pairing, 'window': window, 'classify': classify,
+            'typing_speed': typing_speed, 'reading_speed': reading_speed, 'media': media,
+            'media_send_seconds': media_send_seconds, 'media_view_seconds': media_view_seconds}
+
+
+def legacy_model(work_start, work_end):
+    # Exactly what calculate_time_spent computes
+    return reply_model('legacy', working_calendar(work_start, work_end), classify='legacy')
+
+
+def preset_models(names, work_start, work_end, tz=timezone.utc, holidays=()):
+    presets = {
+        'legacy': lambda: legacy_model(work_start, work_end),
+        # working days only, in the account's time zone, shifts may cross midnight
+        'calendar': lambda: reply_model('calendar', working_calendar(work_start, work_end, WORKDAYS, holidays, tz)),
+        # same calendar, time until the first unanswered message instead of the last one
+        'first': lambda: reply_model('first', working_calendar(work_start, work_end, WORKDAYS, holidays, tz),
+                                     pairing='first'),
+        # every day is a working day, only the single-day classification is replaced
+        'everyday': lambda: reply_model('everyday', working_calendar(work_start, work_end, tz=tz)),
+        # the legacy rules with media messages counted too
+        'media': lambda: reply_model('media', working_calendar(work_start, work_end), classify='legacy', media=True),
+    }
+    return [presets[name]() for name in names]
+
+
+PRESETS = ['legacy', 'calendar', 'first', 'everyday', 'media']
+
+
+def seconds_of_day(value):
+    return value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1e6
+
+
+def compile_model(model, date_from, date_to):
+    # Working intervals of every day of the report as unix seconds, sorted, so classifying
+    # a reply is a bisect instead of datetime.combine calls per message
+    calendar = model['calendar']
+    compiled = dict(model)
+    compiled['start_offset'] = seconds_of_day(calendar['work_start'])
+    compiled['end_offset'] = seconds_of_day(calendar['work_end'])
+    if model['classify'] == 'legacy':
+        return compiled
+
+    tz = calendar['tz']
+    starts, ends = [], []
+    # a day of margin on both sides for time zones and shifts across midnight
+    day = date_from - timedelta(days=1)
+    while day <= date_to + timedelta(days=1):
+        if day.weekday() in calendar['weekdays'] and day not in calendar['holidays']:
+            end_day = day if calendar['work_end'] > calendar['work_start'] else day + timedelta(days=1)
+            starts.append(datetime.combine(day, calendar['work_start'], tzinfo=tz).timestamp())
+            ends.append(datetime.combine(end_day, calendar['work_end'], tzinfo=tz).timestamp())
+        day += timedelta(days=1)
+    compiled['starts'] = starts
+    compiled['ends'] = ends
+    return compiled
+
+
+def is_working(model, answered, reply, group):
+    # answered: unix times of the incoming messages the reply answers, oldest first
+    if model['classify'] == 'legacy':
+        if group:
+            day_start = reply - reply % DAY
+            return (all(ts >= day_start + model['start_offset'] for ts in answered)
+                    and reply <= day_start + model['end_offset'])
+        incoming = answered[-1]
+        day_start = incoming - incoming % DAY
+        return incoming >= day_start + model['start_offset'] and reply <= day_start + model['end_offset']
+
+    first = answered[0]
+    i = bisect_right(model['starts'], first) - 1
+    return i >= 0 and first < model['ends'][i] and reply <= model['ends'][i]
+
+
+def window_size(model, group):
+    if model['pairing'] == 'auto':
+        return GROUP_WINDOW if group else 1
+    if model['pairing'] == 'window':
+        return model['window']
+    return 1
+
+
+def new_counters(states, media):
+    # Message counters shared by the models that count the same messages
+    return {'states': states, 'media': media, 'incoming_messages': 0, 'outgoing_messages': 0, 'incoming_symbols': 0,
+            'outgoing_symbols': 0, 'typing_symbols': 0, 'reading_words': 0, 'last_out': None,
+            'sent_media': {}, 'received_media': {}}
+
+
+def count_media(media_counts, kind, duration):
+    # kind -> [messages, total duration, messages without a duration]
+    counts = media_counts.setdefault(kind, [0, 0.0, 0])
+    counts[0] += 1
+    counts[1] += duration
+    counts[2] += not duration
+
+
+def media_seconds(model, counters):
+    # (sending, viewing) seconds of the media messages under the model's media time model
+    send, view = model['media_send_seconds'], model['media_view_seconds']
+    sending = viewing = 0.0
+    for kind, (count, duration, without_duration) in counters['sent_media'].items():
+        if kind in RECORDED_KINDS:
+            sending += duration + without_duration * send[kind]
+        else:
+            sending += count * send[kind]
+    for kind, (count, duration, without_duration) in counters['received_media'].items():
+        viewing += duration + without_duration * view[kind]
+    return sending, viewing
+
+
+def calculate_models(messages, models, group=False):
+    # One pass over the messages for all compiled models; returns model name -> statistics in the
+    # shape of calculate_time_spent. Media models also get media_messages (kind -> count),
+    # media_time and viewing_time (minutes, like typing_time).
+    text_states, media_states = [], []
+    for model in models:
+        state = {'model': model, 'first': model['pairing'] == 'first',
+                 'answered': deque(maxlen=window_size(model, group)), 'working': [], 'night': []}
+        (media_states if model.get('media') else text_states).append(state)
+    text_counters = new_counters(text_states, False)
+    media_counters = new_counters(media_states, True)
+    both = [counters for counters in (text_counters, media_counters) if counters['states']]
+    media_only = [media_counters] if media_states else []
+
+    for msg in sorted(messages, key=lambda m: m.date):
+        media_info = getattr(msg, 'media_info', None)
+        if msg.text:
+            feeds = both
+        elif media_info and media_info[0] != 'service':
+            feeds = media_only
+        else:
+            continue
+        ts = msg.date.timestamp()
+        for counters in feeds:
+            if not msg.out:
+                counters['incoming_messages'] += 1
+                if msg.text:
+                    counters['incoming_symbols'] += len(msg.text)
+                    counters['reading_words'] += len(msg.text.split())
+                if counters['media'] and media_info:
+                    count_media(counters['received_media'], media_info[0], media_info[1])
+                for state in counters['states']:
+                    if not (state['first'] and state['answered']):
+                        state['answered'].append(ts)
+                counters['last_out'] = False
+            else:
+                counters['outgoing_messages'] += 1
+                forwarded = counters['media'] and media_info is not None and media_info[3]
+                if msg.text:
+                    counters['outgoing_symbols'] += len(msg.text)
+                    if not forwarded:
+                        counters['typing_symbols'] += len(msg.text)
+                if counters['media'] and media_info:
+                    count_media(counters['sent_media'], 'forward' if forwarded else media_info[0], media_info[1])
+                if counters['last_out'] is False:
+                    for state in counters['states']:
+                        answered = state['answered']
+                        reply_time = sum([ts - incoming for incoming in answered]) / len(answered)
+                        if is_working(state['model'], answered, ts, group):
+                            state['working'].append(reply_time)
+                        else:
+                            state['night'].append(reply_time)
+                        answered.clear()
+                counters['last_out'] = True
+
+    results = {}
+    for counters in (text_counters, media_counters):
+        for state in counters['states']:
+            model = state['model']
+            working, night = state['working'], state['night']
+            stats = results[model['name']] = {
+                'group': group,
+                'typing_time': counters['typing_symbols'] / model['typing_speed'],
+                'reading_time': counters['reading_words'] / model['reading_speed'],
+                'incoming_messages': counters['incoming_messages'],
+                'outgoing_messages': counters['outgoing_messages'],
+                'incoming_symbols': counters['incoming_symbols'],
+                'outgoing_symbols': counters['outgoing_symbols'],
+                'average_working_reply': sum(working) / len(working) if working else None,
+                'average_night_reply': sum(night) / len(night) if night else None,
+                'messages_without_reply': 1 if counters['last_out'] is False else 0,
+                'working_reply_times': working,
+                'night_reply_times': night,
+            }
+            if counters['media']:
+                sending, viewing = media_seconds(model, counters)
+                stats['media_time'] = sending / 60
+                stats['viewing_time'] = viewing / 60
+                stats['media_messages'] = {}
+                for media_counts in (counters['sent_media'], counters['received_media']):
+                    for kind, (count, _, _) in media_counts.items():
+                        stats['media_messages'][kind] = stats['media_messages'].get(kind, 0) + count
+    return results
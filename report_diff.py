@@ -0,0 +1,106 @@
+import os
+import glob
+import json
+
+import output_writer
+from aggregates import ReplyTimes
+
+REPLY_KEYS = ['working_reply_seconds', 'night_reply_seconds']
+
+# A report as JSON: the account, the range, the per-chat rows (stats_tracker.chat_row, raw numbers)
+# and the summary, reply times as count and mean. Written as <name>_report_<dates>.json; when the
+# account already has one in the same folder (another range, or the same range run again), the
+# changes since the newest of them go to <name>_report_diff_<dates>.json.
+
+
+def new_report(account_id, summary, start_date, end_date, work_hours, chats):
+    summary_numbers = {}
+    for key, value in summary.items():
+        if isinstance(value, ReplyTimes):
+            summary_numbers[key] = {'count': value.count, 'mean': value.mean()}
+        else:
+            summary_numbers[key] = value
+    return {'account_id': account_id, 'date_from': start_date.date().isoformat(),
+            'date_to': end_date.date().isoformat(), 'work_hours': work_hours, 'summary': summary_numbers,
+            'chats': chats}
+
+
+def previous_report(output_root, name, account_id):
+    # The newest report of the account in output_root, None if there is none
+    paths = glob.glob(os.path.join(glob.escape(output_root), f'{glob.escape(name)}_report_*.json'))
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        if os.path.basename(path).startswith(f'{name}_report_diff_'):
+            continue
+        with open(path, encoding='utf-8') as f:
+            report = json.load(f)
+        if report.get('account_id') == account_id:
+            return report
+    return None
+
+
+def chat_ref(chat):
+    return {'chat_id': chat['chat_id'], 'name': chat['name'], 'group': chat['group']}
+
+
+def change(before, after):
+    return {'before': before, 'after': after,
+            'change': after - before if before is not None and after is not None else None}
+
+
+def diff_reports(previous, current):
+    before = {chat['chat_id']: chat for chat in previous['chats']}
+    after = {chat['chat_id']: chat for chat in current['chats']}
+    changes = {
+        'previous': {key: previous[key] for key in ('date_from', 'date_to', 'work_hours')},
+        'current': {key: current[key] for key in ('date_from', 'date_to', 'work_hours')},
+        'new_chats': [chat_ref(chat) for chat_id, chat in after.items() if chat_id not in before],
+        'gone_chats': [chat_ref(chat) for chat_id, chat in before.items() if chat_id not in after],
+        # chats waiting for my reply now that were not before, and the other way round
+        'new_unanswered': [chat_ref(chat) for chat_id, chat in after.items() if chat['messages_without_reply']
+                           and not before.get(chat_id, {}).get('messages_without_reply')],
+        'answered': [chat_ref(chat) for chat_id, chat in before.items() if chat['messages_without_reply']
+                     and chat_id in after and not after[chat_id]['messages_without_reply']],
+        'reply_time_changes': [],
+        'summary': {},
+    }
+    for chat_id, chat in after.items():
+        old = before.get(chat_id)
+        if old is None:
+            continue
+        changed = {key: change(old[key], chat[key]) for key in REPLY_KEYS if old[key] != chat[key]}
+        if changed:
+            changes['reply_time_changes'].append(dict(chat_ref(chat), **changed))
+    for key, value in current['summary'].items():
+        old = previous['summary'].get(key)
+        if old == value:
+            continue
+        if isinstance(value, dict):
+            changes['summary'][key] = {field: change((old or {}).get(field), value[field]) for field in value}
+        elif isinstance(value, (int, float)):
+            changes['summary'][key] = change(old, value)
+    return changes
+
+
+def write_json(path, data):
+    # Renamed into place, an interrupted run leaves the previous file
+    with output_writer.atomic_open(path) as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+
+
+def write_report(output_root, name, report):
+    # Writes the report and its diff against the previous one; returns the diff, None without a previous report
+    previous = previous_report(output_root, name, report['account_id'])
+    dates = f"{report['date_from']}_{report['date_to']}"
+    changes = None
+    if previous is not None:
+        changes = diff_reports(previous, report)
+        write_json(os.path.join(output_root, f'{name}_report_diff_{dates}.json'), changes)
+    write_json(os.path.join(output_root, f'{name}_report_{dates}.json'), report)
+    return changes
+
+
+def print_changes(changes):
+    previous = changes['previous']
+    print(f"\nИзменения с отчёта {previous['date_from']} - {previous['date_to']}: "
+          f"новых чатов без ответа {len(changes['new_unanswered'])}, отвечено {len(changes['answered'])}, "
+          f"время ответа изменилось в {len(changes['reply_time_changes'])} чатах")
@@ -0,0 +1,69 @@
+import os
+import json
+import sqlite3
+
+STORE_PATH = 'stored_sessions/sessions.sqlite3'
+LEGACY_CONFIG_PATH = 'stored_sessions/sessions.json'  # imported once, then renamed to .imported
+
+SESSION_FIELDS = ['api_id', 'api_hash', 'phone', 'name', 'last_name']
+
+SCHEMA = """
+-- Saved accounts; rowid keeps the order they were added in
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    api_id TEXT NOT NULL,
+    api_hash TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    name TEXT NOT NULL,
+    last_name TEXT NOT NULL
+);
+"""
+
+
+def open_store(path=STORE_PATH, legacy_path=LEGACY_CONFIG_PATH):
+    # Every change is one transaction, so several processes can add and remove accounts
+    # at the same time without overwriting each other
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    import_legacy_config(connection, legacy_path)
+    return connection
+
+
+def import_legacy_config(store, path):
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as f:
+        sessions = json.load(f).get('sessions', {})
+    with store:
+        for session_id, config in sessions.items():
+            store.execute('INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?, ?, ?)',
+                          (session_id, *[str(config.get(field) or '') for field in SESSION_FIELDS]))
+    try:
+        os.replace(path, path + '.imported')
+    except FileNotFoundError:
+        pass  # another process imported it at the same time
+
+
+def load_sessions(store):
+    rows = store.execute(f"SELECT session_id, {', '.join(SESSION_FIELDS)} FROM sessions ORDER BY rowid")
+    return {row[0]: dict(zip(SESSION_FIELDS, row[1:])) for row in rows}
+
+
+def get_session(store, session_id):
+    row = store.execute(f"SELECT {', '.join(SESSION_FIELDS)} FROM sessions WHERE session_id = ?",
+                        (session_id,)).fetchone()
+    return dict(zip(SESSION_FIELDS, row)) if row else None
+
+
+def put_session(store, session_id, config):
+    # A session id added again (logged in anew) keeps its place in the list
+    with store:
+        store.execute(f"INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (session_id) DO UPDATE SET "
+                      f"{', '.join(f'{field} = excluded.{field}' for field in SESSION_FIELDS)}",
+                      (session_id, *[str(config[field]) for field in SESSION_FIELDS]))
+
+
+def delete_session(store, session_id):
+    with store:
+        return store.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,)).rowcount > 0
@@ -0,0 +1,107 @@
+import os
+import queue
+import asyncio
+import multiprocessing
+
+from telethon.utils import get_peer_id
+
+import stats_tracker
+
+RESULT_POLL_SECONDS = 1.0  # how often the coordinator checks for workers that died
+
+# process_chats(shards=N) is the coordinator: it lists the dialogs, splits them into N shards and
+# starts a worker process per shard. Every worker connects with its own client (make_client()),
+# fetches its dialogs, writes their transcripts and sends the statistics back over a queue;
+# the coordinator merges them into the usual statistics files, in the usual dialog order.
+
+
+def partition(dialogs, shards):
+    # Round robin over the dialog list (newest first), so every shard gets a similar mix
+    return [dialogs[i::shards] for i in range(shards)]
+
+
+async def work_shard(make_client, dialogs, results, output_dir, start_date, end_date, work_start, work_end,
+                     concurrency, partials, export, models, analyze_groups):
+    client = make_client()
+
+    async def handle_dialog(entity, group, last_date):
+        user_name = stats_tracker.dialog_folder_name(entity, group)
+        messages = await stats_tracker.fetch_messages(client, entity, start_date, end_date, last_date)
+        if not messages:
+            return None
+        peer_id = get_peer_id(entity)
+        stats, _ = stats_tracker.write_dialog(os.path.join(output_dir, user_name), f'{user_name}.txt', messages,
+                                              work_start, work_end, group, partials, peer_id if export else None,
+                                              models, analyze_groups)
+        return stats
+
+    async with client:
+        async for entity, group, stats in stats_tracker.fetch_dialogs(dialogs, handle_dialog, concurrency):
+            results.put((get_peer_id(entity), stats))
+
+
+def run_worker(*args):
+    try:
+        asyncio.run(work_shard(*args))
+    except BaseException as e:
+        args[2].put(('error', f'{type(e).__name__}: {e}'))
+        return
+    args[2].put(('done', None))
+
+
+def start_shards(make_client, dialogs, shards, output_dir, start_date, end_date, work_start, work_end,
+                 concurrency, partials=False, export=False, models=None, analyze_groups=False):
+    # Spawned, not forked: the coordinator has a running event loop and open connections
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    workers = []
+    for part in partition(dialogs, shards):
+        if not part:
+            continue
+        worker = context.Process(target=run_worker, daemon=True, args=(
+            make_client, part, results, output_dir, start_date, end_date, work_start, work_end, concurrency,
+            partials, export, models, analyze_groups))
+        worker.start()
+        workers.append(worker)
+    return {'workers': workers, 'results': results}
+
+
+def next_result(pool):
+    while True:
+        try:
+            return pool['results'].get(timeout=RESULT_POLL_SECONDS)
+        except queue.Empty:
+            for worker in pool['workers']:
+                if worker.exitcode not in (None, 0):
+                    return 'error', f'worker {worker.pid} exited with code {worker.exitcode}'
+
+
+async def collect_results(pool, futures):
+    # Resolves futures (peer id -> future) with the statistics the workers send, None for
+    # dialogs without messages. A failed worker fails every dialog still waiting.
+    loop = asyncio.get_running_loop()
+    running = len(pool['workers'])
+    while running:
+        key, value = await loop.run_in_executor(None, next_result, pool)
+        if key == 'done':
+            running -= 1
+        elif key == 'error':
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(RuntimeError(f"Ошибка в процессе-шарде: {value}"))
+            return
+        else:
+            futures[key].set_result(value)
+
+
+def stop_shards(pool, futures):
+    # Dialogs still waiting are dropped; failures the coordinator never awaited are not reported again
+    for future in futures.values():
+        if not future.done():
+            future.cancel()
+        elif not future.cancelled():
+            future.exception()
+    for worker in pool['workers']:
+        if worker.is_alive():
+            worker.terminate()
+        worker.join()
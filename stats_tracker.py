@@ -1,8 +1,37 @@
 import os
 import re
-import shutil
-from datetime import timedelta, date, datetime, time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from time import perf_counter, thread_time
+from datetime import timedelta, date, datetime, time, timezone
+from telethon.errors import FloodWaitError
 from telethon.tl.types import User, Chat, Channel
+from telethon.utils import get_peer_id
+
+import checkpoint
+import export
+import group_analytics
+import instrumentation
+import message_cache
+import output_writer
+import reply_models
+import report_diff
+import sharding
+import vectorized_stats
+from aggregates import ReplyTimes
+from message_record import record_from_message
+
+FETCH_CONCURRENCY = 8
+HISTORY_PAGE_SIZE = 100  # maximum messages.getHistory page
+HISTORY_CHUNK_LIMIT = 3000  # Telethon pauses between history pages only above this limit
+CACHE_REVALIDATE_DAYS = 1  # newest cached days fetched again to pick up edits and deletions
+OUTPUT_WORKERS = 2  # threads/processes writing transcripts and computing statistics
+VECTORIZE_MIN_MESSAGES = 1000  # below this the NumPy setup costs more than the per-message loop
+FETCH_SPLIT_MIN_IDS = 2000  # id range of one concurrently fetched part of a huge dialog, at least
+FETCH_SPLIT_MAX_PARTS = 8  # parts of one dialog fetched at the same time, at most
+GROUP_PARTICIPANTS_SHOWN = 20  # participants listed per group in the group analytics report
+DIALOG_INDEX_FULL_REFRESH_DAYS = 7  # the dialog index is read in full again after this, dropping deleted dialogs
 
 
 def sanitize_folder_name(name):
@@ -16,106 +45,164 @@ def sanitize_folder_name(name):
     return sanitized
 
 
-def save_messages(user_dir, file_name, messages):
-    file_path = os.path.join(user_dir, file_name)
-    messages = reversed(messages)
-    with open(file_path, 'w', encoding='utf-8') as file:
-        for msg in messages:
-            time_str = msg.date.strftime('%d.%m %H:%M:%S')
-            direction = 'Исходящее' if msg.out else 'Входящее '
-            content = msg.text or f"<{msg.message or 'Не текстовое сообщ.'}>"
-            lines = content.split('\n')
-            first_line = f"[{time_str}] ({direction}) {lines[0]}"
-            file.write(f"{first_line}\n")
-            indent_length = len(f"[{time_str}] ({direction}) ")
-            for line in lines[1:]:
-                indented_line = ' ' * indent_length + line
-                file.write(f"{indented_line}\n")
+MESSAGE_INDENT = ' ' * len('[01.01 00:00:00] (Исходящее) ')  # the prefix has a fixed width
 
 
-def calculate_time_spent(messages, work_start, work_end, group=False):
-    typing_speed = 200  # symbols per minute
-    reading_speed = 170  # words per minute
+def timestamp_formatter():
+    # strftime('[%d.%m %H:%M:') is done once per minute, only the seconds are formatted per message
+    minutes = {}
 
-    total_typing_symbols = 0
-    total_reading_words = 0
-    total_incoming_messages = 0
-    total_outgoing_messages = 0
-    total_incoming_symbols = 0
-    total_outgoing_symbols = 0
+    def format_timestamp(moment):
+        key = (moment.month, moment.day, moment.hour, moment.minute)
+        prefix = minutes.get(key)
+        if prefix is None:
+            prefix = minutes[key] = moment.strftime('[%d.%m %H:%M:')
+        return f"{prefix}{moment.second:02d}]"
 
-    r_times_working = []
-    r_times_night = []
-    messages_without_reply = 0
+    return format_timestamp
 
-    # Ensure messages are in chronological order (from earliest to latest)
-    messages_sorted = sorted(messages, key=lambda m: m.date)
 
-    awaiting_reply = False
-    last_incoming_chat_datetimes = []
-    last_incoming_datetime = None
+MEDIA_LABELS = {
+    'voice': 'Голосовое', 'video_note': 'Видеосообщение', 'sticker': 'Стикер', 'gif': 'GIF', 'video': 'Видео',
+    'audio': 'Аудио', 'photo': 'Фото', 'document': 'Файл', 'geo': 'Геопозиция', 'contact': 'Контакт',
+    'poll': 'Опрос', 'other': 'Медиа', 'service': 'Служебное', 'text': 'Пересланный текст',
+    'forward': 'Пересланное',
+}
 
-    for msg in messages_sorted:
-        if msg.text:
-            if not msg.out:
-                # Incoming message
-                total_incoming_messages += 1
-                total_incoming_symbols += len(msg.text)
-                total_reading_words += len(msg.text.split())
-                if group:
-                    last_incoming_chat_datetimes.append(msg.date)
-                else:
-                    last_incoming_datetime = msg.date
-                awaiting_reply = True
+
+def media_label(media_info):
+    kind, duration, size, forwarded = media_info
+    label = MEDIA_LABELS[kind]
+    if duration:
+        label += f" {int(duration) // 60}:{int(duration) % 60:02d}"
+    if size:
+        label += f", {size / 1024:.0f} КБ" if size < 2 ** 20 else f", {size / 2 ** 20:.1f} МБ"
+    if forwarded and kind != 'text':
+        label += ", пересланное"
+    return label
+
+
+def format_message(msg, format_timestamp=None):
+    time_str = format_timestamp(msg.date) if format_timestamp else msg.date.strftime('[%d.%m %H:%M:%S]')
+    direction = '(Исходящее)' if msg.out else '(Входящее )'
+    content = msg.text
+    if not content:
+        media_info = getattr(msg, 'media_info', None)
+        content = f"<{media_label(media_info)}>" if media_info else f"<{msg.message or 'Не текстовое сообщ.'}>"
+    # Continuation lines are aligned under the first one
+    content = content.replace('\n', '\n' + MESSAGE_INDENT)
+    return f"{time_str} {direction} {content}\n"
+
+
+def format_transcript(messages):
+    # Oldest first; messages come newest first like from iter_messages
+    format_timestamp = timestamp_formatter()
+    return ''.join([format_message(msg, format_timestamp) for msg in reversed(messages)])
+
+
+def save_messages(user_dir, file_name, messages):
+    # The whole chat is formatted into one buffer and written with a single write
+    output_writer.atomic_write(os.path.join(user_dir, file_name), format_transcript(messages).encode('utf-8'))
+
+
+def new_reply_state(group=False):
+    return {
+        'group': group,
+        'typing_symbols': 0,
+        'reading_words': 0,
+        'incoming_messages': 0,
+        'outgoing_messages': 0,
+        'incoming_symbols': 0,
+        'outgoing_symbols': 0,
+        'working_reply_times': [],
+        'night_reply_times': [],
+        'awaiting_reply': False,
+        # only the last 3 incoming messages are ever averaged in groups
+        'last_incoming_chat_datetimes': deque(maxlen=3),
+        'last_incoming_datetime': None,
+    }
+
+
+def update_reply_state(state, msg, work_start, work_end):
+    # Feeds one message into the statistics; messages must arrive in chronological order.
+    # Returns (reply time, working) when the message is a reply, None otherwise.
+    if not msg.text:
+        return None
+
+    if not msg.out:
+        # Incoming message
+        state['incoming_messages'] += 1
+        state['incoming_symbols'] += len(msg.text)
+        state['reading_words'] += len(msg.text.split())
+        if state['group']:
+            state['last_incoming_chat_datetimes'].append(msg.date)
+        else:
+            state['last_incoming_datetime'] = msg.date
+        state['awaiting_reply'] = True
+    else:
+        # Outgoing message
+        state['outgoing_messages'] += 1
+        state['outgoing_symbols'] += len(msg.text)
+        state['typing_symbols'] += len(msg.text)
+
+        if state['awaiting_reply']:
+            if state['group']:
+                answered = state['last_incoming_chat_datetimes']
+            else:
+                answered = [state['last_incoming_datetime']]
+            reply_time, working = classify_reply(answered, msg.date, work_start, work_end, state['group'])
+            if working:
+                state['working_reply_times'].append(reply_time)
             else:
-                # Outgoing message
-                total_outgoing_messages += 1
-                total_outgoing_symbols += len(msg.text)
-                total_typing_symbols += len(msg.text)
-
-                if awaiting_reply:
-                    if group:
-                        last_3_incoming_times = last_incoming_chat_datetimes[-3:]
-                        # work_start_datetime = datetime.combine(last_3_incoming_times[-1], work_start, tzinfo=msg.date.tzinfo)
-                        # work_end_datetime = datetime.combine(last_3_incoming_times[-1], work_end, tzinfo=msg.date.tzinfo)
-                        work_start_datetime = datetime.combine(msg.date.date(), work_start, tzinfo=msg.date.tzinfo)
-                        work_end_datetime = datetime.combine(msg.date.date(), work_end, tzinfo=msg.date.tzinfo)
-
-                        average_reply_time = sum([(msg.date - dt).total_seconds() for dt in last_3_incoming_times]) / len(last_3_incoming_times)
-                        if all([dt >= work_start_datetime for dt in last_3_incoming_times]) and msg.date <= work_end_datetime:
-                            r_times_working.append(average_reply_time)
-                        else:
-                            r_times_night.append(average_reply_time)
-
-                        last_incoming_chat_datetimes = []
-
-                    else:
-                        last_incoming_date = last_incoming_datetime.date()
-                        work_start_datetime = datetime.combine(last_incoming_date, work_start, tzinfo=last_incoming_datetime.tzinfo)
-                        work_end_datetime = datetime.combine(last_incoming_date, work_end, tzinfo=last_incoming_datetime.tzinfo)
-
-                        if last_incoming_datetime >= work_start_datetime and msg.date <= work_end_datetime:
-                            r_times_working.append((msg.date - last_incoming_datetime).total_seconds())
-                        else:
-                            r_times_night.append((msg.date - last_incoming_datetime).total_seconds())
-
-                        last_incoming_datetime = None
-                    awaiting_reply = False
-
-    if awaiting_reply:
-        messages_without_reply = 1
+                state['night_reply_times'].append(reply_time)
+            state['last_incoming_chat_datetimes'].clear()
+            state['last_incoming_datetime'] = None
+            state['awaiting_reply'] = False
+            return reply_time, working
+    return None
+
+
+def classify_reply(answered, reply_date, work_start, work_end, group=False):
+    # answered: dates of the incoming messages the reply answers, oldest first (the last 3 in
+    # groups). Returns the reply time in seconds and whether it counts as working time.
+    if group:
+        # work_start_datetime = datetime.combine(answered[-1], work_start, tzinfo=reply_date.tzinfo)
+        # work_end_datetime = datetime.combine(answered[-1], work_end, tzinfo=reply_date.tzinfo)
+        work_start_datetime = datetime.combine(reply_date.date(), work_start, tzinfo=reply_date.tzinfo)
+        work_end_datetime = datetime.combine(reply_date.date(), work_end, tzinfo=reply_date.tzinfo)
+
+        average_reply_time = sum([(reply_date - dt).total_seconds() for dt in answered]) / len(answered)
+        working = all([dt >= work_start_datetime for dt in answered]) and reply_date <= work_end_datetime
+        return average_reply_time, working
+
+    last_incoming_datetime = answered[-1]
+    last_incoming_date = last_incoming_datetime.date()
+    work_start_datetime = datetime.combine(last_incoming_date, work_start, tzinfo=last_incoming_datetime.tzinfo)
+    work_end_datetime = datetime.combine(last_incoming_date, work_end, tzinfo=last_incoming_datetime.tzinfo)
+
+    working = last_incoming_datetime >= work_start_datetime and reply_date <= work_end_datetime
+    return (reply_date - last_incoming_datetime).total_seconds(), working
+
+
+def finish_reply_state(state):
+    typing_speed = 200  # symbols per minute
+    reading_speed = 170  # words per minute
+
+    r_times_working = state['working_reply_times']
+    r_times_night = state['night_reply_times']
+    messages_without_reply = 1 if state['awaiting_reply'] else 0
 
     average_night_reply = sum(r_times_night) / len(r_times_night) if r_times_night else None
     average_working_reply = sum(r_times_working) / len(r_times_working) if r_times_working else None
 
     return {
-        'group': group,
-        'typing_time': total_typing_symbols / typing_speed if typing_speed else 0,
-        'reading_time': total_reading_words / reading_speed if reading_speed else 0,
-        'incoming_messages': total_incoming_messages,
-        'outgoing_messages': total_outgoing_messages,
-        'incoming_symbols': total_incoming_symbols,
-        'outgoing_symbols': total_outgoing_symbols,
+        'group': state['group'],
+        'typing_time': state['typing_symbols'] / typing_speed if typing_speed else 0,
+        'reading_time': state['reading_words'] / reading_speed if reading_speed else 0,
+        'incoming_messages': state['incoming_messages'],
+        'outgoing_messages': state['outgoing_messages'],
+        'incoming_symbols': state['incoming_symbols'],
+        'outgoing_symbols': state['outgoing_symbols'],
         'average_working_reply': average_working_reply,
         'average_night_reply': average_night_reply,
         'messages_without_reply': messages_without_reply,
@@ -124,6 +211,221 @@ def calculate_time_spent(messages, work_start, work_end, group=False):
     }
 
 
+def calculate_time_spent(messages, work_start, work_end, group=False):
+    if len(messages) >= VECTORIZE_MIN_MESSAGES and vectorized_stats.available():
+        stats = vectorized_stats.calculate_time_spent(messages, work_start, work_end, group)
+        if stats is not None:
+            return stats
+
+    state = new_reply_state(group)
+
+    # Ensure messages are in chronological order (from earliest to latest)
+    messages_sorted = sorted(messages, key=lambda m: m.date)
+
+    for msg in messages_sorted:
+        update_reply_state(state, msg, work_start, work_end)
+
+    return finish_reply_state(state)
+
+
+def day_partials(messages, work_start, work_end, group=False):
+    # Statistics of every UTC day on its own, as if the report started that day. What a day
+    # needs from the days before it is kept aside, so merge_day_partials can combine any
+    # run of consecutive days exactly: 'head' are the incoming messages before the day's first
+    # outgoing one, 'first_out' is that outgoing message and 'tail' the incoming messages
+    # still waiting for a reply at the end of the day. The first reply of the day is left
+    # out of the reply times, its value depends on the previous days. working_times/night_times
+    # keep the reply times themselves, so merge_day_partials(exact=True) can rebuild the lists.
+    by_day = {}
+    for msg in sorted(messages, key=lambda m: m.date):
+        if msg.text:
+            by_day.setdefault(day_floor(msg.date.astimezone(timezone.utc)), []).append(msg)
+
+    partials = {}
+    for day, day_messages in by_day.items():
+        state = new_reply_state(group)
+        head, first_out = [], None
+        for msg in day_messages:
+            if msg.out and first_out is None:
+                first_out = msg.date
+                replies = len(state['working_reply_times']), len(state['night_reply_times'])
+                update_reply_state(state, msg, work_start, work_end)
+                del state['working_reply_times'][replies[0]:]
+                del state['night_reply_times'][replies[1]:]
+                continue
+            if not msg.out and first_out is None:
+                head.append(msg.date)
+            update_reply_state(state, msg, work_start, work_end)
+
+        tail = state['last_incoming_chat_datetimes'] if group else [state['last_incoming_datetime']]
+        partials[day] = {
+            'group': group,
+            'typing_symbols': state['typing_symbols'],
+            'reading_words': state['reading_words'],
+            'incoming_messages': state['incoming_messages'],
+            'outgoing_messages': state['outgoing_messages'],
+            'incoming_symbols': state['incoming_symbols'],
+            'outgoing_symbols': state['outgoing_symbols'],
+            'working': ReplyTimes(state['working_reply_times']).to_dict(),
+            'night': ReplyTimes(state['night_reply_times']).to_dict(),
+            'working_times': state['working_reply_times'],
+            'night_times': state['night_reply_times'],
+            'head': [dt.timestamp() for dt in head[-3:]],
+            'first_out': first_out.timestamp() if first_out else None,
+            'tail': [dt.timestamp() for dt in tail if dt is not None],
+        }
+    return partials
+
+
+def merge_day_partials(partials, work_start, work_end, group=False, exact=False):
+    # partials of consecutive days, oldest first; the result has the shape of calculate_time_spent
+    # with ReplyTimes instead of the reply time lists. exact: the reply time lists, in message order,
+    # so the result is exactly what calculate_time_spent returns for the messages of these days.
+    state = new_reply_state(group)
+    if exact:
+        working, night = state['working_reply_times'], state['night_reply_times']
+    else:
+        working, night = ReplyTimes(), ReplyTimes()
+    keep = 3 if group else 1
+    tail = []
+
+    for partial in partials:
+        for key in ('typing_symbols', 'reading_words', 'incoming_messages', 'outgoing_messages',
+                    'incoming_symbols', 'outgoing_symbols'):
+            state[key] += partial[key]
+
+        if partial['first_out'] is not None:
+            answered = (tail + partial['head'])[-keep:]
+            if answered:
+                reply_time, is_working = classify_reply(
+                    [datetime.fromtimestamp(ts, timezone.utc) for ts in answered],
+                    datetime.fromtimestamp(partial['first_out'], timezone.utc), work_start, work_end, group)
+                (working if is_working else night).extend([reply_time])
+            tail = partial['tail']
+        else:
+            tail = (tail + partial['tail'])[-keep:]
+
+        if exact:
+            working.extend(partial['working_times'])
+            night.extend(partial['night_times'])
+        else:
+            working.merge(ReplyTimes.from_dict(partial['working']))
+            night.merge(ReplyTimes.from_dict(partial['night']))
+
+    state['awaiting_reply'] = bool(tail)
+    stats = finish_reply_state(state)
+    if exact:
+        return stats
+    stats.update({
+        'average_working_reply': working.mean(),
+        'average_night_reply': night.mean(),
+        'working_reply_times': working,
+        'night_reply_times': night,
+    })
+    return stats
+
+
+def new_message_columns():
+    return {name: [] for name in export.MESSAGE_COLUMNS}
+
+
+def add_message_row(columns, chat_id, msg, reply):
+    text = msg.text or ''
+    columns['chat_id'].append(chat_id)
+    columns['message_id'].append(msg.id)
+    columns['timestamp'].append(int(msg.date.timestamp()))
+    columns['out'].append(bool(msg.out))
+    columns['symbols'].append(len(text))
+    columns['words'].append(len(text.split()))
+    columns['reply_seconds'].append(reply[0] if reply else None)
+    columns['reply_working'].append(reply[1] if reply else None)
+    media_info = msg.media_info or (None, None, None, False)
+    columns['media'].append(media_info[0])
+    columns['media_seconds'].append(media_info[1])
+    columns['media_bytes'].append(media_info[2])
+    columns['forwarded'].append(media_info[3])
+
+
+def message_columns(chat_id, messages, work_start, work_end, group=False):
+    # Per-message export rows in the order calculate_time_spent sees the messages
+    columns = new_message_columns()
+    state = new_reply_state(group)
+    for msg in sorted(messages, key=lambda m: m.date):
+        add_message_row(columns, chat_id, msg, update_reply_state(state, msg, work_start, work_end))
+    return columns
+
+
+def chat_row(account_id, chat_id, name, group, stats, start_date, end_date):
+    # Per-chat export row (a single row in column form): raw numbers, no formatting
+    row = {
+        'account_id': account_id,
+        'chat_id': chat_id,
+        'name': name,
+        'group': group,
+        'date_from': start_date.date().isoformat(),
+        'date_to': end_date.date().isoformat(),
+        'incoming_messages': stats['incoming_messages'],
+        'outgoing_messages': stats['outgoing_messages'],
+        'incoming_symbols': stats['incoming_symbols'],
+        'outgoing_symbols': stats['outgoing_symbols'],
+        'typing_seconds': stats['typing_time'] * 60,
+        'reading_seconds': stats['reading_time'] * 60,
+        'working_replies': len(stats['working_reply_times']),
+        'working_reply_seconds': stats['average_working_reply'],
+        'night_replies': len(stats['night_reply_times']),
+        'night_reply_seconds': stats['average_night_reply'],
+        'messages_without_reply': stats['messages_without_reply'],
+    }
+    return {name: [value] for name, value in row.items()}
+
+
+def new_totals():
+    # Running totals of a report; merge_totals combines them across chats, accounts and ranges
+    return {
+        'typing_time': 0,
+        'reading_time': 0,
+        'incoming_messages': 0,
+        'outgoing_messages': 0,
+        'incoming_symbols': 0,
+        'outgoing_symbols': 0,
+        'work_reply_times': ReplyTimes(),
+        'night_reply_times': ReplyTimes(),
+        'messages_without_reply': 0,
+    }
+
+
+def add_chat_stats(totals, stats):
+    for key in ('typing_time', 'reading_time', 'incoming_messages', 'outgoing_messages',
+                'incoming_symbols', 'outgoing_symbols', 'messages_without_reply'):
+        totals[key] += stats[key]
+    # Reply time lists are summed per chat first, like the ReplyTimes of a resumed dialog
+    for key, times in (('work_reply_times', stats['working_reply_times']),
+                       ('night_reply_times', stats['night_reply_times'])):
+        totals[key].merge(times if isinstance(times, ReplyTimes) else ReplyTimes(times))
+
+
+def add_media_stats(totals, stats):
+    # Media models (reply_models, media=True) also count media messages and their time
+    totals['media_time'] = totals.get('media_time', 0) + stats['media_time']
+    totals['viewing_time'] = totals.get('viewing_time', 0) + stats['viewing_time']
+    media = totals.setdefault('media_messages', {})
+    for kind, count in stats['media_messages'].items():
+        media[kind] = media.get(kind, 0) + count
+
+
+def merge_totals(first, second):
+    merged = {}
+    for key in first.keys() | second.keys():
+        values = [value for value in (first.get(key), second.get(key)) if value is not None]
+        if isinstance(values[0], ReplyTimes):
+            merged[key] = ReplyTimes()
+            for value in values:
+                merged[key].merge(value)
+        else:
+            merged[key] = sum(values)
+    return merged
+
+
 def format_time(total_minutes):
     total_seconds = int(total_minutes * 60)
     hours = total_seconds // 3600
@@ -155,7 +457,7 @@ def format_duration(total_seconds):
 
 def write_chat_statistics(chat_stats_list, filename='chat_statistics.txt'):
 
-    with open(filename, 'w', encoding='utf-8') as f:
+    with output_writer.atomic_open(filename) as f:
         for stats in chat_stats_list:
             f.write(f"Чат с {stats['chat_name']}:\n")
             f.write(f"   Времени на печать: {stats['typing_time']}\n")
@@ -170,65 +472,803 @@ def write_chat_statistics(chat_stats_list, filename='chat_statistics.txt'):
             f.write("\n")
 
 
-async def fetch_messages(client, entity, start_date, end_date):
-    # messages_by_date = defaultdict(list)
-
-    messages = []
+def date_window(start_date, end_date, tz=timezone.utc):
+    # Telegram dates are UTC; naive datetimes would be silently treated as UTC by Telethon,
+    # so the window bounds are always built timezone-aware
+    window_start = datetime.combine(start_date.date(), time.min, tzinfo=tz)
+    window_end = datetime.combine(end_date.date() + timedelta(days=1), time.min, tzinfo=tz)
+    return window_start, window_end
 
-    async for message in client.iter_messages(entity, offset_date=end_date + timedelta(days=1)):
-        if message.date.date() < start_date.date():
-            break
 
-        if start_date.date() <= message.date.date() <= end_date.date():
-            messages.append(message)
+def history(client, entity, **kwargs):
+    # client.iter_messages, counted into the dialog trace when tracing is on
+    messages = client.iter_messages(entity, **kwargs)
+    if instrumentation.DIALOG_TRACE.get() is None:
+        return messages
+    return instrumentation.traced_history(messages, HISTORY_PAGE_SIZE)
 
-    return messages
 
+async def fetch_older(client, entity, offset_id, window_start, min_id=0):
+    # Messages with min_id < id < offset_id down to window_start, newest first. Each iter_messages
+    # call is limited to HISTORY_CHUNK_LIMIT, so Telethon does not pause between pages, and to the
+    # ids left above min_id, so no request is spent past it.
+    messages = []
+    while True:
+        limit = min(HISTORY_CHUNK_LIMIT, offset_id - min_id - 1) if min_id else HISTORY_CHUNK_LIMIT
+        if limit <= 0:
+            return messages
+        count = 0
+        async for message in history(client, entity, limit=limit, offset_id=offset_id, min_id=min_id):
+            if message.date < window_start:
+                return messages
+            messages.append(record_from_message(message))
+            offset_id = message.id
+            count += 1
+        if count < limit:
+            return messages
+
+
+def estimated_older_messages(messages, window_start):
+    # Messages of the window older than the first page, at the pace of the first page
+    span = (messages[0].date - messages[-1].date).total_seconds()
+    rest = (messages[-1].date - window_start).total_seconds()
+    return len(messages) * rest / max(span, 1)
+
+
+async def fetch_messages(client, entity, start_date, end_date, last_date=None, tz=timezone.utc):
+    window_start, window_end = date_window(start_date, end_date, tz)
+    if last_date is not None and last_date < window_start:
+        return []
+
+    # The first page is bounded by date on the server side and doubles as a probe:
+    # most dialogs have less than a page of messages in the window and end here
+    messages = []
+    async for message in history(client, entity, limit=HISTORY_PAGE_SIZE, offset_date=window_end):
+        if message.date < window_start:
+            return messages
+        messages.append(record_from_message(message))
+    if len(messages) < HISTORY_PAGE_SIZE:
+        return messages
+
+    # Larger windows continue page by page from the first page. Private chats and basic groups
+    # share one id sequence per account, most of an id range of theirs holds messages of other
+    # dialogs, so only megagroup windows are split.
+    if (not (isinstance(entity, Channel) and entity.megagroup)
+            or estimated_older_messages(messages, window_start) < 2 * FETCH_SPLIT_MIN_IDS):
+        messages.extend(await fetch_older(client, entity, messages[-1].id, window_start))
+        return messages
+
+    # The oldest page of the window, read forwards from its start, gives the lower id bound
+    # without a request of its own
+    max_id = messages[-1].id
+    page = [message async for message in
+            history(client, entity, limit=HISTORY_PAGE_SIZE, offset_date=window_start, reverse=True)]
+    oldest = [record_from_message(message) for message in reversed(page)
+              if message.id < max_id and message.date >= window_start]
+    if len(page) < HISTORY_PAGE_SIZE or page[-1].id >= max_id:
+        return messages + oldest
+    min_id = page[-1].id
+
+    parts = min(FETCH_SPLIT_MAX_PARTS, (max_id - min_id - 1) // FETCH_SPLIT_MIN_IDS)
+    if parts > 1:
+        # Huge megagroups: the id range is cut into parts fetched concurrently, so one giant group
+        # does not fetch page after page alone at the end of the run. Megagroup ids are per chat,
+        # equal id ranges hold about equally many messages. Every part but the oldest is a whole
+        # number of pages, so the parts need no more requests than one walk over the range.
+        step = -(-(max_id - min_id - 1) // (parts * HISTORY_PAGE_SIZE)) * HISTORY_PAGE_SIZE
+        bounds = [max_id - step * i for i in range(parts)] + [min_id + 1]
+        tasks = [asyncio.create_task(fetch_older(client, entity, bounds[i], window_start, bounds[i + 1] - 1))
+                 for i in range(parts)]
+        try:
+            pieces = await asyncio.gather(*tasks)
+        finally:
+            # A part that fails (FloodWait) stops the others before fetch_with_backoff retries the dialog
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for piece in pieces:
+            messages.extend(piece)
+    else:
+        messages.extend(await fetch_older(client, entity, max_id, window_start, min_id))
+
+    return messages + oldest
+
+
+async def stream_messages(client, entity, start_date, end_date, last_date=None, tz=timezone.utc):
+    # Yields compact records oldest first. The history is walked forwards from the start of the
+    # window until the first message after it, in iter_messages calls of HISTORY_CHUNK_LIMIT like
+    # fetch_older: as many requests as fetch_messages walking it backwards, no pauses, no probes.
+    window_start, window_end = date_window(start_date, end_date, tz)
+    if last_date is not None and last_date < window_start:
+        return
+
+    offset = {'offset_date': window_start}
+    while True:
+        count = 0
+        async for message in history(client, entity, limit=HISTORY_CHUNK_LIMIT, reverse=True, **offset):
+            if message.date >= window_end:
+                return
+            offset = {'offset_id': message.id}
+            count += 1
+            if message.date >= window_start:
+                yield record_from_message(message)
+        if count < HISTORY_CHUNK_LIMIT:
+            return
+
+
+async def stream_dialog(records, user_dir, file_name, work_start, work_end, group=False, export_chat_id=None):
+    # Single pass over chronologically ordered records: the transcript is appended to and
+    # the statistics are updated message by message, nothing is kept per message.
+    # The transcript goes to <file_name>.tmp, its path is stats['transcript_file'] for the writer
+    # stage to move into place. Returns None when the dialog has no messages in the range.
+    state = new_reply_state(group)
+    format_timestamp = timestamp_formatter()
+    columns = new_message_columns() if export_chat_id is not None else None
+    file = None
+    try:
+        async for record in records:
+            if file is None:
+                os.makedirs(user_dir, exist_ok=True)
+                file = open(os.path.join(user_dir, file_name + '.tmp'), 'w', encoding='utf-8')
+            file.write(format_message(record, format_timestamp))
+            reply = update_reply_state(state, record, work_start, work_end)
+            if columns is not None:
+                add_message_row(columns, export_chat_id, record, reply)
+    except BaseException:
+        if file is not None:
+            file.close()
+            os.remove(file.name)
+        raise
+    if file is not None:
+        file.close()
+
+    if file is None:
+        return None
+    stats = finish_reply_state(state)
+    stats['transcript_file'] = file.name
+    if columns is not None:
+        stats['message_columns'] = columns
+    return stats
+
+
+def day_floor(dt):
+    return datetime.combine(dt.date(), time.min, tzinfo=dt.tzinfo)
+
+
+async def sync_messages(client, cache, session_id, entity, start_date, end_date, last_date=None):
+    # Brings the local cache of the dialog up to date for the window, the messages are then read from it.
+    # Stored day results (see write_dialog_days) of the days fetched again are dropped, unless a
+    # rechecked day still has the same messages.
+    peer_id = get_peer_id(entity)
+    window_start, window_end = date_window(start_date, end_date)
+    now = datetime.now(timezone.utc)
+    state = message_cache.get_sync_state(cache, session_id, peer_id)
+
+    if state is None or window_end < state['synced_from'] or window_start > state['synced_to']:
+        # Nothing to extend: fetch the whole window and make it the new covered range
+        messages = await fetch_messages(client, entity, start_date, end_date, last_date)
+        message_cache.drop_outside(cache, session_id, peer_id, window_start, window_end)
+        message_cache.store_messages(cache, session_id, peer_id, messages)
+        message_cache.drop_day_results(cache, session_id, peer_id, window_start, window_end)
+        max_id = max((m.id for m in messages), default=0)
+        message_cache.set_sync_state(cache, session_id, peer_id, window_start, min(window_end, now), max_id)
+        cache.commit()
+        return
+
+    synced_from, synced_to, max_id = state['synced_from'], state['synced_to'], state['max_id']
+
+    if window_start < synced_from:
+        older = await fetch_messages(client, entity, window_start, synced_from - timedelta(days=1), last_date)
+        message_cache.store_messages(cache, session_id, peer_id, older)
+        message_cache.drop_day_results(cache, session_id, peer_id, window_start, synced_from)
+        synced_from = window_start
+
+    if window_end > synced_to:
+        if CACHE_REVALIDATE_DAYS:
+            # Edits and deletions mostly happen shortly after sending, so the newest cached days are
+            # fetched again together with the new messages and anything missing there is dropped
+            recheck_from = max(synced_from, day_floor(synced_to) - timedelta(days=CACHE_REVALIDATE_DAYS))
+            newer = await fetch_messages(client, entity, recheck_from, end_date, last_date)
+            message_cache.drop_deleted(cache, session_id, peer_id, recheck_from, synced_to, {m.id for m in newer})
+            # rechecked days keep their stored results while their messages stay the same
+            rechecked = {}
+            for m in newer:
+                rechecked.setdefault(day_floor(m.date.astimezone(timezone.utc)), []).append(m)
+            stored = message_cache.load_day_digests(cache, session_id, peer_id, day_floor(recheck_from),
+                                                    day_floor(synced_to))
+            for day, digest in stored.items():
+                if message_cache.messages_digest(rechecked.get(day, [])) != digest:
+                    message_cache.drop_day_results(cache, session_id, peer_id, day, day + timedelta(days=1))
+        elif max_id and (last_date is None or last_date >= synced_to):
+            newer = [record_from_message(m) async for m in history(client, entity, min_id=max_id, offset_date=window_end)]
+        elif max_id:
+            newer = []
+        else:
+            newer = await fetch_messages(client, entity, synced_to, end_date, last_date)
+        message_cache.store_messages(cache, session_id, peer_id, newer)
+        message_cache.drop_day_results(cache, session_id, peer_id, day_floor(synced_to), window_end)
+        max_id = max([max_id] + [m.id for m in newer])
+        synced_to = min(window_end, now)
+
+    message_cache.set_sync_state(cache, session_id, peer_id, synced_from, synced_to, max_id)
+    cache.commit()
+
+
+def work_hours_key(work_start, work_end):
+    return f"{work_start.isoformat()}-{work_end.isoformat()}"
+
+
+def store_day_partials(cache, session_id, entity, start_date, end_date, work_start, work_end, partials):
+    # Days of the report window that are completely synced; today is left for the next run
+    peer_id = get_peer_id(entity)
+    window_start, window_end = date_window(start_date, end_date)
+    state = message_cache.get_sync_state(cache, session_id, peer_id)
+    if state is None:
+        return
+    complete_until = min(window_end, day_floor(state['synced_to']))
+    message_cache.store_partials(cache, session_id, peer_id, work_hours_key(work_start, work_end),
+                                 window_start, complete_until, partials)
+    cache.commit()
+
+
+def window_days(start_date, end_date):
+    window_start, window_end = date_window(start_date, end_date)
+    return [window_start + timedelta(days=i) for i in range((window_end - window_start).days)]
+
+
+def day_ranges(days):
+    # Runs of consecutive days as [from, to) ranges
+    ranges = []
+    for day in days:
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + timedelta(days=1)
+        else:
+            ranges.append([day, day + timedelta(days=1)])
+    return ranges
+
+
+def stored_day_results(cache, session_id, entity, start_date, end_date, work_start, work_end):
+    # day -> (transcript, partials) of the days an incremental report can take from the cache;
+    # a day with text messages also needs its partials for these working hours, with the reply times
+    window_start, window_end = date_window(start_date, end_date)
+    stored = message_cache.load_day_results(cache, session_id, get_peer_id(entity),
+                                            work_hours_key(work_start, work_end), window_start, window_end)
+    return {day: (transcript, partial) for day, (transcript, text_messages, partial) in stored.items()
+            if not text_messages or (partial is not None and 'working_times' in partial)}
+
+
+def store_day_results(cache, session_id, entity, start_date, end_date, work_start, work_end, results):
+    # Like store_day_partials: only the days that are completely synced
+    peer_id = get_peer_id(entity)
+    _, window_end = date_window(start_date, end_date)
+    state = message_cache.get_sync_state(cache, session_id, peer_id)
+    if state is None:
+        return
+    complete_until = min(window_end, day_floor(state['synced_to']))
+    message_cache.store_day_results(cache, session_id, peer_id, work_hours_key(work_start, work_end),
+                                    {day: result for day, result in results.items() if day < complete_until})
+    cache.commit()
+
+
+def totals_from_partials(cache, session_id, start_date, end_date, work_start, work_end, peer_ids=None):
+    # Report totals of any stored range and set of dialogs without reading a single message
+    # (library only, process_chats does not use it). Returns the totals of private chats and of
+    # groups, like the ones process_chats builds, and peer id -> days of the range without stored
+    # partials. Dialogs with missing days are left out of the totals; without peer_ids the dialogs
+    # are the ones stored for these working hours on any day of the range.
+    window_start, window_end = date_window(start_date, end_date)
+    stored = message_cache.load_partials(cache, session_id, work_hours_key(work_start, work_end),
+                                         window_start, window_end, peer_ids)
+    for peer_id in peer_ids or ():
+        stored.setdefault(peer_id, {})
+    days = window_days(start_date, end_date)
+    chat_totals, group_totals = new_totals(), new_totals()
+    missing = {}
+    for peer_id, by_day in stored.items():
+        absent = [day for day in days if day not in by_day]
+        if absent:
+            missing[peer_id] = absent
+            continue
+        partials = [partial for partial in by_day.values() if partial]
+        if not partials:
+            continue
+        group = partials[0]['group']
+        stats = merge_day_partials(partials, work_start, work_end, group)
+        add_chat_stats(group_totals if group else chat_totals, stats)
+    return chat_totals, group_totals, missing
+
+
+async def fetch_with_backoff(fetch, flood_wait):
+    # flood_wait is shared by all workers, so one FloodWait pauses the whole pool
+    loop = asyncio.get_running_loop()
+    while True:
+        delay = flood_wait['until'] - loop.time()
+        if delay > 0:
+            instrumentation.add_flood_wait(delay)
+            await asyncio.sleep(delay)
+            continue
+        try:
+            return await fetch()
+        except FloodWaitError as e:
+            flood_wait['until'] = max(flood_wait['until'], loop.time() + e.seconds)
+            print(f"FloodWait: пауза {e.seconds}с")
+
+
+async def fetch_dialogs(dialogs, fetch, concurrency=FETCH_CONCURRENCY):
+    # Sliding window of fetch tasks: at most `concurrency` dialogs are in flight
+    # (or waiting to be consumed), results are yielded in the original dialog order.
+    flood_wait = {'until': 0}
+    dialogs = iter(dialogs)
+    pending = deque()
+
+    def schedule():
+        for entity, group, last_date in dialogs:
+            task = asyncio.create_task(fetch_with_backoff(lambda: fetch(entity, group, last_date), flood_wait))
+            pending.append((entity, group, task))
+            return
+
+    for _ in range(max(concurrency, 1)):
+        schedule()
+
+    try:
+        while pending:
+            entity, group, task = pending.popleft()
+            messages = await task
+            schedule()
+            yield entity, group, messages
+    finally:
+        for _, _, task in pending:
+            task.cancel()
+
+
+def write_dialog(user_dir, file_name, messages, work_start, work_end, group=False, partials=False, export_chat_id=None,
+                 models=None, analyze_groups=False, save=True):
+    # CPU/disk stage of a fetched dialog; runs in the output executor, so it must stay picklable.
+    # Returns the statistics and the timing of the stage. models: compiled reply models, their
+    # statistics go to stats['models']; analyze_groups: group_analytics of a group in stats['group_analytics'].
+    # save=False only formats the transcript, its bytes go to stats['transcript'] for the writer stage.
+    started = perf_counter()
+    if save:
+        os.makedirs(user_dir, exist_ok=True)
+        save_messages(user_dir, file_name, messages)
+    else:
+        transcript = format_transcript(messages).encode('utf-8')
+    saved = perf_counter()
+    cpu_started = thread_time()
+    stats = calculate_time_spent(messages, work_start, work_end, group=group)
+    if partials:
+        stats['day_partials'] = day_partials(messages, work_start, work_end, group)
+    if export_chat_id is not None:
+        stats['message_columns'] = message_columns(export_chat_id, messages, work_start, work_end, group)
+    if models:
+        stats['models'] = reply_models.calculate_models(messages, models, group)
+    if analyze_groups and group:
+        stats['group_analytics'] = group_analytics.analyze_group(messages)
+    if not save:
+        stats['transcript'] = transcript
+    timing = {'interval': (started, perf_counter()), 'save_seconds': saved - started,
+              'stats_cpu_seconds': thread_time() - cpu_started}
+    return stats, timing
+
+
+def write_dialog_days(user_dir, file_name, messages, days, stored, work_start, work_end, group=False, save=True):
+    # write_dialog of an incremental report: stored holds the transcripts and partials of the days
+    # that did not change (see stored_day_results), messages are the ones of the other days. Only
+    # those are formatted and counted; the results of these days go to stats['day_results'].
+    started = perf_counter()
+    cpu_started = thread_time()
+    by_day = {}
+    for msg in messages:
+        by_day.setdefault(day_floor(msg.date.astimezone(timezone.utc)), []).append(msg)
+    partials = day_partials(messages, work_start, work_end, group)
+    computed = {day: (format_transcript(by_day.get(day, [])), partials.get(day),
+                      message_cache.messages_digest(by_day.get(day, []))) for day in days if day not in stored}
+    results = {**stored, **computed}
+    stats = merge_day_partials([results[day][1] for day in days if results[day][1]], work_start, work_end, group,
+                               exact=True)
+    stats['day_results'] = computed
+    cpu_seconds = thread_time() - cpu_started
+    saving = perf_counter()
+    transcript = ''.join([results[day][0] for day in days]).encode('utf-8')
+    if save:
+        os.makedirs(user_dir, exist_ok=True)
+        output_writer.atomic_write(os.path.join(user_dir, file_name), transcript)
+    else:
+        stats['transcript'] = transcript
+    timing = {'interval': (started, perf_counter()), 'save_seconds': perf_counter() - saving,
+              'stats_cpu_seconds': cpu_seconds}
+    return stats, timing
+
+
+def make_output_executor(offload, workers=OUTPUT_WORKERS):
+    if offload == 'process':
+        return ProcessPoolExecutor(workers)
+    if offload == 'thread':
+        return ThreadPoolExecutor(workers)
+    return None
+
+
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def busy_time(intervals):
+    return sum(end - start for start, end in merge_intervals(intervals))
+
+
+def overlap_time(first, second):
+    first, second = merge_intervals(first), merge_intervals(second)
+    total, i, j = 0, 0, 0
+    while i < len(first) and j < len(second):
+        total += max(0, min(first[i][1], second[j][1]) - max(first[i][0], second[j][0]))
+        if first[i][1] < second[j][1]:
+            i += 1
+        else:
+            j += 1
+    return total
+
+
+def print_timings(timings, wall_time, offloaded=True):
+    fetching = busy_time(timings['fetch'])
+    output = busy_time(timings['output'])
+    # Inline output blocks the event loop, pending fetches only look busy meanwhile
+    overlap = overlap_time(timings['fetch'], timings['output']) if offloaded else 0
+    print("\n=== Время выполнения ===")
+    print(f"Всего: {wall_time:.2f}с")
+    print(f"Загрузка сообщений: {fetching:.2f}с")
+    print(f"Запись и подсчёт статистики: {output:.2f}с")
+    print(f"Из них одновременно с загрузкой: {overlap:.2f}с ({overlap / output * 100 if output else 0:.0f}%)")
+
+
+def dialog_kind(entity):
+    if isinstance(entity, User):
+        return 'user'
+    if isinstance(entity, Chat):
+        return 'chat'
+    if isinstance(entity, Channel):
+        return 'megagroup' if entity.megagroup else 'channel'
+    return None
+
+
+def entity_from_dialog_row(row):
+    # Enough of the entity for the report and for iter_messages (id and access_hash),
+    # so nothing has to be resolved over the network
+    if row['kind'] == 'user':
+        return User(id=row['entity_id'], access_hash=row['access_hash'], bot=bool(row['bot']),
+                    first_name=row['first_name'], last_name=row['last_name'])
+    if row['kind'] == 'chat':
+        return Chat(id=row['entity_id'], title=row['title'], photo=None, participants_count=0, date=None, version=0)
+    return Channel(id=row['entity_id'], access_hash=row['access_hash'], title=row['title'], photo=None, date=None,
+                   megagroup=row['kind'] == 'megagroup')
+
+
+async def refresh_dialog_index(client, cache, session_id):
+    # Dialogs come newest first after the pinned ones, so enumeration stops at the first unpinned
+    # dialog older than the newest one seen last time. Once in a while the whole list is read
+    # again to drop deleted and left dialogs.
+    state = message_cache.get_dialog_index_state(cache, session_id)
+    now = datetime.now(timezone.utc)
+    if state is None or now - state['full_refresh'] >= timedelta(days=DIALOG_INDEX_FULL_REFRESH_DAYS):
+        since, full_refresh = None, now
+    else:
+        since, full_refresh = state['newest_date'], state['full_refresh']
 
-async def process_chats(client, start_date, end_date, work_start, work_end):
+    newest = since
+    rows = []
+    async for dialog in client.iter_dialogs(offset_date=datetime.now()):
+        kind = dialog_kind(dialog.entity)
+        if kind is None or dialog.date is None:
+            continue
+        if not dialog.pinned:
+            if since is not None and dialog.date < since:
+                break
+            newest = dialog.date if newest is None else max(newest, dialog.date)
+        entity = dialog.entity
+        rows.append({
+            'peer_id': get_peer_id(entity),
+            'kind': kind,
+            'entity_id': entity.id,
+            'access_hash': getattr(entity, 'access_hash', None),
+            'last_date': dialog.date,
+            'pinned': bool(dialog.pinned),
+            'bot': bool(getattr(entity, 'bot', False)),
+            'first_name': getattr(entity, 'first_name', None),
+            'last_name': getattr(entity, 'last_name', None),
+            'title': getattr(entity, 'title', None),
+        })
+
+    message_cache.store_dialogs(cache, session_id, rows, newest or full_refresh, full_refresh)
+    cache.commit()
+
+
+def dialog_folder_name(entity, group=False):
+    if group:
+        user_name = f"GROUP_{entity.title or ''}_{entity.id}"
+    else:
+        user_name = f"{entity.first_name or ''}_{entity.last_name or ''}_{entity.id}"
+    user_name = user_name.strip().replace(' ', '_').replace(os.sep, '_')
+    return sanitize_folder_name(user_name)
+
+
+def transcript_path(output_dir, entity, group=False):
+    user_name = dialog_folder_name(entity, group)
+    return os.path.join(output_dir, user_name, f'{user_name}.txt')
+
+
+async def process_chats(client, start_date, end_date, work_start, work_end, concurrency=FETCH_CONCURRENCY,
+                        cache=None, session_id=None, stream=False, output_root='.', verbose=True,
+                        offload='thread', report_timings=False, trace=None, trace_top=None, profile=None,
+                        trace_memory=False, export_format=None, models=None, shards=None, make_client=None,
+                        analyze_groups=False, incremental=False, diff=False, archive=None):
+    # offload: 'thread', 'process' or None; where transcripts are written and statistics computed
+    # while the event loop keeps fetching. Streaming mode always works inline.
+    # trace: .json/.csv path for per-dialog timings (also STATS_TRACE), the trace_top slowest dialogs
+    # are printed; profile: cProfile output path, trace_memory: tracemalloc (see instrumentation)
+    # export_format: 'csv', 'parquet' or 'auto' also writes raw per-message and per-chat numbers
+    # models: reply models (see reply_models) computed next to the report and written to
+    # <name>_models_<dates>.txt; not available in streaming mode
+    # analyze_groups: threads, participants and reply attribution of every group (see group_analytics)
+    # in <name>_group_analytics_<dates>.txt; not available in streaming mode either
+    # incremental: with the cache, days whose messages did not change since an earlier report take
+    # their transcript and statistics from the cache, only the other days are read and counted.
+    # Plain reports only: streaming, shards, models, exports and group analytics need every message.
+    # diff: also <name>_report_<dates>.json, and the changes since the previous one (see report_diff)
+    # Finished dialogs are recorded in a journal in the output directory (see checkpoint); an
+    # interrupted run started again with the same parameters continues where it stopped. The
+    # transcripts of an interrupted archive are unpacked into the messages folder for it.
+    # shards: worker processes that fetch and write the dialogs, each with its own client from
+    # make_client() (picklable, see sharding); the cache then only serves the dialog list and
+    # stores day partials. Not combined with streaming mode or traces.
+    # Transcripts are written by the writer stage (see output_writer) in dialog order; archive: 'zip',
+    # 'tar.gz' or 'tar.zst' puts them into <messages folder>.<archive> instead of the folder.
+    profiling = instrumentation.start_profiling(profile, trace_memory)
+    trace = instrumentation.trace_path(trace)
+    traces = []
+    run_started = perf_counter()
     me = await client.get_me()
     start_date = datetime(start_date.year, start_date.month, start_date.day)
     end_date = datetime(end_date.year, end_date.month, end_date.day)
     date_start_str = start_date.strftime('%Y-%m-%d')
     date_end_str = end_date.strftime('%Y-%m-%d')
 
-    output_dir = f'{sanitize_folder_name(me.first_name)}_messages_{date_start_str}_{date_end_str}'
+    output_dir = os.path.join(output_root, f'{sanitize_folder_name(me.first_name)}_messages_{date_start_str}_{date_end_str}')
+    archive_path = output_writer.archive_path(output_dir, archive) if archive else None
     os.makedirs(output_dir, exist_ok=True)
 
     processed_chats, processed_groups = 0, 0
 
-    total_typing_time, total_group_typing_time = 0, 0
-    total_reading_time, total_group_reading_time = 0, 0
-    total_incoming_messages, total_group_incoming_messages = 0, 0
-    total_outgoing_messages, total_group_outgoing_messages = 0, 0
-    total_incoming_symbols, total_group_incoming_symbols = 0, 0
-    total_outgoing_symbols, total_group_outgoing_symbols = 0, 0
-    total_work_reply_times, total_group_work_reply_times = [], []
-    total_night_reply_times, total_group_night_reply_times = [], []
-    total_messages_without_reply, total_group_without_reply = 0, 0
+    chat_totals, group_totals = new_totals(), new_totals()
+    exports = None
+    if export_format:
+        exports = export.open_export(output_root, f'{sanitize_folder_name(me.first_name)}_{date_start_str}_{date_end_str}',
+                                     export_format)
 
     chat_stats_list = []
     groups_stats_list = []
 
-    async for dialog in client.iter_dialogs(offset_date=datetime.now()):
-        if dialog.date.date() < start_date.date():
-            break
-
-        entity = dialog.entity
-
+    if models and not stream:
+        # calendars are compiled once for the dates of the report
+        models = [reply_models.compile_model(model, start_date.date(), end_date.date()) for model in models]
+        model_totals = {model['name']: (new_totals(), new_totals()) for model in models}
+    else:
+        models = None
+    analyze_groups = analyze_groups and not stream
+    group_analytics_list = []
+    incremental = (incremental and cache is not None and not stream and not shards and not models
+                   and exports is None and not analyze_groups)
+    days = window_days(start_date, end_date)
+    report_chats = []
+
+    journal = checkpoint.open_journal(output_dir, {
+        'work_hours': work_hours_key(work_start, work_end),
+        'stream': stream,
+        'export_format': export_format,
+        'models': [model['name'] for model in models] if models else None,
+        'group_analytics': analyze_groups,
+        'incremental': incremental,
+        'archive': archive,
+    })
+    if journal['done'] and verbose:
+        print(f"Продолжаю прерванный запуск: готово диалогов {len(journal['done'])}")
+    completed = False
+
+    if cache is not None:
+        await refresh_dialog_index(client, cache, session_id)
+        window_start, _ = date_window(start_date, end_date)
+        candidates = [(entity_from_dialog_row(row), row['last_date'])
+                      for row in message_cache.load_dialogs(cache, session_id, window_start)]
+    else:
+        candidates = []
+        async for dialog in client.iter_dialogs(offset_date=datetime.now()):
+            if dialog.date.date() < start_date.date():
+                # pinned dialogs come first whatever their date
+                if dialog.pinned:
+                    continue
+                break
+            candidates.append((dialog.entity, dialog.date))
+
+    dialogs = []
+    for entity, last_date in candidates:
         if isinstance(entity, User) and not entity.bot and entity.id != me.id and entity.id != 777000:
             processed_chats += 1
-            messages = await fetch_messages(client, entity, start_date, end_date)
-
-            if messages:
-                user_name = f"{entity.first_name or ''}_{entity.last_name or ''}_{entity.id}"
-                user_name = user_name.strip().replace(' ', '_').replace(os.sep, '_')
-                user_dir = os.path.join(output_dir, sanitize_folder_name(user_name))
-                os.makedirs(user_dir, exist_ok=True)
-                print(f"Получаю чат с {entity.first_name} {entity.last_name or ''}")
-
-                save_messages(user_dir, f'{sanitize_folder_name(user_name)}.txt', messages)
-                stats = calculate_time_spent(messages, work_start, work_end)
+            dialogs.append((entity, False, last_date))
+        elif isinstance(entity, Chat) or (isinstance(entity, Channel) and entity.megagroup):
+            processed_groups += 1
+            dialogs.append((entity, True, last_date))
+
+    loop = asyncio.get_running_loop()
+    executor = None if stream or shards else make_output_executor(offload)
+    timings = {'fetch': [], 'output': []}
+    writer = output_writer.open_writer(output_root, archive_path, archive)
+
+    def keep_result(entity, user_name, user_dir, stats):
+        # the transcript is not part of the journal, it is returned for the writer stage
+        transcript = stats.pop('transcript', None)
+        if 'day_results' in stats:
+            store_day_results(cache, session_id, entity, start_date, end_date, work_start, work_end,
+                              stats.pop('day_results'))
+        elif cache is not None:
+            store_day_partials(cache, session_id, entity, start_date, end_date, work_start, work_end,
+                               stats.pop('day_partials'))
+        checkpoint.record_dialog(journal, get_peer_id(entity), stats)
+        return user_name, user_dir, stats, transcript
+
+    def resumed_stats(entity, group):
+        # Statistics of a dialog finished by an interrupted run, None if it has to be processed.
+        # The journal has no export rows: they are derived again from the cached messages, without
+        # them (no cache, or shards, which do not store messages) the dialog is fetched again.
+        stats = checkpoint.finished_dialog(journal, get_peer_id(entity), transcript_path(output_dir, entity, group))
+        if stats is None or exports is None:
+            return stats
+        if cache is None or shards:
+            return None
+        window_start, window_end = date_window(start_date, end_date)
+        messages = message_cache.load_messages(cache, session_id, get_peer_id(entity), window_start, window_end)
+        if stream:
+            # stream_dialog saw them oldest first, messages of the same second in id order
+            messages.reverse()
+        stats['message_columns'] = message_columns(get_peer_id(entity), messages, work_start, work_end, group)
+        return stats
+
+    async def handle_dialog(entity, group, last_date):
+        # Fetches the dialog and formats its transcript for the writer stage; returns None for dialogs
+        # without messages
+        user_name = dialog_folder_name(entity, group)
+        user_dir = os.path.join(output_dir, user_name)
+        window_start, window_end = date_window(start_date, end_date)
+        export_chat_id = get_peer_id(entity) if exports is not None else None
+        stats = resumed_stats(entity, group)
+        if stats is not None:
+            return user_name, user_dir, stats, None
+        if shard_results is not None:
+            stats = await shard_results[get_peer_id(entity)]
+            if stats is None:
+                if cache is not None:
+                    store_day_partials(cache, session_id, entity, start_date, end_date, work_start, work_end, {})
+                return None
+            return keep_result(entity, user_name, user_dir, stats)
+        dialog_trace = instrumentation.DIALOG_TRACE.get()
+        if trace and dialog_trace is None:
+            # a retry after FloodWait runs in the same task and keeps counting into the same trace
+            dialog_trace = instrumentation.new_dialog_trace(user_name, group)
+            instrumentation.DIALOG_TRACE.set(dialog_trace)
+            traces.append(dialog_trace)
+        fetch_started = perf_counter()
+
+        if cache is not None:
+            await sync_messages(client, cache, session_id, entity, start_date, end_date, last_date)
+
+        if stream:
+            if cache is not None:
+                records = message_cache.iter_messages(cache, session_id, get_peer_id(entity), window_start, window_end)
+            else:
+                records = stream_messages(client, entity, start_date, end_date, last_date)
+            stats = await stream_dialog(records, user_dir, f'{user_name}.txt', work_start, work_end, group,
+                                        export_chat_id)
+            transcript = None
+            if stats is not None:
+                transcript = stats.pop('transcript_file')
+                checkpoint.record_dialog(journal, get_peer_id(entity), stats)
+            if dialog_trace is not None:
+                dialog_trace['fetch_seconds'] = perf_counter() - fetch_started
+                dialog_trace['messages'] = stats['incoming_messages'] + stats['outgoing_messages'] if stats else 0
+                instrumentation.finish_dialog_trace(dialog_trace)
+            if stats is None:
+                return None
+            return user_name, user_dir, stats, transcript
+
+        stored = {}
+        if incremental:
+            # only the days without stored results are read from the cache
+            stored = stored_day_results(cache, session_id, entity, start_date, end_date, work_start, work_end)
+            messages = []
+            for date_from, date_to in day_ranges([day for day in days if day not in stored]):
+                messages += message_cache.load_messages(cache, session_id, get_peer_id(entity), date_from, date_to)
+        elif cache is not None:
+            messages = message_cache.load_messages(cache, session_id, get_peer_id(entity), window_start, window_end)
+        else:
+            messages = await fetch_messages(client, entity, start_date, end_date, last_date)
+        timings['fetch'].append((fetch_started, perf_counter()))
+        if dialog_trace is not None:
+            dialog_trace['fetch_seconds'] = timings['fetch'][-1][1] - fetch_started
+            dialog_trace['messages'] = len(messages)
+        if not messages and not any(transcript for transcript, _ in stored.values()):
+            if incremental:
+                store_day_results(cache, session_id, entity, start_date, end_date, work_start, work_end,
+                                  {day: ('', None, message_cache.messages_digest([])) for day in days
+                                   if day not in stored})
+            elif cache is not None:
+                store_day_partials(cache, session_id, entity, start_date, end_date, work_start, work_end, {})
+            if dialog_trace is not None:
+                instrumentation.finish_dialog_trace(dialog_trace)
+            return None
+
+        if incremental:
+            write = write_dialog_days
+            args = (user_dir, f'{user_name}.txt', messages, days, stored, work_start, work_end, group, False)
+        else:
+            write = write_dialog
+            args = (user_dir, f'{user_name}.txt', messages, work_start, work_end, group, cache is not None,
+                    export_chat_id, models, analyze_groups, False)
+        if executor is None:
+            stats, timing = write(*args)
+        else:
+            stats, timing = await loop.run_in_executor(executor, write, *args)
+        timings['output'].append(timing['interval'])
+        if dialog_trace is not None:
+            dialog_trace['save_seconds'] = timing['save_seconds']
+            dialog_trace['stats_cpu_seconds'] = timing['stats_cpu_seconds']
+            instrumentation.finish_dialog_trace(dialog_trace)
+        return keep_result(entity, user_name, user_dir, stats)
+
+    shard_results = pool = None
+    if shards:
+        # dialogs finished by an interrupted run are not sent to the workers
+        pending = [(entity, group, last_date) for entity, group, last_date in dialogs
+                   if resumed_stats(entity, group) is None]
+        pool = sharding.start_shards(make_client, pending, shards, output_dir, start_date, end_date, work_start,
+                                     work_end, concurrency, cache is not None, exports is not None, models,
+                                     analyze_groups)
+        shard_results = {get_peer_id(entity): loop.create_future() for entity, _, _ in pending}
+        collector = asyncio.create_task(sharding.collect_results(pool, shard_results))
+
+    try:
+        async for entity, group, result in fetch_dialogs(dialogs, handle_dialog, concurrency):
+            if result is None:
+                continue
+
+            user_name, user_dir, stats, transcript = result
+            transcript_name = os.path.relpath(transcript_path(output_dir, entity, group), output_root)
+            if transcript is None and archive:
+                # written by a shard or by an interrupted run, it goes into the archive too
+                transcript = transcript_path(output_dir, entity, group)
+            if isinstance(transcript, bytes):
+                await output_writer.write_file(writer, transcript_name, transcript)
+            elif transcript is not None:
+                await output_writer.move_file(writer, transcript_name, transcript)
+            if models:
+                for model_name, model_stats in stats.pop('models').items():
+                    add_chat_stats(model_totals[model_name][1 if group else 0], model_stats)
+                    if 'media_time' in model_stats:
+                        add_media_stats(model_totals[model_name][1 if group else 0], model_stats)
+            chat_name = entity.title or '' if group else f"{entity.first_name} {entity.last_name or ''}".strip()
+            if exports is not None:
+                # message rows in dialog order, whichever dialog finished first
+                exports['messages'].add(stats.pop('message_columns'))
+                exports['chats'].add(chat_row(me.id, get_peer_id(entity), chat_name, group, stats, start_date, end_date))
+            if diff:
+                report_chats.append({key: values[0] for key, values in
+                                     chat_row(me.id, get_peer_id(entity), chat_name, group, stats, start_date,
+                                              end_date).items()})
+            if not group:
+                if verbose:
+                    print(f"Получаю чат с {entity.first_name} {entity.last_name or ''}")
 
                 # FOR TESTING PURPOSES
                 # with open(os.path.join('chat_statistics_ny.txt'), 'a', encoding='utf-8') as f:
@@ -240,15 +1280,7 @@ async def process_chats(client, start_date, end_date, work_start, work_end):
                 #
                 #     f.write("\n\n")
 
-                total_typing_time += stats['typing_time']
-                total_reading_time += stats['reading_time']
-                total_incoming_messages += stats['incoming_messages']
-                total_outgoing_messages += stats['outgoing_messages']
-                total_incoming_symbols += stats['incoming_symbols']
-                total_outgoing_symbols += stats['outgoing_symbols']
-                total_work_reply_times.extend(stats['working_reply_times'])
-                total_night_reply_times.extend(stats['night_reply_times'])
-                total_messages_without_reply += stats['messages_without_reply']
+                add_chat_stats(chat_totals, stats)
 
                 # Prepare chat statistics for writing to file
                 chat_stats = {
@@ -268,24 +1300,14 @@ async def process_chats(client, start_date, end_date, work_start, work_end):
 
                 if stats['messages_without_reply'] > 0:
                     unanswered_dir = os.path.join(output_dir, '!!!!!UNANSWERED')
-                    os.makedirs(unanswered_dir, exist_ok=True)
-                    dest_chat_dir = os.path.join(unanswered_dir, sanitize_folder_name(user_name))
-                    # Copy the entire chat directory
-                    shutil.copytree(user_dir, dest_chat_dir, dirs_exist_ok=True)
-
-        elif isinstance(entity, Chat) or (isinstance(entity, Channel) and entity.megagroup):
-            processed_groups += 1
-            messages = await fetch_messages(client, entity, start_date, end_date)
+                    dest_chat_dir = os.path.join(unanswered_dir, user_name)
+                    # Link the chat directory instead of writing the transcript a second time
+                    await output_writer.copy_tree(writer, os.path.relpath(user_dir, output_root),
+                                                  os.path.relpath(dest_chat_dir, output_root))
 
-            if messages:
-                user_name = f"GROUP_{entity.title or ''}_{entity.id}"
-                user_name = user_name.strip().replace(' ', '_').replace(os.sep, '_')
-                user_dir = os.path.join(output_dir, sanitize_folder_name(user_name))
-                os.makedirs(user_dir, exist_ok=True)
-                print(f"Получаю чат с {entity.title}")
-
-                save_messages(user_dir, f'{sanitize_folder_name(user_name)}.txt', messages)
-                stats = calculate_time_spent(messages, work_start, work_end, group=True)
+            else:
+                if verbose:
+                    print(f"Получаю чат с {entity.title}")
 
                 # FOR TESTING PURPOSES
                 # with open(os.path.join('chat_statistics_ny.txt'), 'a', encoding='utf-8') as f:
@@ -297,16 +1319,9 @@ async def process_chats(client, start_date, end_date, work_start, work_end):
                 #
                 #     f.write("\n\n")
 
-                total_group_typing_time += stats['typing_time']
-                total_group_reading_time += stats['reading_time']
-                total_group_incoming_messages += stats['incoming_messages']
-                total_group_outgoing_messages += stats['outgoing_messages']
-                total_group_incoming_symbols += stats['incoming_symbols']
-                total_group_outgoing_symbols += stats['outgoing_symbols']
-                total_group_work_reply_times.extend(stats['working_reply_times'])
-                total_group_night_reply_times.extend(stats['night_reply_times'])
-                total_messages_without_reply += stats['messages_without_reply']
-                total_group_without_reply += stats['messages_without_reply']
+                add_chat_stats(group_totals, stats)
+                if analyze_groups:
+                    group_analytics_list.append((entity.title or '', stats.pop('group_analytics')))
 
                 group_chat_stats = {
                     'chat_name': f"{entity.title or ''}".strip(),
@@ -322,55 +1337,185 @@ async def process_chats(client, start_date, end_date, work_start, work_end):
                 }
 
                 groups_stats_list.append(group_chat_stats)
+        completed = True
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if exports is not None:
+            export.close_export(exports)
+        if pool is not None:
+            collector.cancel()
+            sharding.stop_shards(pool, shard_results)
+        try:
+            # the queued transcripts are written before the journal says the report is done
+            await output_writer.close_writer(writer, completed)
+        except Exception:
+            completed = False
+            raise
+        finally:
+            checkpoint.close_journal(journal, completed)
+    timings['output'] += writer['intervals']
+    if archive and completed:
+        # only the folders of shard and streamed transcripts are left, empty
+        output_writer.remove_empty_dirs(output_dir)
+
+    write_chat_statistics(chat_stats_list, filename=os.path.join(output_root, f'{sanitize_folder_name(me.first_name)}_statistics_{date_start_str}_{date_end_str}.txt'))
+    write_chat_statistics(groups_stats_list, filename=os.path.join(output_root, f'{sanitize_folder_name(me.first_name)}_GROUP_statistics_{date_start_str}_{date_end_str}.txt'))
+
+    summary = make_summary(f"{me.first_name} {me.last_name or ''}".strip(), processed_chats, processed_groups,
+                           chat_totals, group_totals)
+    if models:
+        write_model_statistics(summary, model_totals, filename=os.path.join(
+            output_root, f'{sanitize_folder_name(me.first_name)}_models_{date_start_str}_{date_end_str}.txt'))
+    changes = None
+    if diff:
+        report = report_diff.new_report(me.id, summary, start_date, end_date, work_hours_key(work_start, work_end),
+                                        report_chats)
+        changes = report_diff.write_report(output_root, sanitize_folder_name(me.first_name), report)
+    if analyze_groups:
+        write_group_analytics(group_analytics_list, filename=os.path.join(
+            output_root, f'{sanitize_folder_name(me.first_name)}_group_analytics_{date_start_str}_{date_end_str}.txt'))
+
+    if verbose:
+        print_summary(summary)
+        if changes is not None:
+            report_diff.print_changes(changes)
+    if report_timings:
+        print_timings(timings, perf_counter() - run_started, offloaded=executor is not None)
+    if trace:
+        instrumentation.write_trace(traces, trace)
+        instrumentation.print_slowest(traces, trace_top)
+    instrumentation.stop_profiling(profiling)
+
+    return summary
+
+
+def make_summary(name, chats, groups, chat_totals, group_totals):
+    summary = {'name': name, 'chats': chats}
+    summary.update(chat_totals)
+    summary['messages_without_reply'] += group_totals['messages_without_reply']
+    summary['groups'] = groups
+    for key, value in group_totals.items():
+        if key == 'messages_without_reply':
+            summary['group_without_reply'] = value
+        else:
+            summary[f'group_{key}'] = value
+    return summary
+
+
+def average_reply_formatted(reply_times):
+    if reply_times:
+        return format_duration(reply_times.mean())
+    return "N/A"
+
+
+def print_summary(summary):
+    print("\n=== Общая статистика ===")
+    print(f"Всего чатов: {summary['chats']}")
+    print(f"Всего времени на печать: {format_time(summary['typing_time'])}")
+    print(f"Всего времени на прочтение: {format_time(summary['reading_time'])}")
+    print(f"Исходящих сообщений: {summary['outgoing_messages']}")
+    print(f"Входящих сообщений: {summary['incoming_messages']}")
+    print(f"Написано символов: {summary['outgoing_symbols']}")
+    print(f"Получено символов: {summary['incoming_symbols']}")
+    print(f"Среднее время ответа в рабочее время (по всех чатах): {average_reply_formatted(summary['work_reply_times'])}")
+    print(f"Среднее время ответа в нерабочее время (по всех чатах): {average_reply_formatted(summary['night_reply_times'])}")
+    print(f"Сообщений без ответа: {summary['messages_without_reply']}")
 
-    write_chat_statistics(chat_stats_list, filename=f'{sanitize_folder_name(me.first_name)}_statistics_{date_start_str}_{date_end_str}.txt')
-    write_chat_statistics(groups_stats_list, filename=f'{sanitize_folder_name(me.first_name)}_GROUP_statistics_{date_start_str}_{date_end_str}.txt')
 
-    if total_work_reply_times:
-        overall_work_reply_time = sum(total_work_reply_times) / len(total_work_reply_times)
-        overall_work_reply_time_formatted = format_duration(overall_work_reply_time)
-    else:
-        overall_work_reply_time_formatted = "N/A"
+    print("\n\n=== Общая статистика по группам ===")
+    print(f"Всего групп: {summary['groups']}")
+    print(f"Всего времени на печать: {format_time(summary['group_typing_time'])}")
+    print(f"Всего времени на прочтение: {format_time(summary['group_reading_time'])}")
+    print(f"Исходящих сообщений: {summary['group_outgoing_messages']}")
+    print(f"Входящих сообщений: {summary['group_incoming_messages']}")
+    print(f"Написано символов: {summary['group_outgoing_symbols']}")
+    print(f"Получено символов: {summary['group_incoming_symbols']}")
+    print(f"Среднее время ответа в рабочее время (по всем группам): {average_reply_formatted(summary['group_work_reply_times'])}")
+    print(f"Среднее время ответа в нерабочее время (по всем группам): {average_reply_formatted(summary['group_night_reply_times'])}")
+    print(f"Чатов без ответа: {summary['group_without_reply']}")
+
+
+def merge_summaries(summaries):
+    # Team totals: counters are added up, reply times merged so the averages stay per reply
+    team = {}
+    for summary in summaries:
+        team = merge_totals(team, {key: value for key, value in summary.items() if key != 'name'})
+    return team
+
+
+def write_summary_block(f, title, summary):
+    f.write(f"{title}:\n")
+    f.write(f"   Чатов: {summary.get('chats', 0)}\n")
+    f.write(f"   Групп: {summary.get('groups', 0)}\n")
+    f.write(f"   Времени на печать: {format_time(summary.get('typing_time', 0))}\n")
+    f.write(f"   Времени на прочтение: {format_time(summary.get('reading_time', 0))}\n")
+    f.write(f"   Исходящие: {summary.get('outgoing_messages', 0)}\n")
+    f.write(f"   Входящие: {summary.get('incoming_messages', 0)}\n")
+    f.write(f"   Написано символов: {summary.get('outgoing_symbols', 0)}\n")
+    f.write(f"   Получено символов: {summary.get('incoming_symbols', 0)}\n")
+    f.write(f"   Среднее время ответа (рабочее время): {average_reply_formatted(summary.get('work_reply_times'))}\n")
+    f.write(f"   Среднее время ответа (нерабочее время): {average_reply_formatted(summary.get('night_reply_times'))}\n")
+    f.write(f"   Сообщений без ответа: {summary.get('messages_without_reply', 0)}\n")
+    f.write(f"   Среднее время ответа в группах (рабочее время): {average_reply_formatted(summary.get('group_work_reply_times'))}\n")
+    f.write(f"   Среднее время ответа в группах (нерабочее время): {average_reply_formatted(summary.get('group_night_reply_times'))}\n")
+    f.write(f"   Групп без ответа: {summary.get('group_without_reply', 0)}\n")
+    f.write("\n")
+
+
+def write_model_statistics(summary, model_totals, filename):
+    # The report once per reply model, so the models can be compared on the same messages
+    with output_writer.atomic_open(filename) as f:
+        for model_name, (chat_totals, group_totals) in model_totals.items():
+            model_summary = make_summary(summary['name'], summary['chats'], summary['groups'], chat_totals, group_totals)
+            write_summary_block(f, f"Модель {model_name}", model_summary)
+            if 'media_time' not in chat_totals and 'media_time' not in group_totals:
+                continue
+            f.write(f"Модель {model_name}, медиа:\n")
+            for title, totals in (("чаты", chat_totals), ("группы", group_totals)):
+                media = ', '.join(f"{MEDIA_LABELS[kind]} {count}" for kind, count in
+                                  sorted(totals.get('media_messages', {}).items(), key=lambda item: -item[1]))
+                f.write(f"   Медиа ({title}): {media or 'нет'}\n")
+                f.write(f"   Время на запись и отправку ({title}): {format_time(totals.get('media_time', 0))}\n")
+                f.write(f"   Время на просмотр и прослушивание ({title}): {format_time(totals.get('viewing_time', 0))}\n")
+            f.write("\n")
 
-    if total_night_reply_times:
-        overall_night_reply_time = sum(total_night_reply_times) / len(total_night_reply_times)
-        overall_night_reply_time_formatted = format_duration(overall_night_reply_time)
-    else:
-        overall_night_reply_time_formatted = "N/A"
 
-    print("\n=== Общая статистика ===")
-    print(f"Всего чатов: {processed_chats}")
-    print(f"Всего времени на печать: {format_time(total_typing_time)}")
-    print(f"Всего времени на прочтение: {format_time(total_reading_time)}")
-    print(f"Исходящих сообщений: {total_outgoing_messages}")
-    print(f"Входящих сообщений: {total_incoming_messages}")
-    print(f"Написано символов: {total_outgoing_symbols}")
-    print(f"Получено символов: {total_incoming_symbols}")
-    print(f"Среднее время ответа в рабочее время (по всех чатах): {overall_work_reply_time_formatted}")
-    print(f"Среднее время ответа в нерабочее время (по всех чатах): {overall_night_reply_time_formatted}")
-    print(f"Сообщений без ответа: {total_messages_without_reply}")
-
-
-    if total_group_work_reply_times:
-        overall_group_work_reply_time = sum(total_group_work_reply_times) / len(total_group_work_reply_times)
-        overall_group_work_reply_time_formatted = format_duration(overall_group_work_reply_time)
-    else:
-        overall_group_work_reply_time_formatted = "N/A"
+def average_seconds_formatted(seconds, count):
+    return format_duration(seconds / count) if count else "N/A"
+
+
+def write_group_analytics(groups, filename, top=GROUP_PARTICIPANTS_SHOWN):
+    # Per group: threads, my replies by what they answered, the `top` busiest participants
+    with output_writer.atomic_open(filename) as f:
+        for title, analytics in groups:
+            attributed = analytics['attributed']
+            f.write(f"Группа {title}:\n")
+            f.write(f"   Сообщений: {analytics['messages']}, участников: {len(analytics['participants'])}\n")
+            f.write(f"   Веток: {analytics['threads']}, с моим участием: {analytics['my_threads']}\n")
+            f.write(f"   Среднее время ответа в ветках: "
+                    f"{average_seconds_formatted(analytics['thread_reply_seconds'], analytics['thread_replies'])}\n")
+            f.write(f"   Мои ответы: {analytics['my_replies']} (ответом на сообщение {attributed['reply']}, "
+                    f"на упоминание {attributed['mention']}, на последнее сообщение {attributed['last']})\n")
+            f.write(f"   Мое среднее время ответа: "
+                    f"{average_seconds_formatted(analytics['my_reply_seconds'], analytics['my_replies'])}\n")
+            f.write(f"   Упоминания без ответа: {analytics['unanswered_mentions']}\n")
+            participants = analytics['participants']
+            if participants:
+                f.write(f"   Участники (самые активные {min(top, len(participants))} из {len(participants)}):\n")
+            for participant in participants[:top]:
+                f.write(f"      id {participant['sender_id']}: сообщений {participant['messages']}, "
+                        f"символов {participant['symbols']}, упоминаний {participant['mentions']}, "
+                        f"мои ответы {participant['my_replies']} ("
+                        f"{average_seconds_formatted(participant['my_reply_seconds'], participant['my_replies'])}), "
+                        f"ответы мне {participant['replies_to_me']} ("
+                        f"{average_seconds_formatted(participant['their_reply_seconds'], participant['replies_to_me'])}), "
+                        f"без ответа {participant['unanswered']}\n")
+            f.write("\n")
 
-    if total_group_night_reply_times:
-        overall_group_night_reply_time = sum(total_group_night_reply_times) / len(total_group_night_reply_times)
-        overall_group_night_reply_time_formatted = format_duration(overall_group_night_reply_time)
-    else:
-        overall_group_night_reply_time_formatted = "N/A"
 
-    print("\n\n=== Общая статистика по группам ===")
-    print(f"Всего групп: {processed_groups}")
-    print(f"Всего времени на печать: {format_time(total_group_typing_time)}")
-    print(f"Всего времени на прочтение: {format_time(total_group_reading_time)}")
-    print(f"Исходящих сообщений: {total_group_outgoing_messages}")
-    print(f"Входящих сообщений: {total_group_incoming_messages}")
-    print(f"Написано символов: {total_group_outgoing_symbols}")
-    print(f"Получено символов: {total_group_incoming_symbols}")
-    print(f"Среднее время ответа в рабочее время (по всем группам): {overall_group_work_reply_time_formatted}")
-    print(f"Среднее время ответа в нерабочее время (по всем группам): {overall_group_night_reply_time_formatted}")
-    print(f"Чатов без ответа: {total_group_without_reply}")
+def write_team_statistics(summaries, filename='team_statistics.txt'):
+    with output_writer.atomic_open(filename) as f:
+        for summary in summaries:
+            write_summary_block(f, f"Акаунт {summary['name']}", summary)
+        write_summary_block(f, f"Вся команда ({len(summaries)} акаунтов)", merge_summaries(summaries))
@@ -0,0 +1,97 @@
+import io
+import os
+import json
+import asyncio
+import contextlib
+from datetime import date, time
+
+import pytest
+
+import checkpoint
+import output_writer
+import reply_models
+import stats_tracker
+from benchmark import InterruptedClient, archive_files, run_report, snapshot_tree
+from fake_telegram import FakeTelegramClient, make_workload
+
+# A run interrupted halfway and started again against an uninterrupted run: the same files and
+# the same report, with only the dialogs the first run did not finish fetched again
+
+START, END = date(2024, 3, 4), date(2024, 3, 6)
+OPTIONS = {
+    'plain': {},
+    'models': {'models': reply_models.preset_models(['legacy', 'everyday'], time(9), time(18))},
+}
+
+
+@pytest.fixture(scope='module')
+def workload():
+    return make_workload(dms=20, groups=4, days=3, seed=0)
+
+
+def report(client, output_root, **options):
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        asyncio.run(stats_tracker.process_chats(client, START, END, time(9), time(18), output_root=output_root,
+                                                **options))
+    return ''.join(line for line in stdout.getvalue().splitlines(keepends=True) if not line.startswith('Продолжаю'))
+
+
+def interrupt(workload, output_root, **options):
+    # Returns the journal the interrupted run left behind
+    client = InterruptedClient(*workload, fail_after=len(workload[1]) // 2)
+    with pytest.raises(ConnectionError):
+        report(client, output_root, **options)
+    [journal] = [os.path.join(root, name) for root, _, names in os.walk(output_root) for name in names
+                 if name == checkpoint.JOURNAL_NAME]
+    with open(journal, encoding='utf-8') as f:
+        return [json.loads(line) for line in f.read().splitlines()[1:]]
+
+
+@pytest.mark.parametrize('name', OPTIONS)
+def test_resumed_same_as_uninterrupted(workload, tmp_path, name):
+    options = OPTIONS[name]
+    clean = run_report(workload, 0, 8, START, END, time(9), time(18), **options)
+
+    entries = interrupt(workload, str(tmp_path), **options)
+    assert entries
+    client = FakeTelegramClient(*workload)
+    output = report(client, str(tmp_path), **options)
+
+    assert snapshot_tree(tmp_path) == clean[2]
+    assert output == clean[3]
+    assert client.api_calls < clean[1]
+
+
+def test_journal_keeps_no_reply_lists(workload, tmp_path):
+    # The reply times of a dialog and of its models are journaled as sketches of constant size
+    for entry in interrupt(workload, str(tmp_path), **OPTIONS['models']):
+        stats = entry['stats']
+        for model_stats in [stats] + list(stats['models'].values()):
+            for key in checkpoint.REPLY_TIMES:
+                assert set(model_stats[key]) == {'count', 'total', 'zeros', 'buckets'}
+
+
+def unpacked(files, archive, tmp_path):
+    # The files of a report with the archive replaced by its members
+    [name] = [name for name in files if name.endswith(archive)]
+    path = tmp_path / f'unpacked.{archive}'
+    path.write_bytes(files[name])
+    return {**{n: data for n, data in files.items() if n != name},
+            **{(name, member): data for member, data in archive_files(str(path)).items()}}
+
+
+@pytest.mark.parametrize('archive', output_writer.available_archive_formats())
+def test_resumed_archive(workload, tmp_path, archive):
+    # The interrupted archive is thrown away, its transcripts wait in the messages folder
+    clean = run_report(workload, 0, 8, START, END, time(9), time(18), archive=archive)
+
+    output_root = tmp_path / 'report'
+    assert interrupt(workload, str(output_root), archive=archive)
+    assert not [name for name in os.listdir(output_root) if name.endswith(archive + '.tmp')]
+    client = FakeTelegramClient(*workload)
+    output = report(client, str(output_root), archive=archive)
+
+    assert unpacked(snapshot_tree(output_root), archive, tmp_path) == unpacked(clean[2], archive, tmp_path)
+    assert output == clean[3]
+    assert client.api_calls < clean[1]
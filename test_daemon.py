@@ -0,0 +1,35 @@
+import io
+import asyncio
+import contextlib
+from datetime import datetime, time, timedelta, timezone
+
+import stats_tracker
+from benchmark import replay_day
+from fake_telegram import FakeTelegramClient, make_workload
+
+# The last 24 hours, half of them delivered as NewMessage events, against a one-day report.
+# Events arrive in id order like in streaming mode, so that is the report to compare with.
+
+
+def test_live_same_as_report(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'stored_sessions').mkdir()
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    today = now.replace(hour=0, minute=0, second=0)
+    me, dialogs, messages = make_workload(dms=20, groups=4, days=1, seed=0, start=now - timedelta(days=1))
+    with contextlib.redirect_stdout(io.StringIO()):
+        report, _, _ = asyncio.run(replay_day(me, dialogs, messages, 0.5, 3600))
+        # A restart picks up the snapshot and fetches only dialogs changed since it was saved
+        restarted, _, _ = asyncio.run(replay_day(me, dialogs, messages, 0.0, 3600))
+        summary = asyncio.run(stats_tracker.process_chats(FakeTelegramClient(me, dialogs, messages), today, today,
+                                                          time(9), time(18), verbose=False, stream=True))
+
+    live = report['summary']
+    for key in ('incoming_messages', 'outgoing_messages', 'incoming_symbols', 'outgoing_symbols',
+                'messages_without_reply', 'group_incoming_messages', 'group_without_reply'):
+        assert live[key] == summary[key], key
+    for key in ('work_reply_times', 'night_reply_times', 'group_work_reply_times', 'group_night_reply_times'):
+        assert live[key]['count'] == summary[key].count
+        if summary[key].count:
+            assert abs(live[key]['mean'] - summary[key].mean()) < 1e-6
+    assert restarted['summary'] == live
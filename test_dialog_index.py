@@ -0,0 +1,50 @@
+import random
+import asyncio
+from datetime import date, datetime, time, timedelta, timezone
+
+import message_cache
+import stats_tracker
+from benchmark import enumerate_dialogs
+from fake_telegram import FakeTelegramClient, make_workload
+
+# Dialogs chosen from the index against a live iter_dialogs walk, after a full refresh and after
+# an incremental one that reads only the pinned dialogs and the ones with new messages
+
+
+def refresh(client, cache):
+    client.api_calls = 0
+    asyncio.run(stats_tracker.refresh_dialog_index(client, cache, 'test'))
+    return client.api_calls
+
+
+def indexed_dialogs(cache, start):
+    window_start = datetime.combine(start, time.min, tzinfo=timezone.utc)
+    return [row['entity_id'] for row in message_cache.load_dialogs(cache, 'test', window_start)]
+
+
+def test_same_dialogs_as_enumeration(tmp_path):
+    me, dialogs, messages = make_workload(dms=1000, groups=0, dm_messages=2, days=40, seed=0)
+    start = date(2024, 3, 4) + timedelta(days=10)
+    rng = random.Random(0)
+    in_window = [dialog for dialog in dialogs if dialog.date.date() >= start]
+    pinned = rng.sample(in_window, 4)
+    for dialog in pinned[:3]:
+        dialog.pinned = True
+    client = FakeTelegramClient(me, dialogs, messages)
+    cache = message_cache.open_cache(str(tmp_path / 'cache.sqlite3'))
+    try:
+        full = refresh(client, cache)
+        assert indexed_dialogs(cache, start) == asyncio.run(enumerate_dialogs(client, start))
+
+        # Before the next run some dialogs get new messages, one is unpinned and another one pinned
+        latest = max(dialog.date for dialog in dialogs)
+        for dialog in rng.sample([dialog for dialog in dialogs if dialog not in pinned], 10):
+            dialog.date = latest + timedelta(seconds=rng.randrange(1, 86400))
+        pinned[0].pinned = False
+        pinned[3].pinned = True
+
+        incremental = refresh(client, cache)
+        assert indexed_dialogs(cache, start) == asyncio.run(enumerate_dialogs(client, start))
+        assert incremental < full
+    finally:
+        cache.close()
@@ -0,0 +1,123 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from telethon.errors import FloodWaitError
+from telethon.tl.types import Channel
+
+import stats_tracker
+from fake_telegram import FakeTelegramClient, make_workload
+
+# fetch_messages against walking the history by date and filtering on the client, on private
+# chats, basic groups and megagroups big enough to be fetched in parts: the same messages,
+# no more API calls and no pauses between pages
+
+TIMEZONES = [timezone.utc, timezone(timedelta(hours=3)), timezone(timedelta(hours=-7))]
+
+
+async def date_filtered(client, entity, window_start, window_end):
+    messages = []
+    async for message in client.iter_messages(entity, offset_date=window_end):
+        if message.date < window_start:
+            break
+        messages.append(message)
+    return messages
+
+
+async def fetch_all(client, dialogs, fetch):
+    client.api_calls = 0
+    client.paused = 0.0
+    fetched = {}
+    for dialog in dialogs:
+        fetched[dialog.entity.id] = [message.id for message in await fetch(dialog)]
+    return fetched, client.api_calls, client.paused
+
+
+@pytest.fixture(scope='module')
+def workload():
+    return make_workload(dms=20, groups=4, dm_messages=300, group_messages=20000, days=9, seed=0)
+
+
+@pytest.mark.parametrize('tz', TIMEZONES, ids=str)
+def test_same_messages_no_more_calls(workload, tz):
+    # A window in the middle of the history, so both of its ends cut through the dialogs
+    client = FakeTelegramClient(*workload)
+    start, end = datetime(2024, 3, 7), datetime(2024, 3, 9)
+    window_start, window_end = stats_tracker.date_window(start, end, tz)
+
+    expected, filtered_calls, _ = asyncio.run(fetch_all(
+        client, client.dialogs, lambda d: date_filtered(client, d.entity, window_start, window_end)))
+    fetched, calls, paused = asyncio.run(fetch_all(
+        client, client.dialogs, lambda d: stats_tracker.fetch_messages(client, d.entity, start, end, d.date, tz)))
+
+    assert fetched == expected
+    assert calls <= filtered_calls
+    assert paused == 0
+
+
+async def stream_ids(client, entity, start, end, last_date, tz):
+    return [record.id async for record in stats_tracker.stream_messages(client, entity, start, end, last_date, tz)]
+
+
+@pytest.mark.parametrize('tz', TIMEZONES, ids=str)
+def test_stream_same_calls_as_list(workload, tz):
+    # Streaming mode walks forwards from the start of the window: the messages of list mode oldest
+    # first, and no more API calls than the date walk list mode is held to
+    client = FakeTelegramClient(*workload)
+    start, end = datetime(2024, 3, 7), datetime(2024, 3, 9)
+    window_start, window_end = stats_tracker.date_window(start, end, tz)
+
+    expected, filtered_calls, _ = asyncio.run(fetch_all(
+        client, client.dialogs, lambda d: date_filtered(client, d.entity, window_start, window_end)))
+    client.api_calls = 0
+    client.paused = 0.0
+    for dialog in client.dialogs:
+        ids = asyncio.run(stream_ids(client, dialog.entity, start, end, dialog.date, tz))
+        assert ids == expected[dialog.entity.id][::-1]
+
+    assert client.api_calls <= filtered_calls
+    assert client.paused == 0
+
+
+def test_window_in_time_zone(workload):
+    # The window is the local days of tz, messages just outside of them in UTC are left out
+    client = FakeTelegramClient(*workload)
+    tz = timezone(timedelta(hours=3))
+    day = datetime(2024, 3, 7)
+    fetched = 0
+    for dialog in client.dialogs:
+        messages = asyncio.run(stats_tracker.fetch_messages(client, dialog.entity, day, day, dialog.date, tz))
+        assert all(message.date.astimezone(tz).date() == day.date() for message in messages)
+        fetched += len(messages)
+    assert fetched
+
+
+class FloodWaitClient(FakeTelegramClient):
+    # FloodWait on the n-th history request
+    def __init__(self, *args, flood_after=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.flood_after = flood_after
+
+    async def _request(self, history=False):
+        if history:
+            self.flood_after -= 1
+            if self.flood_after == 0:
+                self.api_calls += 1
+                raise FloodWaitError(request=None, capture=0)
+        await super()._request(history)
+
+
+def test_split_parts_stop_on_flood_wait(workload):
+    # A FloodWait in one part of a split megagroup stops the other parts before fetch_messages raises
+    async def fetch():
+        client = FloodWaitClient(*workload, latency=0.001, flood_after=4)
+        dialog = next(dialog for dialog in client.dialogs if isinstance(dialog.entity, Channel))
+        with pytest.raises(FloodWaitError):
+            await stats_tracker.fetch_messages(client, dialog.entity, datetime(2024, 3, 7), datetime(2024, 3, 9),
+                                               dialog.date)
+        calls = client.api_calls
+        await asyncio.sleep(0.05)
+        return calls, client.api_calls
+
+    calls, later = asyncio.run(fetch())
+    assert later == calls
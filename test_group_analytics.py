@@ -0,0 +1,39 @@
+import random
+from datetime import date, time
+
+import pytest
+
+import group_analytics
+import message_cache
+from benchmark import random_group, run_report, scan_group_replies
+from fake_telegram import make_workload
+
+# Indexed reply attribution against a reference that scans the message list, and the group
+# analytics report live and through the cache
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_attribution_same_as_scanning(seed):
+    rng = random.Random(seed)
+    for _ in range(75):
+        messages = random_group(rng, rng.randint(0, 400), participants=rng.randint(1, 20))
+        rng.shuffle(messages)
+        analytics = group_analytics.analyze_group(messages)
+        indexed = {p['sender_id']: [p['my_replies'], p['my_reply_seconds']] for p in analytics['participants']
+                   if p['my_replies']}
+        assert indexed == scan_group_replies(messages)
+
+
+def test_same_report_through_cache(tmp_path):
+    start, end = date(2024, 3, 4), date(2024, 3, 6)
+    workload = make_workload(dms=10, groups=4, days=3, seed=0, reply_share=0.3, mention_share=0.05)
+    report = run_report(workload, 0, 8, start, end, time(9), time(18), analyze_groups=True)
+    cache = message_cache.open_cache(str(tmp_path / 'cache.sqlite3'))
+    try:
+        run_report(workload, 0, 8, start, end, time(9), time(18), cache=cache, session_id='test')
+        cached = run_report(workload, 0, 8, start, end, time(9), time(18), analyze_groups=True, cache=cache,
+                            session_id='test')
+    finally:
+        cache.close()
+    assert cached[2] == report[2]
+    assert any('_group_analytics_' in name for name in report[2])
@@ -0,0 +1,53 @@
+import io
+import json
+import random
+import asyncio
+import contextlib
+from datetime import date, time, timedelta
+
+import pytest
+
+import message_cache
+import stats_tracker
+from benchmark import loop_time_spent, random_conversation, snapshot_tree
+from fake_telegram import FakeTelegramClient, make_workload
+
+# Exact day partials against calculate_time_spent, then daily rolling reports over a warm cache
+# built in full and incrementally, with the JSON report and its diff
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_merged_day_partials_same_as_loop(seed):
+    rng = random.Random(seed)
+    for _ in range(250):
+        messages = random_conversation(rng, rng.randint(0, 300))
+        work_start = time(rng.randint(0, 11), rng.choice([0, 30]))
+        work_end = time(rng.randint(12, 23), rng.choice([0, 59]))
+        group = rng.random() < 0.5
+        # through JSON, like the partials stored in the cache
+        partials = json.loads(json.dumps(list(stats_tracker.day_partials(messages, work_start, work_end,
+                                                                         group).items()), default=str))
+        merged = stats_tracker.merge_day_partials([partial for _, partial in sorted(partials)], work_start, work_end,
+                                                  group, exact=True)
+        assert merged == loop_time_spent(messages, work_start, work_end, group), (work_start, work_end, group)
+
+
+def test_incremental_same_as_full(tmp_path):
+    window, runs = 3, 3
+    workload = make_workload(dms=20, groups=4, days=window + runs - 1, seed=0)
+    caches = {mode: message_cache.open_cache(str(tmp_path / f'{mode}.sqlite3')) for mode in ('full', 'incr')}
+    try:
+        for run in range(runs):
+            start = date(2024, 3, 4) + timedelta(days=run)
+            end = start + timedelta(days=window - 1)
+            for mode, cache in caches.items():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    asyncio.run(stats_tracker.process_chats(FakeTelegramClient(*workload), start, end, time(9),
+                                                            time(18), cache=cache, session_id='test',
+                                                            output_root=str(tmp_path / mode),
+                                                            incremental=mode == 'incr', diff=True))
+            assert snapshot_tree(tmp_path / 'full') == snapshot_tree(tmp_path / 'incr')
+    finally:
+        for cache in caches.values():
+            cache.close()
+    assert any('_report_diff_' in name for name in snapshot_tree(tmp_path / 'incr'))
@@ -0,0 +1,25 @@
+from datetime import date, time, timedelta
+
+import message_cache
+from benchmark import run_report
+from fake_telegram import make_workload
+
+# A rolling window: the report of the next day through a warm cache against one without the cache
+
+
+def test_warm_cache_same_as_no_cache(tmp_path):
+    workload = make_workload(dms=20, groups=4, days=4, seed=0)
+    first = (date(2024, 3, 4), date(2024, 3, 6))
+    second = (first[0] + timedelta(days=1), first[1] + timedelta(days=1))
+
+    cache = message_cache.open_cache(str(tmp_path / 'cache.sqlite3'))
+    try:
+        cold = run_report(workload, 0, 8, *first, time(9), time(18), cache=cache, session_id='test')
+        warm = run_report(workload, 0, 8, *second, time(9), time(18), cache=cache, session_id='test')
+    finally:
+        cache.close()
+    uncached = run_report(workload, 0, 8, *second, time(9), time(18))
+
+    assert warm[2] == uncached[2]
+    assert warm[3] == uncached[3]
+    assert warm[1] < cold[1]
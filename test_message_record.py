@@ -0,0 +1,38 @@
+from datetime import date, time
+
+import message_cache
+import reply_models
+from benchmark import run_report
+from fake_telegram import make_workload
+
+# Media-aware accounting from the metadata of history pages: no more API calls than a text-only
+# workload of the same size, and the same media report through the cache
+
+START, END = date(2024, 3, 4), date(2024, 3, 6)
+
+
+def workload(text_only=False):
+    workload = make_workload(dms=20, groups=4, days=3, seed=0, media_share=0.2)
+    if text_only:
+        for history in workload[2].values():
+            for message in history:
+                message.media = message.fwd_from = None
+    return workload
+
+
+def test_media_from_metadata(tmp_path):
+    models = reply_models.preset_models(['legacy', 'media'], time(9), time(18))
+    report = run_report(workload(), 0, 8, START, END, time(9), time(18), models=models)
+    text_only = run_report(workload(text_only=True), 0, 8, START, END, time(9), time(18))
+    assert report[1] == text_only[1]
+
+    cache = message_cache.open_cache(str(tmp_path / 'cache.sqlite3'))
+    try:
+        run_report(workload(), 0, 8, START, END, time(9), time(18), cache=cache, session_id='test')
+        cached = run_report(workload(), 0, 8, START, END, time(9), time(18), models=models, cache=cache,
+                            session_id='test')
+    finally:
+        cache.close()
+    assert cached[2] == report[2]
+    [name] = [name for name in report[2] if '_models_' in name]
+    assert 'Голосовое' in report[2][name].decode('utf-8')
@@ -0,0 +1,48 @@
+import os
+import random
+import shutil
+from datetime import date, time
+
+import pytest
+
+import output_writer
+import stats_tracker
+from benchmark import archive_files, legacy_save_messages, random_conversation, run_report, snapshot_tree
+from fake_telegram import WORDS, make_workload
+
+# Buffered transcripts and linked UNANSWERED copies against per-line writes and copied folders,
+# and a report written into an archive against the same report in the messages folder
+
+
+def test_buffered_transcripts_same_as_per_line(tmp_path):
+    roots = {}
+    for name, save, place in (('legacy', legacy_save_messages, shutil.copytree),
+                              ('buffered', stats_tracker.save_messages, output_writer.link_tree)):
+        rng = random.Random(0)
+        root = roots[name] = tmp_path / name
+        for i in range(50):
+            messages = sorted(random_conversation(rng, rng.randint(0, 200)), key=lambda m: m.id, reverse=True)
+            for msg in messages[::10]:
+                msg.text += '\n' + ' '.join(rng.choices(WORDS, k=4))
+            os.makedirs(root / f'chat{i}')
+            save(str(root / f'chat{i}'), f'chat{i}.txt', messages)
+        for i in range(0, 50, 3):
+            place(str(root / f'chat{i}'), str(root / '!!!!!UNANSWERED' / f'chat{i}'))
+    assert snapshot_tree(roots['buffered']) == snapshot_tree(roots['legacy'])
+
+
+@pytest.mark.parametrize('archive', output_writer.available_archive_formats())
+def test_archive_same_as_folder(tmp_path, archive):
+    workload = make_workload(dms=20, groups=4, days=3, seed=0)
+    start, end = date(2024, 3, 4), date(2024, 3, 6)
+    folder = run_report(workload, 0, 8, start, end, time(9), time(18))
+    report = run_report(workload, 0, 8, start, end, time(9), time(18), archive=archive)
+
+    [name] = [name for name in report[2] if name.endswith(archive)]
+    path = tmp_path / f'report.{archive}'
+    path.write_bytes(report[2][name])
+    messages = {name: data for name, data in folder[2].items() if '_messages_' in name}
+    assert archive_files(str(path)) == {name.replace(os.sep, '/'): data for name, data in messages.items()}
+    assert {n: data for n, data in report[2].items() if n != name} == {
+        n: data for n, data in folder[2].items() if n not in messages}
+    assert report[3] == folder[3]
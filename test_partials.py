@@ -0,0 +1,61 @@
+import io
+import random
+import contextlib
+from datetime import date, datetime, time, timedelta
+
+import pytest
+
+import message_cache
+import stats_tracker
+from benchmark import run_report, summary_lines
+from fake_telegram import make_workload
+
+# Totals of sub-ranges merged from the day partials one cached report stored, against full
+# reports of the same ranges
+
+DAYS = 6
+FIRST_DAY = date(2024, 3, 4)
+
+
+@pytest.fixture(scope='module')
+def workload():
+    return make_workload(dms=20, groups=4, days=DAYS, seed=0)
+
+
+@pytest.fixture(scope='module')
+def cache(workload, tmp_path_factory):
+    cache = message_cache.open_cache(str(tmp_path_factory.mktemp('partials') / 'cache.sqlite3'))
+    run_report(workload, 0, 8, FIRST_DAY, FIRST_DAY + timedelta(days=DAYS - 1), time(9), time(18),
+               cache=cache, session_id='test')
+    yield cache
+    cache.close()
+
+
+def totals(cache, start, end):
+    return stats_tracker.totals_from_partials(cache, 'test', datetime.combine(start, time.min),
+                                              datetime.combine(end, time.min), time(9), time(18))
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_same_totals_as_full_report(workload, cache, seed):
+    rng = random.Random(seed)
+    start = FIRST_DAY + timedelta(days=rng.randrange(DAYS))
+    end = start + timedelta(days=rng.randrange((FIRST_DAY - start).days + DAYS))
+    report = run_report(workload, 0, 8, start, end, time(9), time(18))
+
+    chat_totals, group_totals, missing = totals(cache, start, end)
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        stats_tracker.print_summary(stats_tracker.make_summary('test', 0, 0, chat_totals, group_totals))
+    assert not missing
+    assert summary_lines(stdout.getvalue()) == summary_lines(report[3])
+
+
+def test_missing_days(workload, cache):
+    # A range reaching past the cached days: the day after is missing for every dialog, which
+    # is left out of the totals
+    end = FIRST_DAY + timedelta(days=DAYS)
+    chat_totals, group_totals, missing = totals(cache, FIRST_DAY, end)
+    assert len(missing) == len(workload[1])
+    assert all([day.date() for day in days] == [end] for days in missing.values())
+    assert chat_totals['incoming_messages'] == group_totals['incoming_messages'] == 0
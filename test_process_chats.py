@@ -0,0 +1,48 @@
+from datetime import date, time
+
+import pytest
+
+import stats_tracker
+from benchmark import run_report
+from fake_telegram import make_workload
+
+# process_chats run sequentially, concurrently, with the output stage offloaded and with huge
+# dialogs fetched in parts: the files and the printed report never change
+
+START, END = date(2024, 3, 4), date(2024, 3, 6)
+
+
+@pytest.fixture(scope='module')
+def workload():
+    return make_workload(dms=20, groups=4, days=3, seed=0)
+
+
+@pytest.fixture(scope='module')
+def sequential(workload):
+    return run_report(workload, 0, 1, START, END, time(9), time(18))
+
+
+@pytest.mark.parametrize('concurrency', [4, 16])
+def test_concurrent_same_as_sequential(workload, sequential, concurrency):
+    report = run_report(workload, 0, concurrency, START, END, time(9), time(18))
+    assert report[2] == sequential[2]
+    assert report[3] == sequential[3]
+    assert report[1] == sequential[1]
+
+
+@pytest.mark.parametrize('offload', [None, 'thread', 'process'])
+def test_offload_same_output(workload, sequential, offload):
+    report = run_report(workload, 0, 8, START, END, time(9), time(18), offload=offload)
+    assert report[2] == sequential[2]
+    assert report[3] == sequential[3]
+
+
+def test_split_same_as_serial(monkeypatch):
+    # A report dominated by one huge megagroup: its window fetched in one walk and in parts
+    workload = make_workload(dms=10, groups=1, days=3, seed=0, group_messages=20000)
+    split = run_report(workload, 0, 8, START, END, time(9), time(18))
+    monkeypatch.setattr(stats_tracker, 'FETCH_SPLIT_MAX_PARTS', 1)
+    serial = run_report(workload, 0, 8, START, END, time(9), time(18))
+    assert split[2] == serial[2]
+    assert split[3] == serial[3]
+    assert split[1] <= serial[1]
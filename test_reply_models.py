@@ -0,0 +1,37 @@
+import random
+from datetime import date, datetime, time, timedelta, timezone
+
+import pytest
+
+import reply_models
+from benchmark import loop_time_spent, random_conversation
+from message_record import MessageRecord
+
+# The legacy reply model against calculate_time_spent on seeded random conversations, and a
+# working calendar against the legacy rule on a night shift
+
+FIRST_DAY, LAST_DAY = date(2024, 3, 4), date(2024, 5, 4)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_legacy_model_same_as_calculate_time_spent(seed):
+    rng = random.Random(seed)
+    for _ in range(300):
+        messages = random_conversation(rng, rng.randint(0, 300))
+        work_start = time(rng.randint(0, 11), rng.choice([0, 30]))
+        work_end = time(rng.randint(12, 23), rng.choice([0, 59]))
+        group = rng.random() < 0.5
+        model = reply_models.compile_model(reply_models.legacy_model(work_start, work_end), FIRST_DAY, LAST_DAY)
+        assert (reply_models.calculate_models(messages, [model], group)['legacy']
+                == loop_time_spent(messages, work_start, work_end, group)), (work_start, work_end, group)
+
+
+def test_calendar_night_shift():
+    # A reply after midnight is working time for a 22:00-06:00 calendar, night time for the legacy rule
+    question = MessageRecord(1, datetime(2024, 3, 4, 23, 50, tzinfo=timezone.utc), False, 'q', 'q')
+    answer = MessageRecord(2, question.date + timedelta(minutes=20), True, 'a', 'a')
+    models = [reply_models.compile_model(model, FIRST_DAY, LAST_DAY)
+              for model in reply_models.preset_models(['legacy', 'everyday'], time(22), time(6))]
+    shift = reply_models.calculate_models([question, answer], models)
+    assert not shift['legacy']['working_reply_times']
+    assert shift['everyday']['working_reply_times'] == [1200.0]
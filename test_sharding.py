@@ -0,0 +1,18 @@
+import functools
+from datetime import date, time
+
+from benchmark import run_report
+from fake_telegram import FakeTelegramClient, make_workload
+
+# Worker processes against a single process on the same workload: the fake client of every
+# worker is built from the same workload, so the files and the printed report must be identical
+
+
+def test_shards_same_as_single_process():
+    workload = make_workload(dms=20, groups=4, days=3, seed=0)
+    start, end = date(2024, 3, 4), date(2024, 3, 6)
+    single = run_report(workload, 0, 8, start, end, time(9), time(18))
+    sharded = run_report(workload, 0, 8, start, end, time(9), time(18), shards=2,
+                         make_client=functools.partial(FakeTelegramClient, *workload))
+    assert sharded[2] == single[2]
+    assert sharded[3] == single[3]
@@ -0,0 +1,34 @@
+import random
+from datetime import time
+
+import pytest
+
+import stats_tracker
+import vectorized_stats
+from benchmark import loop_time_spent, random_conversation
+
+# The NumPy engine against the per-message loop on seeded random conversations: bursts,
+# same-second messages, empty texts, long gaps, any working hours, chats and groups
+
+pytestmark = pytest.mark.skipif(not vectorized_stats.available(), reason='numpy is not installed')
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_same_as_loop(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        messages = random_conversation(rng, rng.randint(0, 300))
+        work_start = time(rng.randint(0, 11), rng.choice([0, 30]))
+        work_end = time(rng.randint(12, 23), rng.choice([0, 59]))
+        group = rng.random() < 0.5
+        assert (vectorized_stats.calculate_time_spent(messages, work_start, work_end, group)
+                == loop_time_spent(messages, work_start, work_end, group)), (work_start, work_end, group)
+
+
+def test_dispatch_above_threshold():
+    # calculate_time_spent switches to NumPy for big dialogs, the result does not change
+    rng = random.Random(0)
+    messages = random_conversation(rng, stats_tracker.VECTORIZE_MIN_MESSAGES * 3)
+    for group in (False, True):
+        assert (stats_tracker.calculate_time_spent(messages, time(9), time(18), group)
+                == loop_time_spent(messages, time(9), time(18), group))